@@ -1,93 +1,276 @@
-from typing import List, Dict
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, List, Dict, NamedTuple, Optional, Set, Iterator, Tuple
 from memory import Memory, DEFAULT_MEMORY_LOCATION
 from prompts.facts import init_assistant_facts, init_system_prompt
 from config.commands import FACT_KEY_COMMANDS, PROCEDURE_KEY_COMMANDS
-from openai import OpenAI
+from utils.command_router import CommandMatch, CommandRouter
+from utils.llm_client import get_shared_http_client, create_async_http_client, DEFAULT_TIMEOUT, DEFAULT_MAX_RETRIES, DEFAULT_MAX_CONNECTIONS
+from utils.context_builder import estimate_tokens
+from utils.metrics import MetricsRegistry
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONTEXT_TOKEN_BUDGET = 2000
+
+class MessageResult(NamedTuple):
+    response: Optional[str]
+    # Seconds spent in each phase of the message
+    timings: Dict[str, float]
+    # What was cut to fit the context in the token budget, see Memory.build_context
+    context_report: Optional[Dict[str, Any]]
+
+
 class Agent:
-    def __init__(self, memory_location: str = DEFAULT_MEMORY_LOCATION):
-        self.memory = Memory(memory_location)
+    # client: OpenAI client to use, by default one is created on the first call
+    # on top of the connection pool shared by all agents of the process
+    # context_token_budget: estimated tokens the memory context may use, None for no limit
+    # memory: memory to use instead of loading memory_location, e.g. one from a MemoryPool
+    # metrics: registry for the phase timings, by default the one of the memory
+    def __init__(self, memory_location: str = DEFAULT_MEMORY_LOCATION, client: Optional[OpenAI] = None,
+                 timeout: float = DEFAULT_TIMEOUT, max_retries: int = DEFAULT_MAX_RETRIES,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 context_token_budget: Optional[int] = DEFAULT_CONTEXT_TOKEN_BUDGET,
+                 memory: Optional[Memory] = None, metrics: Optional[MetricsRegistry] = None):
+        self.memory = memory if memory is not None else Memory(memory_location, metrics=metrics)
+        self.metrics = metrics or self.memory.metrics
+        # Seconds spent in each phase of the latest message
+        self.last_timings: Dict[str, float] = {}
         self.model_name = "gpt-4.1-nano"
+        self.context_token_budget = context_token_budget
+        self.last_context_report = None
+        self.client = client
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_connections = max_connections
+
+        # Async client of the event loop it was created in
+        self.async_client: Optional[AsyncOpenAI] = None
+        self.async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+        # Interaction writes still running after process_message_async returned
+        self.pending_writes: Set[asyncio.Future] = set()
+
+        # Key commands of config/commands.py, more can be added with register_command
+        self.commands = CommandRouter()
+        self.register_command("learn_fact", FACT_KEY_COMMANDS, self.handle_learn_fact)
+        self.register_command("learn_procedure", PROCEDURE_KEY_COMMANDS, self.handle_learn_procedure)
+
+        self.memory.add_facts(init_assistant_facts, "fact")
+
+    def get_client(self) -> OpenAI:
+        if self.client is None:
+            http_client = get_shared_http_client(max_connections=self.max_connections)
+            self.client = OpenAI(http_client=http_client, timeout=self.timeout, max_retries=self.max_retries)
+        return self.client
+
+    def get_async_client(self) -> AsyncOpenAI:
+        loop = asyncio.get_running_loop()
+        if self.async_client is None or self.async_client_loop is not loop:
+            http_client = create_async_http_client(max_connections=self.max_connections)
+            self.async_client = AsyncOpenAI(http_client=http_client, timeout=self.timeout, max_retries=self.max_retries)
+            self.async_client_loop = loop
+        return self.async_client
 
-        for fact in init_assistant_facts:
-            self.memory.add_fact(fact, "fact")
+    @contextmanager
+    def phase(self, name: str, timings: Optional[Dict[str, float]] = None) -> Iterator[None]:
+        """Time a phase of message processing as agent.<name>, into `timings` or last_timings."""
+        if not self.metrics.enabled:
+            yield
+            return
+        timings = self.last_timings if timings is None else timings
+        start = time.perf_counter()
+        try:
+            with self.metrics.timer(f"agent.{name}"):
+                yield
+        finally:
+            timings[name] = time.perf_counter() - start
 
     def get_system_prompt(self) -> str:
         return init_system_prompt
     
-    def get_key_command(self, message: str, list_of_commands: List[str]) -> str:
-        for key_command in list_of_commands:
-            if key_command in message.lower():
-                return key_command
-        return None
-    
-    def learn_fact(self, message: str, key_command: str) -> None:
+    def register_command(self, name: str, key_commands: Iterable[str], handler: Callable[[CommandMatch], str]) -> None:
+        """
+        Handle messages containing one of `key_commands` with `handler`,
+        which gets the CommandMatch and returns what extract_and_learn returns.
+        """
+        self.commands.add(name, key_commands, handler)
+
+    # key_command: removed from the message, None if the message is only the fact
+    def learn_fact(self, message: str, key_command: Optional[str] = None) -> None:
         try:
-            fact = message.replace(key_command, "").strip()
+            fact = (message.replace(key_command, "") if key_command else message).strip()
             if fact: 
                 self.memory.add_fact(fact, "fact")
-                print(f"Learned fact: {fact}")
+                logger.info("Learned fact: %s", fact)
             else:
-                print(f"No fact found in message: {message}.")
+                logger.warning("No fact found in message: %s", message)
         except Exception as e:
-            print(f"Error learning fact: {e}. Format should be: {FACT_KEY_COMMANDS[0]} <fact>")
+            logger.error("Error learning fact: %s. Format should be: %s <fact>", e, FACT_KEY_COMMANDS[0])
     
-    def learn_procedure(self, message: str, key_command: str) -> None:
+    # key_command: removed from the message, None if the message starts with the procedure name
+    def learn_procedure(self, message: str, key_command: Optional[str] = None) -> None:
         try:
             start, steps = message.split(":", 1)
-            procedure_name = start.replace(key_command, "").strip()
+            procedure_name = (start.replace(key_command, "") if key_command else start).strip()
             steps = [f"{i+1}. {step.strip()}" for i, step in enumerate(steps.split(","))]
             if len(steps) > 0: 
                 self.memory.add_procedure(procedure_name, steps, "procedure")
-                print(f"Learned procedure: {procedure_name} with steps: {steps}")
+                logger.info("Learned procedure: %s with steps: %s", procedure_name, steps)
             else:
-                print(f"No steps found in message: {message}.")
+                logger.warning("No steps found in message: %s", message)
         except Exception as e:
-            print(f"Error learning procedure: {e}. Format should be: {PROCEDURE_KEY_COMMANDS[0]} <procedure_name>: <step1>, <step2>, <step3>, ...")
+            logger.error("Error learning procedure: %s. Format should be: %s <procedure_name>: <step1>, <step2>, <step3>, ...", e, PROCEDURE_KEY_COMMANDS[0])
+
+    def handle_learn_fact(self, match: CommandMatch) -> str:
+        self.learn_fact(match.payload)
+        return "learned fact"
+
+    def handle_learn_procedure(self, match: CommandMatch) -> str:
+        self.learn_procedure(match.payload)
+        return "learned procedure"
     
     def extract_and_learn(self, message: str) -> str:
-        learn_fact_key_command = self.get_key_command(message, FACT_KEY_COMMANDS)
-        learn_procedure_key_command = self.get_key_command(message, PROCEDURE_KEY_COMMANDS)
-
-        if learn_fact_key_command:
-            self.learn_fact(message, learn_fact_key_command)
-            return "learned fact"
-        elif learn_procedure_key_command:
-            self.learn_procedure(message, learn_procedure_key_command)
-            return "learned procedure"
-        else:
-            print(f"No key command found in message: {message}. Proceed to create a context for the user's question.")
+        result = self.commands.route(message)
+        if result is None:
+            logger.debug("No key command found in message: %s. Proceed to create a context for the user's question.", message)
             return "no key command found"
+        return result
 
     def build_messages(self, message: str) -> List[Dict[str, str]]:
-        context = self.memory.get_context(message)
+        messages, self.last_context_report = self.build_messages_with_report(message)
+        return messages
+
+    def build_messages_with_report(self, message: str) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        context, report = self.memory.build_context(message, token_budget=self.context_token_budget)
+        if report["dropped"] or report["truncated"]:
+            logger.info("Context cut to %s tokens: dropped %d and truncated %d items", self.context_token_budget, len(report["dropped"]), len(report["truncated"]))
         messages = [
             {"role": "system", "content": self.get_system_prompt()},
             {"role": "system", "content": f"Context: {context}"},
             {"role": "user", "content": message}
         ]
-        return messages
+        return messages, report
 
     def call_openai_api(self, messages: List[Dict[str, str]]) -> str:
         try:
-            client = OpenAI()
+            client = self.get_client()
             response = client.chat.completions.create(model=self.model_name, messages=messages, temperature=0.5, max_tokens=1000)
             content = response.choices[0].message.content
-            print(f"Response from OpenAI: {content}")
+            logger.debug("Response from OpenAI: %s", content)
+            return content
+        except Exception as e:
+            self.metrics.increment("agent.llm_errors")
+            logger.error("Error getting response from OpenAI: %s", e)
+            return None
+
+    async def call_openai_api_async(self, messages: List[Dict[str, str]]) -> str:
+        try:
+            client = self.get_async_client()
+            response = await client.chat.completions.create(model=self.model_name, messages=messages, temperature=0.5, max_tokens=1000)
+            content = response.choices[0].message.content
+            logger.debug("Response from OpenAI: %s", content)
             return content
         except Exception as e:
-            print(f"Error getting response from OpenAI: {e}")
+            self.metrics.increment("agent.llm_errors")
+            logger.error("Error getting response from OpenAI: %s", e)
             return None
 
+    def prepare_messages(self, message: str) -> List[Dict[str, str]]:
+        self.last_timings = {}
+        messages, self.last_context_report = self.prepare_messages_with_report(message, self.last_timings)
+        return messages
+
+    def prepare_messages_with_report(self, message: str, timings: Dict[str, float]) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        """The memory work before the LLM call, timed into `timings`, leaving last_timings and last_context_report alone."""
+        self.metrics.increment("agent.messages")
+        # Pick up what other processes sharing the memory location learned
+        with self.phase("refresh", timings):
+            self.memory.refresh()
+        with self.phase("extract_and_learn", timings):
+            self.extract_and_learn(message)
+        with self.phase("build_context", timings):
+            messages, report = self.build_messages_with_report(message)
+        if self.metrics.enabled:
+            self.metrics.observe("agent.prompt_tokens", sum(estimate_tokens(m["content"]) for m in messages))
+        return messages, report
     
     def process_message(self, message: str) -> str:
-        self.extract_and_learn(message)
-        messages = self.build_messages(message)
-        response = self.call_openai_api(messages)
+        messages = self.prepare_messages(message)
+        with self.phase("llm_call"):
+            response = self.call_openai_api(messages)
         if response: 
-            self.memory.add_interaction(message, response)
+            with self.phase("save_interaction"):
+                self.memory.add_interaction(message, response)
         
-        return response
\ No newline at end of file
+        return response
+
+    def stream_message(self, message: str) -> Iterator[str]:
+        """
+        Same pipeline as process_message, yielding the response as it is generated.
+
+        The full response is stored as an interaction once the stream ends,
+        nothing is stored if the call fails.
+        """
+        messages = self.prepare_messages(message)
+        chunks = []
+        try:
+            start = time.perf_counter()
+            client = self.get_client()
+            stream = client.chat.completions.create(model=self.model_name, messages=messages, temperature=0.5, max_tokens=1000, stream=True)
+            for chunk in stream:
+                content = chunk.choices[0].delta.content if chunk.choices else None
+                if content:
+                    if not chunks:
+                        self.metrics.observe("agent.first_chunk", time.perf_counter() - start, kind="timer")
+                    chunks.append(content)
+                    yield content
+        except Exception as e:
+            self.metrics.increment("agent.llm_errors")
+            logger.error("Error streaming response from OpenAI: %s", e)
+            return
+
+        response = "".join(chunks)
+        logger.debug("Response from OpenAI: %s", response)
+        if response:
+            with self.phase("save_interaction"):
+                self.memory.add_interaction(message, response)
+
+    async def process_message_async(self, message: str) -> str:
+        """
+        Same pipeline as process_message without blocking the event loop.
+
+        The interaction is written in the background after the response is
+        returned, use wait_for_writes to make sure it is on disk.
+        """
+        return (await self.run_message_async(message)).response
+
+    async def run_message_async(self, message: str) -> MessageResult:
+        """
+        process_message_async with the timings and context report of this
+        message: concurrent messages don't go through last_timings and
+        last_context_report, which would mix them up.
+
+        The memory work, which reads and writes files, runs on worker
+        threads so the event loop keeps serving other messages meanwhile.
+        """
+        timings: Dict[str, float] = {}
+        messages, report = await asyncio.to_thread(self.prepare_messages_with_report, message, timings)
+        with self.phase("llm_call", timings):
+            response = await self.call_openai_api_async(messages)
+        if response:
+            with self.phase("save_interaction", timings):
+                write = asyncio.wrap_future(await asyncio.to_thread(self.memory.add_interaction_in_background, message, response))
+            self.pending_writes.add(write)
+            write.add_done_callback(self.pending_writes.discard)
+
+        return MessageResult(response, timings, report)
+
+    async def wait_for_writes(self) -> None:
+        if self.pending_writes:
+            await asyncio.gather(*self.pending_writes)
\ No newline at end of file
@@ -0,0 +1,73 @@
+import datetime
+import random
+from typing import Any, Dict, List
+
+# Small vocabulary so searches hit a realistic share of the records
+SUBJECTS = ["user", "assistant", "project", "team", "manager", "server", "database", "meeting", "report", "customer"]
+ATTRIBUTES = ["name", "favourite colour", "language", "deadline", "budget", "location", "owner", "status", "version", "goal"]
+VALUES = ["blue", "Python", "Berlin", "Friday", "green", "production", "John", "Rust", "the cloud", "version two",
+          "Tokyo", "Monday", "red", "staging", "Alice", "JavaScript", "London", "Sunday", "yellow", "testing"]
+VERBS = ["deploy", "review", "cook", "book", "configure", "debug", "write", "plan", "clean", "install"]
+OBJECTS = ["the service", "pasta", "a flight", "the laptop", "the release", "a report", "the garden", "the database", "a meeting", "the budget"]
+QUESTIONS = ["What is the {attribute} of the {subject}?", "Can you help me {verb} {object}?",
+             "Remind me how to {verb} {object}", "Tell me about the {subject}", "Why is the {subject} {value}?"]
+ANSWERS = ["The {attribute} of the {subject} is {value}.", "Sure, first {verb} {object}, then check the {subject}.",
+           "You asked me to remember that the {subject} prefers {value}.", "I don't know the {attribute} of the {subject} yet."]
+
+START_TIME = datetime.datetime(2024, 1, 1)
+
+
+class Generator:
+    """Synthetic memory records, the same seed always produces the same records."""
+
+    def __init__(self, seed: int = 0):
+        self.random = random.Random(seed)
+        self.time = START_TIME
+
+    def words(self) -> Dict[str, str]:
+        return {
+            "subject": self.random.choice(SUBJECTS),
+            "attribute": self.random.choice(ATTRIBUTES),
+            "value": self.random.choice(VALUES),
+            "verb": self.random.choice(VERBS),
+            "object": self.random.choice(OBJECTS),
+        }
+
+    def timestamp(self) -> str:
+        self.time += datetime.timedelta(seconds=self.random.randint(1, 120))
+        return self.time.isoformat()
+
+    def fact(self, i: int) -> Dict[str, Any]:
+        words = self.words()
+        # The counter keeps facts unique, duplicates would be deduplicated away
+        return {"fact": f"The {words['attribute']} of {words['subject']} {i} is {words['value']}", "type": "fact", "timestamp": self.timestamp()}
+
+    def procedure(self, i: int) -> Dict[str, Any]:
+        words = self.words()
+        name = f"{words['verb']} {words['object']} {i}"
+        steps = [f"{step}. {self.random.choice(VERBS)} {self.random.choice(OBJECTS)}" for step in range(1, self.random.randint(2, 6) + 1)]
+        return {"description": "procedure", "name": name, "steps": steps, "timestamp": self.timestamp()}
+
+    def question(self) -> str:
+        return self.random.choice(QUESTIONS).format(**self.words())
+
+    def interaction(self) -> Dict[str, Any]:
+        return {
+            "agent_message": self.random.choice(ANSWERS).format(**self.words()),
+            "user_message": self.question(),
+            "metadata": None,
+            "timestamp": self.timestamp(),
+        }
+
+    def facts(self, count: int) -> List[Dict[str, Any]]:
+        return [self.fact(i) for i in range(count)]
+
+    def procedures(self, count: int) -> Dict[str, Dict[str, Any]]:
+        procedures = (self.procedure(i) for i in range(count))
+        return {procedure["name"]: procedure for procedure in procedures}
+
+    def interactions(self, count: int) -> List[Dict[str, Any]]:
+        return [self.interaction() for _ in range(count)]
+
+    def queries(self, count: int) -> List[str]:
+        return [self.question() for _ in range(count)]
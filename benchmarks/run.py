@@ -0,0 +1,188 @@
+"""
+Benchmarks of the memory operations on synthetic data.
+
+    python -m benchmarks.run --sizes 10000,100000 --output results.json
+
+A size is the number of interactions, with a tenth as many facts and a
+hundredth as many procedures. Each size runs in its own process so peak RSS
+is measured per size.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from benchmarks.generators import Generator
+from benchmarks.stub_llm import StubOpenAI
+from utils.json_file_utils import save_to_json_file
+from utils.metrics import default_registry
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_OPERATIONS = 100
+DEFAULT_SEED = 0
+OPERATIONS = ["init_cold", "init_warm", "add_interaction", "search_facts", "get_context", "process_message"]
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    # Nearest rank
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def summarize(latencies: List[float]) -> Dict[str, Any]:
+    """Latency percentiles in milliseconds and throughput in operations per second."""
+    values = sorted(latencies)
+    total = sum(values)
+    return {
+        "count": len(values),
+        "mean_ms": total / len(values) * 1000,
+        "p50_ms": percentile(values, 0.5) * 1000,
+        "p90_ms": percentile(values, 0.9) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+        "max_ms": values[-1] * 1000,
+        "throughput_per_s": len(values) / total if total else None,
+    }
+
+def measure(operation: Callable[[Any], Any], arguments: List[Any]) -> List[float]:
+    latencies = []
+    for argument in arguments:
+        start = time.perf_counter()
+        operation(argument)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def get_peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+def get_folder_size(location: str) -> int:
+    return sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(location) for name in names)
+
+def write_dataset(location: str, size: int, seed: int) -> None:
+    generator = Generator(seed)
+    save_to_json_file(location, "facts.json", generator.facts(max(size // 10, 1)))
+    save_to_json_file(location, "procedures.json", generator.procedures(max(size // 100, 1)))
+    save_to_json_file(location, "interactions.json", generator.interactions(size))
+
+def run_size(size: int, operations: int = DEFAULT_OPERATIONS, seed: int = DEFAULT_SEED, storage: str = "json",
+             llm_latency: float = 0.0, selected: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Run the benchmarks on one dataset size, returns the results of every operation."""
+    from memory import Memory
+    from agent import Agent
+
+    selected = selected or OPERATIONS
+    location = tempfile.mkdtemp(prefix="memory-benchmark-")
+    try:
+        start = time.perf_counter()
+        write_dataset(location, size, seed)
+        result = {"size": size, "setup_s": time.perf_counter() - start, "dataset_bytes": get_folder_size(location), "operations": {}}
+        # Per-phase timings of the whole run, see utils.metrics
+        default_registry.reset()
+        queries = Generator(seed + 1).queries(operations)
+        interactions = Generator(seed + 2).interactions(operations)
+
+        def run(name: str, operation: Callable[[Any], Any], arguments: List[Any]) -> None:
+            if name in selected:
+                result["operations"][name] = summarize(measure(operation, arguments))
+
+        # Cold loads build the search indexes, warm loads reuse the saved ones
+        repeats = [None] * min(operations, 5)
+        run("init_cold", lambda _: Memory(location, storage=storage), repeats)
+        memory = Memory(location, storage=storage)
+        memory.flush()
+        run("init_warm", lambda _: Memory(location, storage=storage), repeats)
+
+        run("add_interaction", lambda record: memory.add_interaction(record["user_message"], record["agent_message"]), interactions)
+        run("search_facts", memory.search_facts, queries)
+        run("get_context", memory.get_context, queries)
+
+        if "process_message" in selected:
+            client = StubOpenAI(latency=llm_latency)
+            agent = Agent(memory=memory, client=client)
+            run("process_message", agent.process_message, queries)
+            result["prompt_characters_mean"] = client.chat.completions.prompt_characters / max(client.chat.completions.calls, 1)
+
+        memory.flush()
+        result["file_bytes"] = get_folder_size(location)
+        result["peak_rss_mb"] = get_peak_rss_mb()
+        result["metrics"] = default_registry.snapshot()
+        return result
+    finally:
+        shutil.rmtree(location, ignore_errors=True)
+
+def run_size_in_process(queue: "multiprocessing.Queue", *args: Any) -> None:
+    queue.put(run_size(*args))
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(sizes: List[int], operations: int = DEFAULT_OPERATIONS, seed: int = DEFAULT_SEED, storage: str = "json",
+                   llm_latency: float = 0.0, selected: Optional[List[str]] = None, isolate: bool = True) -> Dict[str, Any]:
+    results = []
+    for size in sizes:
+        args = (size, operations, seed, storage, llm_latency, selected)
+        if isolate:
+            context = multiprocessing.get_context("spawn")
+            queue = context.Queue()
+            process = context.Process(target=run_size_in_process, args=(queue, *args))
+            process.start()
+            results.append(queue.get())
+            process.join()
+        else:
+            results.append(run_size(*args))
+        print(f"size {size}: " + ", ".join(f"{name} p50 {stats['p50_ms']:.2f} ms" for name, stats in results[-1]["operations"].items()), file=sys.stderr)
+
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(),
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": seed,
+            "operations": operations,
+            "storage": storage,
+            "llm_latency": llm_latency,
+        },
+        "results": results,
+    }
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark memory operations on synthetic data")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES), help="comma separated numbers of interactions")
+    parser.add_argument("--operations", type=int, default=DEFAULT_OPERATIONS, help="calls measured per operation")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--storage", default="json", help="storage mode of the memory")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds the stubbed LLM takes to answer")
+    parser.add_argument("--only", help=f"comma separated operations to run: {', '.join(OPERATIONS)}")
+    parser.add_argument("--no-isolate", action="store_true", help="run every size in this process")
+    parser.add_argument("--output", help="write the results to this JSON file instead of stdout")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    selected = args.only.split(",") if args.only else None
+    results = run_benchmarks(sizes, args.operations, args.seed, args.storage, args.llm_latency, selected, isolate=not args.no_isolate)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+
+class StubCompletions:
+    def __init__(self, latency: float, response: str):
+        self.latency = latency
+        self.response = response
+        self.calls = 0
+        self.prompt_characters = 0
+
+    def create(self, messages: List[Dict[str, str]], stream: bool = False, **kwargs: Any):
+        self.calls += 1
+        self.prompt_characters += sum(len(message["content"]) for message in messages)
+        if self.latency:
+            time.sleep(self.latency)
+
+        if stream:
+            return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word + " "))]) for word in self.response.split()])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.response))])
+
+
+class StubOpenAI:
+    """
+    Offline stand-in for the OpenAI client, answers every chat completion
+    with the same response after `latency` seconds.
+    """
+
+    def __init__(self, latency: float = 0.0, response: str = "This is a benchmark response."):
+        self.chat = SimpleNamespace(completions=StubCompletions(latency, response))
@@ -0,0 +1,194 @@
+import datetime
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from openai import OpenAI
+from memory import Memory, get_interaction_content
+from prompts.consolidation import consolidation_prompt
+from utils.json_file_utils import load_json_file, save_to_json_file
+from utils.llm_client import get_shared_http_client, DEFAULT_TIMEOUT, DEFAULT_MAX_RETRIES
+from utils.storage import SharedJournalStorage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_NAME = "gpt-4.1-nano"
+DEFAULT_BATCH_SIZE = 20
+# Interactions younger than this or among the newest KEEP_RECENT stay as they are
+DEFAULT_MIN_AGE = 24 * 60 * 60
+DEFAULT_KEEP_RECENT = 20
+DEFAULT_INTERVAL = 60.0
+DEFAULT_MAX_CALLS_PER_MINUTE = 10
+# Timestamp of the newest interaction consolidated so far, in the memory location
+STATE_FILE_NAME = "consolidation.json"
+
+def parse_facts(content: str) -> List[str]:
+    """Facts from the LLM answer, a JSON list of strings or, failing that, one fact per bullet line."""
+    content = content.strip()
+    if content.startswith("```"):
+        content = content.strip("`").removeprefix("json").strip()
+    try:
+        facts = json.loads(content)
+    except json.JSONDecodeError:
+        facts = [line.lstrip("-*• ").strip() for line in content.splitlines() if line.lstrip().startswith(("-", "*", "•"))]
+        if not facts:
+            raise ValueError(f"Unreadable consolidation answer: {content[:200]}")
+    if not isinstance(facts, list):
+        raise ValueError(f"Consolidation answer is not a list: {content[:200]}")
+    return [fact.strip() for fact in facts if isinstance(fact, str) and fact.strip()]
+
+
+class Consolidator:
+    """
+    Turns old interactions into facts in the background.
+
+    Every round takes the oldest interactions that are at least `min_age`
+    seconds old and not among the `keep_recent` newest, asks the LLM for the
+    facts worth keeping in one call per batch and adds them with a single
+    write. Consolidated interactions stay in the hot tier until they fill a
+    segment of `segment_size` (the archive's by default), then move into the
+    archive (see utils.segments), out of the hot search set. The shared
+    storage mode has no archive, there they stay in the hot tier. The newest
+    consolidated interaction is recorded in consolidation.json, so they
+    aren't consolidated again after a restart. LLM calls are limited to
+    `max_calls_per_minute`; a batch whose call fails stays in place and is
+    retried the next round.
+
+    The memory can be shared with the threads of the application: the batch
+    is read under its shared lock, and checked and written back as a single
+    change. A `lock` of the application is also held while the results are
+    written, if given.
+    """
+
+    def __init__(self, memory: Memory, client: Optional[OpenAI] = None, model_name: str = DEFAULT_MODEL_NAME,
+                 batch_size: int = DEFAULT_BATCH_SIZE, min_age: float = DEFAULT_MIN_AGE,
+                 keep_recent: int = DEFAULT_KEEP_RECENT, interval: float = DEFAULT_INTERVAL,
+                 max_calls_per_minute: float = DEFAULT_MAX_CALLS_PER_MINUTE, lock: Optional[threading.Lock] = None,
+                 segment_size: Optional[int] = None):
+        self.memory = memory
+        self.segment_size = segment_size or memory.segment_size
+        self.archiving = not isinstance(memory.storage, SharedJournalStorage)
+        self.client = client
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.min_age = min_age
+        self.keep_recent = keep_recent
+        self.interval = interval
+        self.min_call_interval = 60.0 / max_calls_per_minute
+        self.last_call: Optional[float] = None
+        self.lock = lock or threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        state = load_json_file(memory.location, STATE_FILE_NAME) or {}
+        self.consolidated_until: Optional[str] = state.get("consolidated_until")
+
+    def get_client(self) -> OpenAI:
+        if self.client is None:
+            self.client = OpenAI(http_client=get_shared_http_client(), timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES)
+        return self.client
+
+    def count_consolidated(self) -> int:
+        """Number of the oldest hot interactions already consolidated, e.g. waiting for a full segment."""
+        if self.consolidated_until is None:
+            return 0
+        count = 0
+        for interaction in self.memory.interactions:
+            if interaction["timestamp"] > self.consolidated_until:
+                break
+            count += 1
+        return count
+
+    def get_aged_batch(self) -> List[Dict[str, Any]]:
+        """The oldest interactions ready for consolidation, at most batch_size."""
+        with self.memory.lock.shared():
+            start = self.count_consolidated()
+            count = min(self.batch_size, len(self.memory.interactions) - self.keep_recent - start)
+            interactions = self.memory.interactions[start:start + count] if count > 0 else []
+        cutoff = (datetime.datetime.now() - datetime.timedelta(seconds=self.min_age)).isoformat()
+        batch = []
+        for interaction in interactions:
+            if interaction["timestamp"] > cutoff:
+                break
+            batch.append(interaction)
+        return batch
+
+    def wait_for_rate_limit(self) -> bool:
+        """Sleep until the next call is allowed, False if stopped meanwhile."""
+        if self.last_call is not None:
+            delay = self.last_call + self.min_call_interval - time.monotonic()
+            if delay > 0 and self.stop_event.wait(delay):
+                return False
+        self.last_call = time.monotonic()
+        return True
+
+    def extract_facts(self, interactions: List[Dict[str, Any]]) -> List[str]:
+        history = "\n\n".join(get_interaction_content(interaction, separator="\n") for interaction in interactions)
+        messages = [
+            {"role": "system", "content": consolidation_prompt},
+            {"role": "user", "content": history},
+        ]
+        response = self.get_client().chat.completions.create(model=self.model_name, messages=messages, temperature=0)
+        return parse_facts(response.choices[0].message.content)
+
+    def run_once(self) -> int:
+        """Consolidate one batch, returns the number of interactions consolidated."""
+        batch = self.get_aged_batch()
+        if not batch or not self.wait_for_rate_limit():
+            return 0
+
+        metrics = self.memory.metrics
+        try:
+            with metrics.timer("consolidation.llm_call"):
+                facts = self.extract_facts(batch)
+        except Exception as e:
+            metrics.increment("consolidation.errors")
+            logger.error("Error consolidating %d interactions: %s", len(batch), e)
+            return 0
+
+        with self.lock, self.memory.changing():
+            # The hot tier may have been archived meanwhile
+            start = self.count_consolidated()
+            if self.memory.interactions[start:start + len(batch)] != batch:
+                logger.warning("Interactions changed during consolidation, batch skipped")
+                return 0
+            if facts:
+                self.memory.add_facts(facts, "consolidated")
+            self.memory.write_file(self.save_state, batch[-1]["timestamp"])
+            # Only whole segments are sealed, the rest waits for the next batches
+            consolidated = start + len(batch)
+            if self.archiving and consolidated >= self.segment_size:
+                self.memory.archive_oldest_interactions(consolidated - consolidated % self.segment_size, self.segment_size)
+
+        metrics.increment("consolidation.interactions", len(batch))
+        metrics.increment("consolidation.facts", len(facts))
+        logger.info("Consolidated %d interactions into %d facts", len(batch), len(facts))
+        return len(batch)
+
+    def save_state(self, consolidated_until: str) -> None:
+        # Written after the facts, the batch counts as consolidated once both are on disk
+        save_to_json_file(self.memory.location, STATE_FILE_NAME, {"consolidated_until": consolidated_until})
+        self.consolidated_until = consolidated_until
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            try:
+                consolidated = self.run_once()
+            except Exception:
+                logger.exception("Consolidation round failed")
+                consolidated = 0
+            # Keep going while there is a backlog, otherwise wait for the next round
+            if not consolidated and self.stop_event.wait(self.interval):
+                break
+
+    def start(self) -> None:
+        if self.thread is None or not self.thread.is_alive():
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, name="memory-consolidator", daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
@@ -6,10 +6,12 @@ A simple chat interface for an AI agent that remembers everything.
 
 import os
 import sys
+import logging
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
 
 # Import our agent
 from agent import Agent
@@ -40,6 +42,7 @@ def main():
             user_input = input("👤 You: ")
             
             if user_input.lower() in ["exit", "quit", "bye"]:
+                agent.memory.flush()
                 print("👋 Goodbye! Your agent will remember everything you taught it.")
                 break
             
@@ -47,14 +50,20 @@ def main():
                 continue
             
             print("🤔 Thinking...")
-            response = agent.process_message(user_input)
+            response = ""
+            for chunk in agent.stream_message(user_input):
+                if not response:
+                    print("🤖 Assistant: ", end="", flush=True)
+                response += chunk
+                print(chunk, end="", flush=True)
             
             if response:
-                print(f"🤖 Assistant: {response}")
+                print()
             else:
                 print("❌ No response received.")
                 
         except KeyboardInterrupt:
+            agent.memory.flush()
             print("\n👋 Goodbye!")
             break
         except Exception as e:
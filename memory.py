@@ -1,25 +1,82 @@
 import json
+import logging
 import os
+import copy
+import asyncio
 import datetime
-from typing import List, Dict, Any, Optional
+import functools
+import hashlib
+import heapq
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional, Set, Union, Tuple
 from dotenv import load_dotenv
-from utils.json_file_utils import create_folder, load_json_file, save_to_json_file
-from utils.search import search_keywords
+from utils.json_file_utils import create_folder, get_file_path, load_json_file, save_to_json_file
+from utils.cache import LRUCache, DEFAULT_CACHE_SIZE
+from utils.context_builder import ContextSection, fit_context, render_context
+from utils.index import InvertedIndex
+from utils.interaction_store import InteractionStore
+from utils.metadata_index import MetadataIndex, matches_filters
+from utils.metrics import MetricsRegistry, get_registry
+from utils.query_engine import search_stores
+from utils.rw_lock import ReadWriteLock
+from utils.segments import SegmentArchive, DEFAULT_SEGMENT_SIZE
+from utils.short_term_memory import ShortTermMemory
+from utils.snapshot import SNAPSHOT_NAME, get_source_signature, read_snapshot, write_snapshot
+from utils.storage import JsonStorage, SharedJournalStorage, create_storage
+from utils.time_index import DEFAULT_SESSION_GAP, TimeBound, TimeIndex, split_sessions, to_bound_key, to_timestamp_key
+from utils.trigram_index import DEFAULT_FUZZY_THRESHOLD
 
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 def get_fact_content(fact: Dict[str, Any]) -> str:
     return fact["fact"]
 
+def get_fact_hash(fact: str) -> str:
+    # Facts differing only in case or whitespace are the same fact
+    normalized = " ".join(fact.casefold().split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
 def get_procedure_content(procedure: Dict[str, Any]) -> str:
     return f"{procedure.get('name', '')} {procedure.get('description', '')}"
 
 def get_interaction_content(interaction: Dict[str, Any], separator: str = "") -> str:
     return f"user: {interaction['user_message']} {separator}agent: {interaction['agent_message']}"
 
+def get_interaction_time(interaction: Dict[str, Any]) -> int:
+    # Interactions with an unreadable timestamp sort first
+    key = to_timestamp_key(interaction["timestamp"])
+    return -1 if key is None else key
+
+def reads(method):
+    """Run a Memory method under the shared lock, alongside other readers."""
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock.shared():
+            return method(self, *args, **kwargs)
+    return locked
+
+def writes(method):
+    """Run a Memory method as a change of the stores, see Memory.changing."""
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.changing():
+            return method(self, *args, **kwargs)
+    return locked
+
 DEFAULT_MEMORY_LOCATION = "./json_memory"
 
+CONTENT_FUNCTIONS = {
+    "facts": get_fact_content,
+    "procedures": get_procedure_content,
+    "interactions": get_interaction_content,
+}
+
 class Memory:
     # facts: list of facts, knowledge about the world, semantic memory
     # procedures: dict of procedures, smth can be done on autopilot, procedural memory
@@ -27,88 +84,816 @@ class Memory:
     # short_term_memory: fast access to latest information, working memory
     
     
-    def __init__(self, location: str = DEFAULT_MEMORY_LOCATION):
+    # storage: "json" rewrites each file on every change, "journal" appends
+    # changes to <name>.journal.jsonl and compacts them into <name>.json,
+    # "shared" is the journal mode for several processes using one location
+    # short_term_memory_half_life: seconds after which a short-term memory
+    # counts half as important, None disables decay
+    # context_cache_size: number of get_context sections kept, 0 disables the cache
+    # embedder: embedder for the "vector" search mode, see utils.vector_index
+    # metrics: registry for timings and counts, see utils.metrics
+    # hot_interactions: keep only about this many interactions in interactions.json
+    # and RAM, older ones are sealed into compressed segments of segment_size
+    # interactions in interactions.segments/, None keeps every interaction hot
+    # snapshot: load from memory.snapshot, a binary copy of the stores and their
+    # search indexes written by flush, while the JSON files haven't changed
+    # metadata_indexes: interaction metadata keys to index for the filters of
+    # search_interactions and search_recent_interactions
+    #
+    # A memory can be shared by the threads of a process: searches run at the
+    # same time, changes one at a time, see changing
+    def __init__(self, location: str = DEFAULT_MEMORY_LOCATION, storage: Union[str, JsonStorage] = "json",
+                 short_term_memory_size: int = 10, short_term_memory_half_life: Optional[float] = None,
+                 context_cache_size: int = DEFAULT_CACHE_SIZE, embedder=None,
+                 metrics: Optional[MetricsRegistry] = None,
+                 hot_interactions: Optional[int] = None, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 snapshot: bool = True, metadata_indexes: Iterable[str] = ()):
         self.location = location
         create_folder(location)
+        self.metrics = get_registry(metrics)
+        self.storage = create_storage(storage, location, self.metrics)
+        # Other processes change shared files behind the snapshot's back
+        self.snapshot = snapshot and not isinstance(self.storage, SharedJournalStorage)
+
+        self.metadata_keys = list(metadata_indexes)
+        self.hot_interactions = hot_interactions
+        self.segment_size = segment_size
+        self.archive: Optional[SegmentArchive] = None
+        if hot_interactions is not None or os.path.exists(get_file_path(location, "interactions.segments")):
+            self.open_archive()
+
+        # search mode per store, see utils.index.SEARCH_MODES, or "vector"
+        # for similarity search over embeddings
+        self.search_modes = {store: "keyword" for store in CONTENT_FUNCTIONS}
+        # Minimum similarity of a word to a query term in the "fuzzy" mode
+        self.fuzzy_threshold = DEFAULT_FUZZY_THRESHOLD
+        self.embedder = embedder
+
+        self.short_term_memory_size = short_term_memory_size
+        self.short_term_memory = ShortTermMemory(short_term_memory_size, half_life=short_term_memory_half_life)
+
+        # Every change to a store bumps its generation, which invalidates the
+        # cached get_context sections built from that store
+        self.generations = {store: 0 for store in [*CONTENT_FUNCTIONS, "short_term_memory"]}
+        self.context_cache = LRUCache(context_cache_size)
+
+        # Readers hold `lock` shared, a change holds it exclusive while it
+        # changes the stores; `write_lock` makes changes take turns, file
+        # writes included except journal appends
+        self.lock = ReadWriteLock()
+        self.write_lock = threading.RLock()
+        # File writes of the change in progress, None outside of a change
+        self.file_writes: Optional[List[Tuple[Callable[..., Any], Tuple[Any, ...]]]] = None
+        # Changes whose journal appends are being written outside write_lock
+        self.appends_done = threading.Condition()
+        self.running_appends = 0
+
+        # Single thread running the writes of the *_async methods in order
+        self.writer: Optional[ThreadPoolExecutor] = None
+
+        self.load_stores()
+
+    @contextmanager
+    def changing(self) -> Iterator[None]:
+        """
+        Change the stores. Changes take turns; readers wait while the stores
+        change but not while the files are written: writes queued with
+        write_file run once the lock is released, still before the next
+        change. A change that only appends records to journals writes them
+        after the next change may start, so the appends of several threads
+        reach the storage together, see utils.storage.GroupCommit. Nested
+        changes are part of the outermost one.
+
+        The queued writes run even if the change fails part way: what it
+        changed in RAM must reach the files.
+        """
+        appends = []
+        try:
+            with self.write_lock:
+                if self.file_writes is not None:
+                    yield
+                    return
+                self.file_writes = []
+                try:
+                    with self.lock.exclusive():
+                        yield
+                finally:
+                    file_writes, self.file_writes = self.file_writes, None
+                    appends = self.run_file_writes(file_writes)
+        finally:
+            if appends:
+                self.run_appends(appends)
+
+    def run_file_writes(self, file_writes: List[Tuple[Callable[..., Any], Tuple[Any, ...]]]) -> List[Tuple[Callable[..., Any], Tuple[Any, ...]]]:
+        """Run the writes of a change under write_lock, returns them instead if they are all appends."""
+        if not file_writes:
+            return []
+        self.compact_journals()
+        if all(self.storage.is_append(write) for write, _ in file_writes):
+            with self.appends_done:
+                self.running_appends += 1
+            return file_writes
+        self.wait_for_writes()
+        for write, args in file_writes:
+            write(*args)
+        return []
+
+    def run_appends(self, appends: List[Tuple[Callable[..., Any], Tuple[Any, ...]]]) -> None:
+        try:
+            # The stores may change meanwhile, journals are compacted under write_lock
+            for write, (file_name, _, *args) in appends:
+                write(file_name, None, *args)
+        finally:
+            with self.appends_done:
+                self.running_appends -= 1
+                self.appends_done.notify_all()
+        if any(self.storage.compaction_due(file_name) for _, (file_name, *_) in appends):
+            with self.write_lock:
+                self.compact_journals()
+
+    def compact_journals(self) -> None:
+        """Compact the journals the appends written outside write_lock filled up, under write_lock."""
+        due = [store for store in CONTENT_FUNCTIONS if self.storage.compaction_due(f"{store}.json")]
+        if not due:
+            return
+        self.wait_for_writes()
+        with self.lock.shared():
+            for store in due:
+                self.storage.compact(f"{store}.json", getattr(self, store))
+
+    def write_file(self, write: Callable[..., Any], *args: Any) -> None:
+        """
+        Call `write(*args)` once the current change is done, right away outside
+        of one. Either way the background writes queued before go first: the
+        copy of a file queued by add_interaction_async is older than what is
+        written now and must not land after it.
+        """
+        if self.file_writes is None:
+            self.wait_for_writes()
+            write(*args)
+        else:
+            self.file_writes.append((write, args))
+
+    @writes
+    def load_stores(self) -> None:
+        with self.metrics.timer("memory.load"):
+            if not self.load_snapshot():
+                self.load_json_files()
+            # Built from the distinct metadata of the interaction store, so
+            # it is cheap enough not to be saved
+            self.metadata_index = MetadataIndex(self.metadata_keys)
+            self.metadata_index.build(self.interactions.get_metadata_groups())
+            # Built on the first vector search of a store
+            self.vector_indexes = {}
+            for store in CONTENT_FUNCTIONS:
+                self.generations[store] += 1
+            # Entries added since the first load are newer than the file
+            if not self.short_term_memory:
+                self.load_short_term_memory()
+
+    def load_short_term_memory(self) -> None:
+        # Added in the order they were saved, so capacity and decay apply as before
+        for entry in self.storage.load("short_term_memory.json", []):
+            self.short_term_memory.add(entry)
+        self.short_term_memory.dirty = False
+        self.generations["short_term_memory"] += 1
+
+    def load_json_files(self) -> None:
+        self.facts = self.storage.load("facts.json", [])
+        self.procedures = self.storage.load("procedures.json", {})
+        # Held column by column, see utils.interaction_store
+        self.interactions = InteractionStore(self.storage.load("interactions.json", []))
+        if self.archive is not None:
+            self.drop_archived_interactions()
+        self.time_index = TimeIndex.from_interactions(self.interactions)
+
+        # Content hash of every fact -> position of its first occurrence
+        self.fact_ids = {}
+        for fact_id, fact in enumerate(self.facts):
+            self.fact_ids.setdefault(get_fact_hash(fact["fact"]), fact_id)
 
-        self.facts = load_json_file(location, "facts.json") or []
-        self.procedures = load_json_file(location, "procedures.json") or {}
-        self.interactions = load_json_file(location, "interactions.json") or []
+        # Procedures are indexed by their position in the procedures dict
+        self.procedure_names = list(self.procedures)
+        self.procedure_ids = {name: i for i, name in enumerate(self.procedure_names)}
 
-        self.short_term_memory = []
-        self.short_term_memory_size = 10
+        self.indexes = {store: self.load_index(store) for store in CONTENT_FUNCTIONS}
+
+    def load_snapshot(self) -> bool:
+        """Load the stores and indexes from memory.snapshot, False if it is missing or out of date."""
+        if not self.snapshot:
+            return False
+        with self.metrics.timer("memory.load_snapshot"):
+            payload = read_snapshot(get_file_path(self.location, SNAPSHOT_NAME), get_source_signature(self.location))
+        if payload is None:
+            return False
+
+        self.facts = payload["facts"]
+        self.procedures = payload["procedures"]
+        self.interactions = InteractionStore.from_columns(payload["interactions"])
+        self.fact_ids = payload["fact_ids"]
+        self.procedure_names = list(self.procedures)
+        self.procedure_ids = {name: i for i, name in enumerate(self.procedure_names)}
+        self.indexes = {store: InvertedIndex.from_state(fn, payload["indexes"][store]) for store, fn in CONTENT_FUNCTIONS.items()}
+        self.time_index = TimeIndex.from_state(payload["time_index"])
+        return True
+
+    @reads
+    def save_snapshot(self) -> None:
+        """Write memory.snapshot from the stores, which must match the JSON files."""
+        payload = {
+            "facts": self.facts,
+            "procedures": self.procedures,
+            "interactions": self.interactions.to_columns(),
+            "fact_ids": self.fact_ids,
+            "indexes": {store: index.to_state() for store, index in self.indexes.items()},
+            "time_index": self.time_index.to_state(),
+        }
+        with self.metrics.timer("memory.save_snapshot"):
+            write_snapshot(get_file_path(self.location, SNAPSHOT_NAME), get_source_signature(self.location), payload)
+
+    def export_json(self, folder: Optional[str] = None) -> None:
+        """
+        Write the stores as plain JSON files to `folder`, by default the memory
+        location itself, where pending journal records are folded in.
+        """
+        if folder is None or os.path.abspath(folder) == os.path.abspath(self.location):
+            self.compact()
+            return
+        create_folder(folder)
+        with self.lock.shared():
+            save_to_json_file(folder, "facts.json", self.facts)
+            save_to_json_file(folder, "procedures.json", self.procedures)
+            save_to_json_file(folder, "interactions.json", self.interactions)
+
+    def refresh(self) -> None:
+        """
+        Apply the changes other processes made to the memory files since they
+        were loaded. Only the "shared" storage mode has any.
+        """
+        # Nothing else writes the files of the other modes, so don't wait
+        # for a change of this process to finish
+        if not isinstance(self.storage, SharedJournalStorage):
+            return
+        # Readers are only held up when there is something to apply
+        with self.write_lock:
+            updates = {store: self.storage.read_updates(f"{store}.json") for store in CONTENT_FUNCTIONS}
+            if not any(records is None or records for records in updates.values()):
+                return
+            with self.changing():
+                if any(records is None for records in updates.values()):
+                    # Writes still queued would be missing from the reloaded files
+                    self.wait_for_writes()
+                    self.load_stores()
+                    return
+
+                for record in updates["facts"]:
+                    fact_hash = get_fact_hash(record["value"]["fact"])
+                    if fact_hash not in self.fact_ids:
+                        self.apply_fact(fact_hash, record["value"])
+                for record in updates["procedures"]:
+                    self.apply_procedure(record["value"])
+                for record in updates["interactions"]:
+                    self.apply_interaction(record["value"])
+
+    def get_store_items(self, store: str) -> List[Dict[str, Any]]:
+        if store == "procedures":
+            return [self.procedures[name] for name in self.procedure_names]
+        return getattr(self, store)
+
+    def get_store_item(self, store: str, doc_id: int) -> Dict[str, Any]:
+        if store == "procedures":
+            return self.procedures[self.procedure_names[doc_id]]
+        return getattr(self, store)[doc_id]
+
+    def get_index_signature(self, store: str) -> List[Any]:
+        # Used to detect an index file that is out of date with its store.
+        # Processes sharing a location can store the same items in another
+        # order, so the signature covers the order too
+        items = self.get_store_items(store)
+        timestamps = items.get_timestamps() if isinstance(items, InteractionStore) else (item["timestamp"] for item in items)
+        return [len(items), zlib.crc32("\n".join(timestamps).encode("utf-8"))]
+
+    def load_index(self, store: str) -> InvertedIndex:
+        fn = CONTENT_FUNCTIONS[store]
+        data = load_json_file(self.location, f"{store}.index.json")
+        if data and data.get("signature") == self.get_index_signature(store):
+            return InvertedIndex.from_dict(fn, data)
+
+        index = InvertedIndex(fn)
+        index.build(enumerate(self.get_store_items(store)))
+        return index
+
+    def get_vector_index(self, store: str):
+        index = self.vector_indexes.get(store)
+        if index is not None:
+            return index
+
+        # numpy is only needed once vector search is used
+        from utils.vector_index import VectorIndex, HashingEmbedder
+        self.embedder = self.embedder or HashingEmbedder()
+        fn = CONTENT_FUNCTIONS[store]
+        metadata = load_json_file(self.location, f"{store}.vectors.json")
+        path = get_file_path(self.location, f"{store}.vectors.npy")
+        if metadata and metadata.get("signature") == self.get_index_signature(store) and metadata.get("dimensions") == self.embedder.dimensions and os.path.exists(path):
+            index = VectorIndex.load(fn, self.embedder, path, metadata)
+        else:
+            index = VectorIndex(fn, self.embedder)
+            index.build(enumerate(self.get_store_items(store)))
+
+        self.vector_indexes[store] = index
+        return index
+
+    @reads
+    def save_indexes(self) -> None:
+        with self.metrics.timer("memory.save_indexes"):
+            for store, index in self.indexes.items():
+                save_to_json_file(self.location, f"{store}.index.json", index.to_dict(self.get_index_signature(store)))
+            for store, index in self.vector_indexes.items():
+                metadata = index.save(get_file_path(self.location, f"{store}.vectors.npy"), self.get_index_signature(store))
+                save_to_json_file(self.location, f"{store}.vectors.json", metadata)
+
+    def write_in_background(self, write, file_name: str, data: Union[List[Any], Dict[str, Any]], *args) -> Future:
+        if self.writer is None:
+            self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-writer")
+        if self.storage.is_append(write):
+            # Only the records are written, see compact_journals
+            data = None
+        else:
+            # The writer gets a shallow copy so changes made in the meantime
+            # can't show up half way through a dump
+            data = copy.copy(data)
+        return self.writer.submit(write, file_name, data, *args)
+
+    def wait_for_writes(self) -> None:
+        """Block until every background write and journal append scheduled so far is on disk."""
+        if self.writer is not None:
+            self.writer.submit(lambda: None).result()
+        with self.appends_done:
+            while self.running_appends:
+                self.appends_done.wait()
+
+    @writes
+    def flush(self) -> None:
+        """Persist the search indexes and short-term memory next to the JSON files."""
+        # Interactions added with add_interaction_async are archived here
+        self.archive_interactions()
+        self.write_file(self.save_indexes)
+        if self.snapshot:
+            self.write_file(self.save_snapshot)
+        if self.short_term_memory.dirty:
+            self.write_file(self.storage.save, "short_term_memory.json", self.short_term_memory.to_list())
+            self.short_term_memory.dirty = False
+
+    def close(self) -> None:
+        """Flush and stop the background writer, the memory can't be used afterwards."""
+        with self.write_lock:
+            self.flush()
+            if self.writer is not None:
+                self.writer.shutdown()
+                self.writer = None
+
+    @reads
+    def get_size(self) -> int:
+        # Number of stored items, a rough measure of the memory held in RAM
+        return len(self.facts) + len(self.procedures) + len(self.interactions)
 
     def add_memory(self, memory: Dict[str, Any]):
         self.memory.append(memory)
 
-    def add_fact(self, fact: str, type: str):
-        self.facts.append({
+    @writes
+    def add_fact(self, fact: str, type: str) -> int:
+        """Add a fact unless it is already known, returns the id of the fact."""
+        fact_hash = get_fact_hash(fact)
+        if fact_hash in self.fact_ids:
+            return self.fact_ids[fact_hash]
+
+        record = self.append_fact(fact_hash, fact, type)
+        self.write_file(self.storage.append, "facts.json", self.facts, record)
+        return self.fact_ids[fact_hash]
+
+    @writes
+    def add_facts(self, facts: List[str], type: str) -> List[int]:
+        """Add several facts with a single write, returns the id of every fact."""
+        records = []
+        fact_ids = []
+        for fact in facts:
+            fact_hash = get_fact_hash(fact)
+            if fact_hash not in self.fact_ids:
+                records.append(self.append_fact(fact_hash, fact, type))
+            fact_ids.append(self.fact_ids[fact_hash])
+
+        if records:
+            self.write_file(self.storage.extend, "facts.json", self.facts, records)
+        return fact_ids
+
+    def append_fact(self, fact_hash: str, fact: str, type: str) -> Dict[str, Any]:
+        record = {
             "fact": fact,
             "type": type,
             "timestamp": datetime.datetime.now().isoformat()
-        })
-        
-        save_to_json_file(self.location, "facts.json", self.facts)
+        }
+        self.apply_fact(fact_hash, record)
+        return record
+
+    def apply_fact(self, fact_hash: str, record: Dict[str, Any]) -> None:
+        self.facts.append(record)
+        self.fact_ids[fact_hash] = len(self.facts) - 1
+        self.indexes["facts"].add(len(self.facts) - 1, record)
+        if "facts" in self.vector_indexes:
+            self.vector_indexes["facts"].add(len(self.facts) - 1, record)
+        self.generations["facts"] += 1
 
+    @writes
+    def compact_facts(self) -> int:
+        """Drop duplicated facts, keeping the first occurrence. Returns the number removed."""
+        # The rewrite replaces the file, so it must include what other processes added
+        self.refresh()
+        unique_facts = [fact for fact_id, fact in enumerate(self.facts) if self.fact_ids[get_fact_hash(fact["fact"])] == fact_id]
+        removed = len(self.facts) - len(unique_facts)
+        if not removed:
+            return 0
+
+        self.facts = unique_facts
+        self.fact_ids = {get_fact_hash(fact["fact"]): fact_id for fact_id, fact in enumerate(self.facts)}
+        self.indexes["facts"] = InvertedIndex(get_fact_content)
+        self.indexes["facts"].build(enumerate(self.facts))
+        self.vector_indexes.pop("facts", None)
+        self.generations["facts"] += 1
+        self.write_file(self.storage.save, "facts.json", self.facts)
+        return removed
+
+    @writes
     def add_procedure(self, procedure: str, steps:List[str], description: str):
-        self.procedures[procedure] = {
+        record = {
             "description": description,
             "name": procedure,
             "steps": steps,
             "timestamp": datetime.datetime.now().isoformat()
         }
-        save_to_json_file(self.location, "procedures.json", self.procedures)
+        self.apply_procedure(record)
+        self.write_file(self.storage.set, "procedures.json", self.procedures, procedure, record)
+
+    def apply_procedure(self, record: Dict[str, Any]) -> None:
+        procedure = record["name"]
+        if procedure in self.procedure_ids:
+            doc_id = self.procedure_ids[procedure]
+            self.indexes["procedures"].remove(doc_id, self.procedures[procedure])
+        else:
+            doc_id = self.procedure_ids[procedure] = len(self.procedure_names)
+            self.procedure_names.append(procedure)
+        self.procedures[procedure] = record
+        self.indexes["procedures"].add(doc_id, record)
+        if "procedures" in self.vector_indexes:
+            self.vector_indexes["procedures"].add(doc_id, record)
+        self.generations["procedures"] += 1
         
+    @writes
     def add_interaction(self, user_message: str, agent_message: str, metadata: Dict[str, Any] = None) -> None:
-        self.interactions.append({
+        record = self.record_interaction(user_message, agent_message, metadata)
+        self.write_file(self.storage.append, "interactions.json", self.interactions, record)
+        self.archive_interactions()
+
+    @writes
+    def archive_interactions(self) -> int:
+        """
+        Seal the oldest interactions into archive segments once the hot tier
+        holds a full segment more than hot_interactions. Returns the number
+        of interactions archived.
+        """
+        if self.hot_interactions is None or len(self.interactions) < self.hot_interactions + self.segment_size:
+            return 0
+
+        segments = (len(self.interactions) - self.hot_interactions) // self.segment_size
+        archived = segments * self.segment_size
+        self.seal_oldest_interactions(archived, self.segment_size)
+        return archived
+
+    @writes
+    def archive_oldest_interactions(self, count: int, segment_size: Optional[int] = None) -> None:
+        """Move the `count` oldest interactions out of the hot tier into segments of `segment_size`, one segment by default."""
+        count = min(count, len(self.interactions))
+        if count:
+            self.seal_oldest_interactions(count, segment_size or count)
+
+    def open_archive(self) -> None:
+        if isinstance(self.storage, SharedJournalStorage):
+            raise ValueError("Archived interactions can't be used with the shared storage mode")
+        self.archive = SegmentArchive(get_file_path(self.location, "interactions.segments"), get_interaction_content, metadata_keys=self.metadata_keys)
+
+    def seal_oldest_interactions(self, count: int, segment_size: int) -> None:
+        if self.archive is None:
+            self.open_archive()
+        with self.metrics.timer("memory.archive_interactions"):
+            # Only the tiers are swapped here, the segments are written once
+            # the lock is released, before the hot file. Writes queued before
+            # still go first, so an append can't add an archived interaction
+            # again after the rewrite
+            for start in range(0, count, segment_size):
+                segment = self.archive.add(self.interactions[start:min(start + segment_size, count)])
+                self.write_file(self.archive.write, segment)
+            self.interactions = InteractionStore(self.interactions[count:])
+            self.write_file(self.storage.save, "interactions.json", self.interactions)
+            self.rebuild_interaction_indexes()
+
+    def drop_archived_interactions(self) -> None:
+        # Sealing writes the segment before the hot file, after a crash in
+        # between the hot file still starts with the archived interactions
+        if not self.archive.segments or not len(self.interactions):
+            return
+        last = self.archive.segments[-1]
+        if self.interactions[0]["timestamp"] > last["last_timestamp"]:
+            return
+        archived = self.archive.read(last)
+        if self.interactions[:len(archived)] == archived:
+            self.interactions = InteractionStore(self.interactions[len(archived):])
+            self.write_file(self.storage.save, "interactions.json", self.interactions)
+
+    def rebuild_interaction_indexes(self) -> None:
+        self.indexes["interactions"] = InvertedIndex(get_interaction_content)
+        self.indexes["interactions"].build(enumerate(self.interactions))
+        self.time_index = TimeIndex.from_interactions(self.interactions)
+        self.metadata_index = MetadataIndex(self.metadata_keys)
+        self.metadata_index.build(self.interactions.get_metadata_groups())
+        self.vector_indexes.pop("interactions", None)
+        self.generations["interactions"] += 1
+
+    def add_interaction_async(self, user_message: str, agent_message: str, metadata: Dict[str, Any] = None) -> asyncio.Future:
+        """
+        Add an interaction without waiting for the file write.
+
+        The interaction is searchable right away, the write runs on the
+        background writer thread. Must be called from a running event loop,
+        await the returned future to wait for the write.
+        """
+        return asyncio.wrap_future(self.add_interaction_in_background(user_message, agent_message, metadata))
+
+    def add_interaction_in_background(self, user_message: str, agent_message: str, metadata: Dict[str, Any] = None) -> Future:
+        """Same as add_interaction_async from any thread, returns the future of the file write."""
+        with self.write_lock:
+            with self.changing():
+                record = self.record_interaction(user_message, agent_message, metadata)
+            # Other changes still wait, so a copy of the store for a rewrite
+            # is consistent without holding off readers
+            return self.write_in_background(self.storage.append, "interactions.json", self.interactions, record)
+
+    def record_interaction(self, user_message: str, agent_message: str, metadata: Dict[str, Any] = None) -> Dict[str, Any]:
+        record = {
             "agent_message": agent_message,
             "user_message": user_message,
             "metadata": metadata,
             "timestamp": datetime.datetime.now().isoformat()
-        })
-        save_to_json_file(self.location, "interactions.json", self.interactions)
+        }
+        self.apply_interaction(record)
+        return record
+
+    def apply_interaction(self, record: Dict[str, Any]) -> None:
+        self.interactions.append(record)
+        self.indexes["interactions"].add(len(self.interactions) - 1, record)
+        self.time_index.add(to_timestamp_key(record["timestamp"]), len(self.interactions) - 1)
+        self.metadata_index.add(len(self.interactions) - 1, record.get("metadata"))
+        if "interactions" in self.vector_indexes:
+            self.vector_indexes["interactions"].add(len(self.interactions) - 1, record)
+        self.generations["interactions"] += 1
         
+    @writes
     def add_to_short_term_memory(self, memory: str, importance: float = 1.0) -> None:
-        self.short_term_memory.append({
+        record = {
             "content": memory,
             "importance": importance,
             "timestamp": datetime.datetime.now().isoformat()
-            })
-        save_to_json_file(self.location, "short_term_memory.json", self.short_term_memory)
+            }
+        # Saved on flush, the entries evicted in between never hit the disk
+        self.short_term_memory.add(record)
+        self.generations["short_term_memory"] += 1
+
+    def compact(self) -> None:
+        """Fold pending journal records into the JSON files."""
+        # The stores don't change, other changes wait but searches don't
+        with self.write_lock:
+            self.wait_for_writes()
+            with self.lock.shared():
+                self.storage.compact("facts.json", self.facts)
+                self.storage.compact("procedures.json", self.procedures)
+                self.storage.compact("interactions.json", self.interactions)
+            self.refresh()
+            self.flush()
     
-    def search_facts(self, query: str, limit: int = 3) -> List[Dict[str, Any]]:
+    @reads
+    def search_store(self, store: str, query: str, limit: int = 3, mode: Optional[str] = None, with_scores: bool = False,
+                     candidates: Optional[Set[int]] = None) -> List[Any]:
+        results = self.search_ids(store, query, limit=limit, mode=mode or self.search_modes[store], candidates=candidates)
+        if with_scores:
+            return [(self.get_store_item(store, doc_id), score) for doc_id, score in results]
+        return [self.get_store_item(store, doc_id) for doc_id, _ in results]
+
+    # candidates: only search these items, None for all of them
+    @reads
+    def search_ids(self, store: str, query: str, limit: int, mode: str, candidates: Optional[Set[int]] = None) -> List[Tuple[int, float]]:
+        with self.metrics.timer(f"memory.search.{store}"):
+            if mode == "vector":
+                return self.get_vector_index(store).search(query, limit=limit, candidates=candidates)
+            return self.indexes[store].search(query, limit=limit, mode=mode, candidates=candidates, threshold=self.fuzzy_threshold)
+
+    def search_facts(self, query: str, limit: int = 3, mode: Optional[str] = None, with_scores: bool = False) -> List[Any]:
         """Search facts using keyword matching."""
-        return search_keywords(query, self.facts, fn=get_fact_content, limit=limit)
+        return self.search_store("facts", query, limit=limit, mode=mode, with_scores=with_scores)
     
-    def search_procedures(self, query: str, limit: int = 3) -> List[Dict[str, Any]]:
-        return search_keywords(query, self.procedures.values(), fn=get_procedure_content, limit=limit)
+    def search_procedures(self, query: str, limit: int = 3, mode: Optional[str] = None, with_scores: bool = False) -> List[Any]:
+        return self.search_store("procedures", query, limit=limit, mode=mode, with_scores=with_scores)
     
-    def search_interactions(self, query: str, limit: int = 3) -> List[Dict[str, Any]]:
-        return search_keywords(query, self.interactions, fn=get_interaction_content, limit=limit)
-    
-    def search_recent_interactions(self, limit: int = 3) -> List[Dict[str, Any]]:
-        return self.interactions[-limit:]
+    @reads
+    def filter_interactions(self, filters: Optional[Dict[str, Any]]) -> Optional[Set[int]]:
+        """
+        Positions of the hot interactions whose metadata passes `filters`,
+        None if there are no filters. Filters on keys in metadata_indexes
+        are answered by the index, the others by checking the candidates
+        left, see utils.metadata_index.MetadataIndex.select for the syntax.
+        """
+        if not filters:
+            return None
+        with self.metrics.timer("memory.filter_interactions"):
+            positions, remaining = self.metadata_index.select(filters)
+            if remaining:
+                candidates = range(len(self.interactions)) if positions is None else positions
+                positions = {i for i in candidates if matches_filters(self.interactions.get_metadata(i), remaining)}
+        return positions
+
+    @reads
+    def search_interactions(self, query: str, limit: int = 3, mode: Optional[str] = None, with_scores: bool = False,
+                            filters: Optional[Dict[str, Any]] = None) -> List[Any]:
+        """Search interactions, only those whose metadata passes `filters` if given, see filter_interactions."""
+        candidates = self.filter_interactions(filters)
+        if self.archive is None or not self.archive.segments:
+            return self.search_store("interactions", query, limit=limit, mode=mode, with_scores=with_scores, candidates=candidates)
+
+        # Archived segments are searched too, results are merged by score and
+        # then by position in the full history
+        mode = mode or self.search_modes["interactions"]
+        offset = len(self.archive)
+        results = [(offset + doc_id, self.interactions[doc_id], score) for doc_id, score in self.search_ids("interactions", query, limit, mode, candidates)]
+        with self.metrics.timer("memory.search.archive"):
+            results += self.archive.search(query, limit=limit, mode=mode, embedder=self.embedder, filters=filters, threshold=self.fuzzy_threshold)
+        results = heapq.nsmallest(limit, results, key=lambda x: (-x[2], x[0]))
+        if with_scores:
+            return [(interaction, score) for _, interaction, score in results]
+        return [interaction for _, interaction, _ in results]
+
+    @reads
+    def search_all(self, query: str, limit: int = 3, mode: str = "keyword", stores: Optional[List[str]] = None,
+                   with_scores: bool = False) -> List[Tuple[Any, ...]]:
+        """
+        The `limit` best items of several stores (all by default) for one
+        query, as (store, item) or (store, item, score) pairs. The best score
+        found so far lets the stores searched next skip the items that can't
+        beat it. All stores are searched in the same mode so scores compare;
+        BM25 statistics are those of each store.
+        """
+        stores = stores or list(CONTENT_FUNCTIONS)
+        archived = self.archive is not None and self.archive.segments and "interactions" in stores
+        offset = len(self.archive) if archived else 0
+        archived_records: Dict[int, Dict[str, Any]] = {}
+
+        def search(store: str, minimum: Optional[float]) -> List[Tuple[int, float]]:
+            if store == "archive":
+                results = self.archive.search(query, limit=limit, mode=mode, embedder=self.embedder, threshold=self.fuzzy_threshold)
+                archived_records.update((position, record) for position, record, _ in results)
+                return [(position, score) for position, _, score in results]
+            if mode == "vector":
+                results = self.search_ids(store, query, limit, mode)
+            else:
+                with self.metrics.timer(f"memory.search.{store}"):
+                    results = self.indexes[store].search(query, limit=limit, mode=mode, threshold=self.fuzzy_threshold, minimum=minimum)
+            # Hot interactions come after the archived ones in the full history
+            return [(doc_id + offset, score) for doc_id, score in results] if store == "interactions" else results
+
+        with self.metrics.timer("memory.search_all"):
+            if archived:
+                # Archived interactions come first in the full history
+                stores = [name for store in stores for name in (["archive", store] if store == "interactions" else [store])]
+            results = search_stores(stores, search, limit)
+
+        found = []
+        for store, doc_id, score in results:
+            if store == "archive":
+                store, item = "interactions", archived_records[doc_id]
+            elif store == "interactions":
+                item = self.interactions[doc_id - offset]
+            else:
+                item = self.get_store_item(store, doc_id)
+            found.append((store, item, score) if with_scores else (store, item))
+        return found
+
+    @reads
+    def search_recent_interactions(self, limit: int = 3, filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        if filters:
+            # Only the interactions passing the filters are sorted by time
+            newest = heapq.nlargest(limit, self.filter_interactions(filters), key=lambda i: (self.interactions.timestamps[i], i))
+            interactions = [self.interactions[i] for i in reversed(newest)]
+            if self.archive is not None and len(interactions) < limit:
+                archived = self.archive.recent(limit - len(interactions), filters=filters)
+                interactions = archived + interactions
+            return interactions
+        if self.archive is not None and limit > len(self.interactions):
+            return self.archive.recent(limit - len(self.interactions)) + self.interactions[:]
+        if len(self.time_index) < len(self.interactions):
+            # Some timestamps can't be read, the order of the file is all there is
+            return self.interactions[-limit:] if limit > 0 else []
+        return [self.interactions[i] for i in self.time_index.latest(limit)]
+
+    @reads
+    def get_interactions_between(self, start: TimeBound = None, end: TimeBound = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Interactions with start <= timestamp < end in time order, the `limit`
+        newest if given. Bounds are ISO timestamps or datetimes, None leaves
+        that side of the window open.
+        """
+        start_key, end_key = to_bound_key(start), to_bound_key(end)
+        with self.metrics.timer("memory.time_window"):
+            interactions = [self.interactions[i] for i in self.time_index.between(start_key, end_key, limit)]
+            if self.archive is not None and self.archive.segments:
+                archived = self.archive.between(start_key, end_key)
+                interactions = list(heapq.merge(archived, interactions, key=get_interaction_time))
+                if limit is not None:
+                    interactions = interactions[max(len(interactions) - limit, 0):]
+        return interactions
+
+    @reads
+    def get_sessions(self, start: TimeBound = None, end: TimeBound = None, gap: float = DEFAULT_SESSION_GAP) -> List[List[Dict[str, Any]]]:
+        """Interactions between start and end split into sessions, wherever they are more than `gap` seconds apart."""
+        return split_sessions(self.get_interactions_between(start, end), gap)
+
+    @reads
+    def get_last_session(self, gap: float = DEFAULT_SESSION_GAP) -> List[Dict[str, Any]]:
+        """The newest interactions up to the last pause longer than `gap` seconds."""
+        start = self.time_index.get_session_start(gap)
+        interactions = [self.interactions[i] for i in self.time_index.positions[start:]]
+        if start == 0 and self.archive is not None:
+            # The session may have started before the oldest hot interaction
+            for segment in reversed(self.archive.segments):
+                sessions = split_sessions(sorted(self.archive.read(segment) + interactions, key=get_interaction_time), gap)
+                interactions = sessions[-1]
+                if len(sessions) > 1:
+                    break
+        return interactions
     
-    def sort_short_term_memory(self) -> None:
-        return sorted(self.short_term_memory, key=lambda x: (x["importance"], x["timestamp"]), reverse=True)
+    @reads
+    def sort_short_term_memory(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return self.short_term_memory.top(limit)
         
     # Generate a context string for the LLM using relevant memory.
-    def get_context(self, query: str, limit: int = 3) -> str:
+    def get_context_section(self, store: str, key: tuple, build) -> List[Tuple[str, float]]:
+        return self.context_cache.get_or_compute((store, self.generations[store], *key), build)
+
+    # Section builders return (text, relevance score) for every item
+    def build_recent_interactions_context(self, limit: int) -> List[Tuple[str, float]]:
         recent_interactions = self.search_recent_interactions(limit=limit)
-        recent_interactions_context = "\n".join([get_interaction_content(interaction, separator="\n") for interaction in recent_interactions])
-        facts = self.search_facts(query, limit=limit)
-        facts_context = "\n".join([f"Fact: {fact['fact']}" for fact in facts])
-        procedures = self.search_procedures(query, limit=limit)
-        procedures_context = "\n".join([f"Procedure {i+1}. {procedure['name']}: {procedure['description']} {chr(10)}Procedure's Steps: {chr(10).join(procedure['steps'])}" for i, procedure in enumerate(procedures)])
-
-        print(f"Recent interactions: {recent_interactions_context}")
-        print(f"Facts: {facts_context}")
-        print(f"Proceduresss: {procedures}")
-        print(f"Procedures: {procedures_context}")
-        
+        # Newer interactions are more relevant
+        return [(get_interaction_content(interaction, separator="\n"), i) for i, interaction in enumerate(recent_interactions, 1)]
+
+    def build_facts_context(self, query: str, limit: int) -> List[Tuple[str, float]]:
+        facts = self.search_facts(query, limit=limit, with_scores=True)
+        return [(f"Fact: {fact['fact']}", score) for fact, score in facts]
+
+    def build_procedures_context(self, query: str, limit: int) -> List[Tuple[str, float]]:
+        procedures = self.search_procedures(query, limit=limit, with_scores=True)
+        return [(f"Procedure {i+1}. {procedure['name']}: {procedure['description']} {chr(10)}Procedure's Steps: {chr(10).join(procedure['steps'])}", score) for i, (procedure, score) in enumerate(procedures)]
+
+    def build_short_term_memory_context(self) -> List[Tuple[str, float]]:
         short_term_memory = self.sort_short_term_memory()
-        short_term_memory_context = "\n".join([f"Short term memory: {memory['content']}" for memory in short_term_memory])
+        return [(f"Short term memory: {memory['content']}", self.short_term_memory.decayed_importance(memory)) for memory in short_term_memory]
+
+    # Sections are cached per (query, limit, store generation), so only the
+    # sections of stores that changed since the last call are rebuilt.
+    def get_context_sections(self, query: str, limit: int = 3) -> List[ContextSection]:
+        # Searches lowercase and split the query, so this does not change results
+        query = " ".join(query.lower().split())
 
-        return f"Recent interactions: {recent_interactions_context}\nFacts: {facts_context}\nProcedures: {procedures_context}\nRecent memory with current context sorted by importance and timestamp: {short_term_memory_context}".strip()
+        return [
+            ContextSection("interactions", "Recent interactions", self.get_context_section("interactions", ("recent", limit), lambda: self.build_recent_interactions_context(limit))),
+            ContextSection("facts", "Facts", self.get_context_section("facts", (query, limit, self.search_modes["facts"], self.fuzzy_threshold), lambda: self.build_facts_context(query, limit))),
+            ContextSection("procedures", "Procedures", self.get_context_section("procedures", (query, limit, self.search_modes["procedures"], self.fuzzy_threshold), lambda: self.build_procedures_context(query, limit))),
+            ContextSection("short_term_memory", "Recent memory with current context sorted by importance and timestamp", self.get_context_section("short_term_memory", (), self.build_short_term_memory_context)),
+        ]
 
+    @reads
+    def build_context(self, query: str, limit: int = 3, token_budget: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+        """
+        Build the context and report what was cut to fit it in `token_budget`
+        estimated tokens, see utils.context_builder.fit_context.
+        """
+        with self.metrics.timer("memory.build_context"):
+            sections = self.get_context_sections(query, limit=limit)
+            if token_budget is None:
+                report = {"token_budget": None, "estimated_tokens": None, "dropped": [], "truncated": []}
+            else:
+                sections, report = fit_context(sections, token_budget)
+            context = render_context(sections)
 
+        for section in sections:
+            self.metrics.observe(f"memory.context_items.{section.name}", len(section.items))
+        logger.debug("Context for %r:\n%s", query, context)
+        return context, report
+
+    # Generate a context string for the LLM using relevant memory.
+    def get_context(self, query: str, limit: int = 3, token_budget: Optional[int] = None) -> str:
+        return self.build_context(query, limit=limit, token_budget=token_budget)[0]
@@ -0,0 +1,187 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import quote
+from memory import Memory
+from utils.json_file_utils import create_folder
+
+DEFAULT_POOL_LOCATION = "./json_memory/tenants"
+DEFAULT_MAX_RESIDENT = 64
+
+def get_tenant_folder(tenant_id: str) -> str:
+    # Tenant ids come from users, keep them from escaping the pool directory
+    folder = quote(str(tenant_id), safe="")
+    if folder in ("", ".", ".."):
+        raise ValueError(f"Invalid tenant id: {tenant_id!r}")
+    return folder
+
+
+class MemoryPool:
+    """
+    One Memory per tenant, each in its own directory under `location`.
+
+    A tenant's memory is loaded on first access and kept resident until the
+    pool holds more than `max_resident` memories, or more than `max_items`
+    stored items in total; the least recently used tenants are then flushed
+    and dropped from RAM. Take the memory from the pool for every request
+    instead of holding on to it, an evicted memory must not be written to.
+
+    The pool lock only guards the bookkeeping: memories are loaded, flushed
+    and measured outside of it, so a tenant's cold load, eviction or long
+    change doesn't hold up the requests of the others. Items are counted as
+    of each tenant's last request, and kept as a running total. Concurrent requests for a tenant being
+    loaded wait for that one load, and a tenant being flushed is reloaded
+    once its files are written.
+    """
+
+    # memory_options: keyword arguments of every Memory, e.g. storage="journal"
+    def __init__(self, location: str = DEFAULT_POOL_LOCATION, max_resident: int = DEFAULT_MAX_RESIDENT,
+                 max_items: Optional[int] = None, **memory_options: Any):
+        self.location = location
+        create_folder(location)
+        self.max_resident = max_resident
+        self.max_items = max_items
+        self.memory_options = memory_options
+        self.memories: "OrderedDict[str, Memory]" = OrderedDict()
+        self.lock = threading.RLock()
+        # Tenants being loaded and being flushed, outside of the lock
+        self.loading: Dict[str, Future] = {}
+        self.closing: Dict[str, Future] = {}
+        # Stored items of every resident tenant as of its last request, and their total
+        self.sizes: Dict[str, int] = {}
+        self.resident_items = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.memories)
+
+    def __contains__(self, tenant_id: str) -> bool:
+        return tenant_id in self.memories
+
+    def get_location(self, tenant_id: str) -> str:
+        return os.path.join(self.location, get_tenant_folder(tenant_id))
+
+    def get(self, tenant_id: str) -> Memory:
+        """Return the memory of a tenant, loading it if it isn't resident."""
+        with self.lock:
+            memory = self.memories.get(tenant_id)
+            loading = self.loading.get(tenant_id)
+            if memory is not None:
+                self.hits += 1
+                self.memories.move_to_end(tenant_id)
+            elif loading is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                future = self.loading[tenant_id] = Future()
+                closing = self.closing.get(tenant_id)
+        if memory is not None:
+            # Written to since its last request
+            size = memory.get_size()
+            with self.lock:
+                if self.memories.get(tenant_id) is memory:
+                    self.set_size(tenant_id, size)
+                evicted = self.take_evicted(keep=tenant_id)
+            self.close_evicted(evicted)
+            return memory
+        if loading is not None:
+            return loading.result()
+
+        try:
+            if closing is not None:
+                closing.result()
+            memory = Memory(self.get_location(tenant_id), **self.memory_options)
+            size = memory.get_size()
+        except BaseException as e:
+            with self.lock:
+                del self.loading[tenant_id]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[tenant_id]
+            self.memories[tenant_id] = memory
+            self.set_size(tenant_id, size)
+            evicted = self.take_evicted(keep=tenant_id)
+        future.set_result(memory)
+        self.close_evicted(evicted)
+        return memory
+
+    def evict(self, keep: Optional[str] = None) -> List[str]:
+        """Evict least recently used tenants until the pool is within its limits, never `keep`."""
+        with self.lock:
+            evicted = self.take_evicted(keep)
+        self.close_evicted(evicted)
+        return [tenant_id for tenant_id, _, _ in evicted]
+
+    def take_evicted(self, keep: Optional[str] = None) -> List[Tuple[str, Memory, Future]]:
+        """Drop the least recently used tenants beyond the limits, to be closed with close_evicted outside the lock."""
+        evicted = []
+        while self.memories and self.over_limit():
+            tenant_id = next(iter(self.memories))
+            if tenant_id == keep:
+                break
+            evicted.append(self.take(tenant_id))
+        return evicted
+
+    def take(self, tenant_id: str) -> Tuple[str, Memory, Future]:
+        memory = self.memories.pop(tenant_id)
+        self.resident_items -= self.sizes.pop(tenant_id, 0)
+        future = self.closing[tenant_id] = Future()
+        self.evictions += 1
+        return tenant_id, memory, future
+
+    def close_evicted(self, evicted: List[Tuple[str, Memory, Future]]) -> None:
+        for tenant_id, memory, future in evicted:
+            try:
+                memory.close()
+            finally:
+                with self.lock:
+                    if self.closing.get(tenant_id) is future:
+                        del self.closing[tenant_id]
+                future.set_result(None)
+
+    def over_limit(self) -> bool:
+        if len(self.memories) > self.max_resident:
+            return True
+        return self.max_items is not None and self.resident_items > self.max_items
+
+    def set_size(self, tenant_id: str, size: int) -> None:
+        self.resident_items += size - self.sizes.get(tenant_id, 0)
+        self.sizes[tenant_id] = size
+
+    def release(self, tenant_id: str) -> None:
+        """Flush a tenant's memory and drop it from RAM."""
+        with self.lock:
+            if tenant_id not in self.memories:
+                return
+            evicted = [self.take(tenant_id)]
+        self.close_evicted(evicted)
+
+    def flush(self) -> None:
+        with self.lock:
+            memories = list(self.memories.values())
+        for memory in memories:
+            memory.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            evicted = [self.take(tenant_id) for tenant_id in list(self.memories)]
+        self.close_evicted(evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "resident": len(self.memories),
+                "resident_items": self.resident_items,
+                "evictions": self.evictions,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "max_resident": self.max_resident,
+                "max_items": self.max_items,
+            }
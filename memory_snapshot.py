@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Build or export the binary snapshot of a memory location.
+
+    python memory_snapshot.py import ./json_memory
+    python memory_snapshot.py export ./json_memory --output ./json_export
+
+`import` loads the JSON files, rebuilding the search indexes, and writes
+memory.snapshot next to them so the next start skips both. `export` writes
+the stores as plain JSON, loading from the snapshot when it is up to date.
+The JSON files stay the source of truth: a snapshot that no longer matches
+them is ignored and rewritten on the next flush.
+"""
+import argparse
+import logging
+import os
+import sys
+from typing import List, Optional
+
+from memory import Memory
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Build or export the binary snapshot of a memory location")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="build memory.snapshot from the JSON files")
+    import_parser.add_argument("location", help="memory folder")
+    export_parser = subparsers.add_parser("export", help="write the stores as plain JSON files")
+    export_parser.add_argument("location", help="memory folder")
+    export_parser.add_argument("--output", help="folder to write to, the memory folder itself by default")
+    parser.add_argument("--storage", default="json", help="storage mode of the memory")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.location):
+        parser.error(f"no memory folder at {args.location}")
+
+    if args.command == "import":
+        memory = Memory(args.location, storage=args.storage, snapshot=False)
+        memory.flush()
+        memory.save_snapshot()
+    else:
+        memory = Memory(args.location, storage=args.storage)
+        memory.export_json(args.output)
+    memory.close()
+    print(f"{args.command}: {len(memory.facts)} facts, {len(memory.procedures)} procedures, "
+          f"{len(memory.interactions)} interactions", file=sys.stderr)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
+    main()
@@ -0,0 +1,9 @@
+consolidation_prompt = """
+You consolidate the conversation history of an assistant into long-term memory.
+
+Read the interactions below and extract the facts worth remembering about the user, their preferences, their projects and the world, for example "The user's name is John" or "The user prefers Python over Java".
+
+Only extract facts that are stated or clearly implied, that stay true after the conversation is over and that are useful in future conversations. Skip greetings, small talk, questions without answers and anything about the assistant itself.
+
+Write every fact as a short, self-contained sentence. Answer with a JSON list of strings and nothing else, or [] if there is nothing worth remembering.
+"""
@@ -1,9 +1,19 @@
+import os
+import logging
 import streamlit as st
 from agent import Agent
+from memory import Memory
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
+
+@st.cache_resource
+def get_shared_memory() -> Memory:
+    # Loaded once per server process and shared by every browser session,
+    # Memory lets their searches run at once and their changes take turns
+    return Memory()
 
 # Page config
 st.set_page_config(page_title="MemAgent Simple Chat", page_icon="🧠")
@@ -41,21 +51,26 @@ if st.session_state.agent:
     st.code("Remember that the user's favorite color is blue")
     st.code("Remember the procedure making tea: boil water, add tea bag, wait 3 minutes")
     
-    # Show recent memory
-    if memory.facts:
+    # Show recent memory, copied while other sessions can't change it
+    with memory.lock.shared():
+        recent_facts = memory.facts[-3:]
+        procedures = list(memory.procedures.items())
+
+    if recent_facts:
         st.markdown("**Recent Facts:**")
-        for fact in memory.facts[-3:]:
+        for fact in recent_facts:
             st.write(f"• {fact['fact']}")
     
-    if memory.procedures:
+    if procedures:
         st.markdown("**Stored Procedures:**")
-        for name, proc in memory.procedures.items():
+        for name, proc in procedures:
             st.write(f"• **{name}**: {proc['description']}")
 
 # Initialize agent
 if st.button("🚀 Initialize Agent"):
     try:
-        st.session_state.agent = Agent()
+        # Sessions only keep their own agent on top of the shared memory
+        st.session_state.agent = Agent(memory=get_shared_memory())
         st.success("Agent ready! Start chatting below.")
     except Exception as e:
         st.error(f"Error: {e}")
@@ -76,16 +91,14 @@ if prompt := st.chat_input("Type your message..."):
     # Get response
     if st.session_state.agent:
         with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                try:
-                    response = st.session_state.agent.process_message(prompt)
-                    if response:
-                        st.write(response)
-                        st.session_state.messages.append({"role": "assistant", "content": response})
-                    else:
-                        st.error("No response received.")
-                except Exception as e:
-                    st.error(f"Error: {e}")
+            try:
+                response = st.write_stream(st.session_state.agent.stream_message(prompt))
+                if response:
+                    st.session_state.messages.append({"role": "assistant", "content": response})
+                else:
+                    st.error("No response received.")
+            except Exception as e:
+                st.error(f"Error: {e}")
     else:
         with st.chat_message("assistant"):
             st.error("Please initialize the agent first!")
@@ -1,10 +1,16 @@
 import sys
 import os
+import json
+import time
+import asyncio
 import shutil
-from unittest.mock import patch, MagicMock
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch, MagicMock, AsyncMock
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from agent import Agent
+from utils.metrics import MetricsRegistry
 from prompts.facts import init_assistant_facts
 
 def test_learn_fact():
@@ -134,6 +140,38 @@ def test_extract_and_learn_output():
     # Clean up
     shutil.rmtree(test_dir)
 
+def test_command_router():
+    # Create a test directory
+    test_dir = "test_command_router"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    agent = Agent(memory_location=test_dir)
+
+    # The longest key command wins, whatever the case and the order in config/commands.py
+    assert agent.commands.match("Remember this fact: the sky is blue") == ("learn_fact", "remember this fact", "the sky is blue")
+    assert agent.extract_and_learn("Please REMEMBER THIS DETAIL: tea is hot") == "learned fact"
+    assert agent.memory.facts[-1]["fact"] == "tea is hot"
+    assert agent.extract_and_learn("Remember the steps for tea: boil water, steep") == "learned procedure"
+    assert agent.memory.procedures["tea"]["steps"] == ["1. boil water", "2. steep"]
+
+    # Whole words only
+    assert agent.commands.match("I remember thatcher") is None
+
+    # New commands are registered with a handler
+    forgotten = []
+    def forget(match):
+        forgotten.append(match.payload)
+        return "forgot"
+    agent.register_command("forget", ["forget that", "forget this"], forget)
+    assert agent.extract_and_learn("forget that I like tea") == "forgot"
+    assert forgotten == ["I like tea"]
+    assert agent.extract_and_learn("What is the weather?") == "no key command found"
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
 def test_process_message_orchestration():
     # Create a test directory
     test_dir = "test_process_message_orchestration"
@@ -196,11 +234,305 @@ def test_process_message_no_interaction_on_api_failure():
     # Clean up
     shutil.rmtree(test_dir)
 
+def test_restart_does_not_duplicate_initial_facts():
+    # Create a test directory
+    test_dir = "test_agent_restart"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Start the agent twice on the same memory
+    Agent(memory_location=test_dir)
+    agent = Agent(memory_location=test_dir)
+
+    # The initial facts are only stored once
+    assert len(agent.memory.facts) == len(init_assistant_facts)
+    assert [fact["fact"] for fact in agent.memory.facts] == init_assistant_facts
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+class ChatCompletionHandler(BaseHTTPRequestHandler):
+    # Local stand-in for the chat completions endpoint, keeping connections alive
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.connections.add(self.client_address)
+        body = json.dumps({
+            "id": "chatcmpl-test",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-4.1-nano",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "Hello from the stand-in"}, "finish_reason": "stop"}],
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def test_openai_client_reuses_connections():
+    # Create a test directory
+    test_dir = "test_agent_client_pool"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ChatCompletionHandler)
+    server.connections = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    environment = {"OPENAI_API_KEY": "test", "OPENAI_BASE_URL": f"http://127.0.0.1:{server.server_port}/v1"}
+
+    try:
+        with patch.dict(os.environ, environment):
+            agent = Agent(memory_location=test_dir)
+            other_agent = Agent(memory_location=test_dir)
+
+            for message in ["Hello", "How are you?", "Bye"]:
+                assert agent.process_message(message) == "Hello from the stand-in"
+            assert other_agent.process_message("Hello") == "Hello from the stand-in"
+
+        # One client per agent, all requests went through a single connection
+        assert agent.get_client() is agent.client
+        assert len(server.connections) == 1
+        assert len(agent.memory.interactions) == 3
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_process_message_async_concurrency():
+    # Create a test directory
+    test_dir = "test_process_message_async"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Initialize agent with test memory location
+    agent = Agent(memory_location=test_dir)
+
+    async def create(**kwargs):
+        # Simulate a slow model
+        await asyncio.sleep(0.2)
+        response = MagicMock()
+        response.choices[0].message.content = f"Answer to {kwargs['messages'][-1]['content']}"
+        return response
+
+    async def run_conversations():
+        started = time.perf_counter()
+        responses = await asyncio.gather(*[agent.process_message_async(f"Question {i}") for i in range(20)])
+        elapsed = time.perf_counter() - started
+        await agent.wait_for_writes()
+        return responses, elapsed
+
+    with patch('agent.AsyncOpenAI') as mock_async_openai:
+        mock_client = MagicMock()
+        mock_client.chat.completions.create = AsyncMock(side_effect=create)
+        mock_async_openai.return_value = mock_client
+
+        responses, elapsed = asyncio.run(run_conversations())
+
+    # The calls overlapped instead of running one after the other
+    assert responses == [f"Answer to Question {i}" for i in range(20)]
+    assert elapsed < 2
+    assert mock_async_openai.call_count == 1
+
+    # Every interaction is in memory and on disk
+    assert len(agent.memory.interactions) == 20
+    with open(os.path.join(test_dir, "interactions.json")) as f:
+        assert len(json.load(f)) == 20
+    assert not agent.pending_writes
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_process_message_async_no_interaction_on_api_failure():
+    # Create a test directory
+    test_dir = "test_process_message_async_failure"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Initialize agent with test memory location
+    agent = Agent(memory_location=test_dir)
+
+    with patch('agent.AsyncOpenAI') as mock_async_openai:
+        mock_client = MagicMock()
+        mock_client.chat.completions.create = AsyncMock(side_effect=Exception("API Error"))
+        mock_async_openai.return_value = mock_client
+
+        response = asyncio.run(agent.process_message_async("What's the weather?"))
+
+    assert response is None
+    assert len(agent.memory.interactions) == 0
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_stream_message():
+    # Create a test directory
+    test_dir = "test_stream_message"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Initialize agent with test memory location
+    agent = Agent(memory_location=test_dir)
+
+    def make_chunk(content):
+        chunk = MagicMock()
+        chunk.choices[0].delta.content = content
+        return chunk
+
+    with patch('agent.OpenAI') as mock_openai:
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value = iter([make_chunk("Hello"), make_chunk(None), make_chunk(", world")])
+        mock_openai.return_value = mock_client
+
+        stream = agent.stream_message("Hi!")
+        assert next(stream) == "Hello"
+        # Nothing is stored before the stream ends
+        assert len(agent.memory.interactions) == 0
+        assert list(stream) == [", world"]
+
+    assert mock_client.chat.completions.create.call_args.kwargs["stream"] is True
+    assert len(agent.memory.interactions) == 1
+    assert agent.memory.interactions[0]["agent_message"] == "Hello, world"
+
+    # A failing call yields nothing and stores nothing
+    with patch('agent.OpenAI') as mock_openai:
+        agent.client = None
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.side_effect = Exception("API Error")
+        mock_openai.return_value = mock_client
+
+        assert list(agent.stream_message("Hi again!")) == []
+    assert len(agent.memory.interactions) == 1
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_process_message_metrics():
+    # Create a test directory
+    test_dir = "test_process_message_metrics"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Hooks see every value as it is recorded
+    metrics = MetricsRegistry()
+    events = []
+    metrics.add_hook(lambda kind, name, value: events.append((kind, name)))
+    agent = Agent(memory_location=test_dir, metrics=metrics)
+    metrics.reset()
+
+    mock_response = MagicMock()
+    mock_response.choices[0].message.content = "Test response"
+    with patch('agent.OpenAI') as mock_openai:
+        mock_openai.return_value.chat.completions.create.return_value = mock_response
+        agent.process_message("Remember that the user's name is John")
+
+    # Every phase of the message is timed
+    phases = ["refresh", "extract_and_learn", "build_context", "llm_call", "save_interaction"]
+    assert list(agent.last_timings) == phases
+    snapshot = metrics.snapshot()
+    for phase in phases:
+        assert snapshot["summaries"][f"agent.{phase}"]["count"] == 1
+    assert ("timer", "agent.llm_call") in events
+    assert snapshot["counters"]["agent.messages"] == 1
+    assert snapshot["counters"]["storage.bytes_written"] > 0
+    assert snapshot["summaries"]["agent.prompt_tokens"]["total"] > 0
+    assert snapshot["summaries"]["memory.context_items.facts"]["max"] >= 1
+    assert "memagent_agent_llm_call_count 1" in metrics.to_prometheus()
+
+    # A disabled registry records nothing
+    metrics.enabled = False
+    metrics.reset()
+    with patch('agent.OpenAI') as mock_openai:
+        mock_openai.return_value.chat.completions.create.return_value = mock_response
+        agent.process_message("Hello")
+    assert metrics.snapshot() == {"counters": {}, "summaries": {}}
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_run_message_async_keeps_the_loop_free():
+    # Create a test directory
+    test_dir = "test_run_message_async"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Initialize agent with test memory location
+    agent = Agent(memory_location=test_dir, context_token_budget=1)
+
+    # Simulate slow disk and context building
+    build_context = agent.memory.build_context
+    def slow_build_context(*args, **kwargs):
+        time.sleep(0.3)
+        return build_context(*args, **kwargs)
+    agent.memory.build_context = slow_build_context
+
+    async def create(**kwargs):
+        response = MagicMock()
+        response.choices[0].message.content = f"Answer to {kwargs['messages'][-1]['content']}"
+        return response
+
+    async def run_messages():
+        gaps = []
+        async def tick():
+            last = time.perf_counter()
+            while True:
+                await asyncio.sleep(0.01)
+                now = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+        ticker = asyncio.create_task(tick())
+        results = await asyncio.gather(*[agent.run_message_async(f"Question {i}") for i in range(3)])
+        ticker.cancel()
+        await agent.wait_for_writes()
+        return results, max(gaps)
+
+    with patch('agent.AsyncOpenAI') as mock_async_openai:
+        mock_client = MagicMock()
+        mock_client.chat.completions.create = AsyncMock(side_effect=create)
+        mock_async_openai.return_value = mock_client
+
+        results, longest_gap = asyncio.run(run_messages())
+
+    # The event loop kept running while the memory work was in progress
+    assert longest_gap < 0.2
+    assert [result.response for result in results] == [f"Answer to Question {i}" for i in range(3)]
+    # Every message has its own timings and context report
+    for result in results:
+        assert list(result.timings) == ["refresh", "extract_and_learn", "build_context", "llm_call", "save_interaction"]
+        assert result.timings["build_context"] >= 0.3
+        assert result.context_report["token_budget"] == 1
+    assert agent.last_timings == {}
+    assert len(agent.memory.interactions) == 3
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
 if __name__ == "__main__":
     test_learn_fact()
     test_learn_fact_error()
     test_learn_procedure()
     test_learn_procedure_error()
     test_extract_and_learn_output()
+    test_command_router()
     test_process_message_orchestration()
     test_process_message_no_interaction_on_api_failure()
+    test_restart_does_not_duplicate_initial_facts()
+    test_openai_client_reuses_connections()
+    test_process_message_async_concurrency()
+    test_process_message_async_no_interaction_on_api_failure()
+    test_stream_message()
+    test_process_message_metrics()
+    test_run_message_async_keeps_the_loop_free()
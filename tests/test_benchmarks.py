@@ -0,0 +1,33 @@
+import sys
+import os
+import json
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.generators import Generator
+from benchmarks.run import run_size, summarize, OPERATIONS
+
+def test_generators_are_reproducible():
+    # The same seed gives the same dataset
+    assert Generator(7).interactions(20) == Generator(7).interactions(20)
+    assert Generator(7).facts(20) != Generator(8).facts(20)
+    assert len(Generator(7).procedures(20)) == 20
+
+def test_summarize():
+    stats = summarize([0.001 * i for i in range(1, 101)])
+    assert stats["count"] == 100
+    assert round(stats["p50_ms"]) == 51
+    assert round(stats["p99_ms"]) == 100
+    assert stats["max_ms"] == 100.0
+
+def test_run_size():
+    # Every operation is measured on a small dataset, offline
+    result = run_size(200, operations=5)
+    assert set(result["operations"]) == set(OPERATIONS)
+    assert result["file_bytes"] > result["dataset_bytes"]
+    assert result["prompt_characters_mean"] > 0
+    json.dumps(result)
+
+if __name__ == "__main__":
+    test_generators_are_reproducible()
+    test_summarize()
+    test_run_size()
@@ -0,0 +1,156 @@
+import sys
+import os
+import time
+import shutil
+from unittest.mock import MagicMock
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from memory import Memory
+from consolidator import Consolidator, parse_facts
+
+def make_client(content):
+    client = MagicMock()
+    client.chat.completions.create.return_value.choices[0].message.content = content
+    return client
+
+def test_parse_facts():
+    assert parse_facts('["The user\'s name is John", " ", 3]') == ["The user's name is John"]
+    assert parse_facts('```json\n["The user likes tea"]\n```') == ["The user likes tea"]
+    assert parse_facts("Facts:\n- The user likes tea\n- The user lives in Berlin") == ["The user likes tea", "The user lives in Berlin"]
+    try:
+        parse_facts("Nothing to remember here")
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+def test_consolidate_interactions_into_facts():
+    # Create a test directory
+    test_dir = "test_consolidator"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    memory = Memory(test_dir)
+    for i in range(8):
+        memory.add_interaction(f"My name is John, message {i}", f"Nice to meet you {i}")
+
+    # One LLM call per batch, the newest interactions are kept
+    client = make_client('["The user\'s name is John"]')
+    consolidator = Consolidator(memory, client=client, batch_size=5, min_age=0, keep_recent=2, max_calls_per_minute=6000, segment_size=5)
+    assert consolidator.run_once() == 5
+    assert client.chat.completions.create.call_count == 1
+    assert "message 0" in client.chat.completions.create.call_args.kwargs["messages"][1]["content"]
+    assert memory.facts[-1] == {**memory.facts[-1], "fact": "The user's name is John", "type": "consolidated"}
+
+    # A full segment of consolidated interactions leaves the hot tier but stays searchable
+    assert [interaction["user_message"] for interaction in memory.interactions] == [f"My name is John, message {i}" for i in range(5, 8)]
+    assert len(memory.archive) == 5 and len(memory.archive.segments) == 1
+    assert memory.search_interactions("message 1", limit=1)[0]["user_message"] == "My name is John, message 1"
+
+    # Only the interactions beyond keep_recent are left to consolidate, they
+    # wait in the hot tier for the next segment
+    assert consolidator.run_once() == 1
+    assert consolidator.run_once() == 0
+    assert len(memory.facts) == 1
+    assert len(memory.interactions) == 3 and len(memory.archive) == 5
+
+    # Reloading opens the archive and doesn't consolidate the waiting interaction again
+    reloaded = Memory(test_dir)
+    assert len(reloaded.interactions) == 3 and len(reloaded.archive) == 5
+    assert Consolidator(reloaded, client=client, min_age=0, keep_recent=2, segment_size=5).run_once() == 0
+    assert client.chat.completions.create.call_count == 2
+
+    # Batches are gathered into one segment
+    for i in range(8, 12):
+        reloaded.add_interaction(f"My name is John, message {i}", f"Nice to meet you {i}")
+    consolidator = Consolidator(reloaded, client=client, batch_size=2, min_age=0, keep_recent=2, max_calls_per_minute=6000, segment_size=5)
+    assert consolidator.run_once() == 2
+    assert len(reloaded.archive) == 5
+    assert consolidator.run_once() == 2
+    assert len(reloaded.archive) == 10 and len(reloaded.archive.segments) == 2
+    assert len(reloaded.interactions) == 2
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_consolidation_failure_keeps_interactions():
+    # Create a test directory
+    test_dir = "test_consolidator_failure"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    memory = Memory(test_dir)
+    for i in range(4):
+        memory.add_interaction(f"Message {i}", f"Answer {i}")
+
+    client = MagicMock()
+    client.chat.completions.create.side_effect = Exception("API Error")
+    consolidator = Consolidator(memory, client=client, min_age=0, keep_recent=0, max_calls_per_minute=6000)
+    assert consolidator.run_once() == 0
+    assert len(memory.interactions) == 4 and memory.archive is None
+
+    # Young interactions are left alone
+    consolidator = Consolidator(memory, client=make_client("[]"), min_age=3600, keep_recent=0)
+    assert consolidator.run_once() == 0
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_consolidation_with_shared_storage():
+    # Create a test directory
+    test_dir = "test_consolidator_shared"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    memory = Memory(test_dir, storage="shared")
+    for i in range(4):
+        memory.add_interaction(f"I like tea, message {i}", f"Tea is nice {i}")
+
+    # The shared mode has no archive, consolidated interactions stay hot
+    client = make_client('["The user likes tea"]')
+    consolidator = Consolidator(memory, client=client, batch_size=2, min_age=0, keep_recent=0, max_calls_per_minute=6000, segment_size=2)
+    assert consolidator.run_once() == 2
+    assert len(memory.interactions) == 4 and memory.archive is None
+    assert [fact["fact"] for fact in Memory(test_dir, storage="shared").facts] == ["The user likes tea"]
+
+    # The next rounds move on to the interactions left
+    assert consolidator.run_once() == 2
+    assert consolidator.run_once() == 0
+    assert client.chat.completions.create.call_count == 2
+    assert Consolidator(Memory(test_dir, storage="shared"), client=client, min_age=0, keep_recent=0).run_once() == 0
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_consolidator_background_thread():
+    # Create a test directory
+    test_dir = "test_consolidator_thread"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    memory = Memory(test_dir)
+    for i in range(10):
+        memory.add_interaction(f"I live in Berlin, message {i}", f"Berlin is nice {i}")
+
+    # Rounds keep going while there is a backlog
+    consolidator = Consolidator(memory, client=make_client('["The user lives in Berlin"]'), batch_size=3, min_age=0, keep_recent=1, max_calls_per_minute=6000, segment_size=3)
+    consolidator.start()
+    deadline = time.time() + 5
+    while len(memory.interactions) > 1 and time.time() < deadline:
+        time.sleep(0.01)
+    consolidator.stop()
+    assert len(memory.interactions) == 1
+    assert [fact["fact"] for fact in memory.facts] == ["The user lives in Berlin"]
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+if __name__ == "__main__":
+    test_parse_facts()
+    test_consolidate_interactions_into_facts()
+    test_consolidation_failure_keeps_interactions()
+    test_consolidation_with_shared_storage()
+    test_consolidator_background_thread()
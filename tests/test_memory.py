@@ -1,6 +1,23 @@
-from memory import Memory
+from memory import Memory, get_fact_content, get_interaction_content
+from memory_pool import MemoryPool
+from utils.interaction_store import InteractionStore
+from utils.query_engine import QueryTerm, count_match, top_k
+from utils.search import search_keywords
+from utils.short_term_memory import ShortTermMemory
+from utils.context_builder import estimate_tokens
 import os
+import json
 import shutil
+import datetime
+import multiprocessing
+import copy
+import tracemalloc
+import random
+import threading
+from collections.abc import Mapping
+from unittest import mock
+import asyncio
+import time
 
 def test_agent_memory():
     # Create a test directory
@@ -276,6 +293,14 @@ def test_short_term_memory_persistence():
     assert memory.short_term_memory[0]["content"] == "Important memory"
     assert memory.short_term_memory[0]["importance"] == 0.8
 
+    # Flushed entries are loaded again on startup, within capacity
+    memory.flush()
+    reloaded = Memory(test_dir)
+    assert [entry["content"] for entry in reloaded.short_term_memory] == ["Important memory", "Less important memory"]
+    assert not reloaded.short_term_memory.dirty
+    assert "Short term memory: Important memory" in reloaded.get_context("memory")
+    assert [entry["content"] for entry in Memory(test_dir, short_term_memory_size=1).short_term_memory] == ["Important memory"]
+
     # Clean up
     shutil.rmtree(test_dir)
 
@@ -342,6 +367,1146 @@ def test_get_context():
     # Clean up
     shutil.rmtree(test_dir)
 
+def test_journal_storage_reload():
+    # Create a test directory
+    test_dir = "test_memory_journal"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Initialize memory in journal mode
+    memory = Memory(test_dir, storage="journal")
+    memory.add_fact("The user's name is John", "fact")
+    memory.add_procedure("greeting", ["Say hello"], "Say hello to the user")
+    memory.add_procedure("greeting", ["Say hi"], "Say hi to the user")
+    memory.add_interaction("Hello", "Hi there!", {"mood": "sunny"})
+
+    # Changes are appended to the journal, the snapshot is not written
+    assert not os.path.exists(os.path.join(test_dir, "facts.json"))
+    assert os.path.exists(os.path.join(test_dir, "facts.journal.jsonl"))
+
+    # Reloading replays the journal
+    reloaded = Memory(test_dir, storage="journal")
+    assert reloaded.facts == memory.facts
+    assert reloaded.procedures == memory.procedures
+    assert reloaded.procedures["greeting"]["steps"] == ["Say hi"]
+    assert reloaded.interactions == memory.interactions
+
+    # Compaction folds the journal into plain JSON files
+    reloaded.compact()
+    assert os.path.getsize(os.path.join(test_dir, "facts.journal.jsonl")) == 0
+    plain = Memory(test_dir)
+    assert plain.facts == memory.facts
+    assert plain.procedures == memory.procedures
+    assert plain.interactions == memory.interactions
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_journal_storage_migrates_existing_json():
+    # Create a test directory
+    test_dir = "test_memory_journal_migrate"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Existing store written in the original json mode
+    memory = Memory(test_dir)
+    memory.add_fact("First fact", "fact")
+
+    # Opening it in journal mode keeps the existing data
+    journal_memory = Memory(test_dir, storage="journal")
+    journal_memory.storage.compact_every = 2
+    journal_memory.add_fact("Second fact", "fact")
+    assert [fact["fact"] for fact in Memory(test_dir, storage="journal").facts] == ["First fact", "Second fact"]
+
+    # Reaching compact_every records rewrites the snapshot
+    journal_memory.add_fact("Third fact", "fact")
+    assert [fact["fact"] for fact in Memory(test_dir).facts] == ["First fact", "Second fact", "Third fact"]
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_journal_compaction_survives_a_crash():
+    # Create a test directory
+    test_dir = "test_memory_journal_crash"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    memory = Memory(test_dir, storage="journal", snapshot=False)
+    memory.add_facts(["First fact", "Second fact"], "fact")
+    expected = ["First fact", "Second fact"]
+
+    # A crash after the snapshot is replaced doesn't replay the journal over it
+    with mock.patch("utils.storage.os.remove", side_effect=OSError("crash")):
+        try:
+            memory.storage.compact("facts.json", memory.facts)
+            assert False, "expected OSError"
+        except OSError:
+            pass
+    assert [fact["fact"] for fact in Memory(test_dir, storage="journal", snapshot=False).facts] == expected
+
+    # A crash before the snapshot is replaced keeps the journal's records
+    memory = Memory(test_dir, storage="journal", snapshot=False)
+    memory.add_fact("Third fact", "fact")
+    expected.append("Third fact")
+    with mock.patch("utils.storage.write_text_atomic", side_effect=OSError("crash")):
+        try:
+            memory.storage.compact("facts.json", memory.facts)
+            assert False, "expected OSError"
+        except OSError:
+            pass
+    memory = Memory(test_dir, storage="journal", snapshot=False)
+    assert [fact["fact"] for fact in memory.facts] == expected
+
+    # Records added after the crash come after those, the next compaction cleans up
+    memory.add_fact("Fourth fact", "fact")
+    expected.append("Fourth fact")
+    assert [fact["fact"] for fact in Memory(test_dir, storage="journal", snapshot=False).facts] == expected
+    memory.compact()
+    assert not [name for name in os.listdir(test_dir) if ".compacting-" in name]
+    assert [fact["fact"] for fact in Memory(test_dir, snapshot=False).facts] == expected
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_indexed_search_matches_keyword_scan():
+    # Create a test directory
+    test_dir = "test_memory_index"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Initialize memory
+    memory = Memory(test_dir)
+
+    memory.add_fact("The user's name is John", "fact")
+    memory.add_fact("John likes programming.", "fact")
+    memory.add_fact("Python is a programming language", "fact")
+    memory.add_fact("Programs are written by programmers", "fact")
+    memory.add_interaction("Hello, how are you?", "I'm doing well, thank you!")
+    memory.add_interaction("What's your name?", "I'm an AI assistant")
+
+    # Substring scoring gives the same results as a full scan
+    for query in ["program", "john programming", "user", "'s name", "am", "nothing here"]:
+        for limit in [1, 3, 10]:
+            assert memory.search_facts(query, limit=limit) == search_keywords(query, memory.facts, fn=get_fact_content, limit=limit)
+            assert memory.search_interactions(query, limit=limit) == search_keywords(query, memory.interactions, fn=get_interaction_content, limit=limit)
+
+    # Token mode only matches whole words
+    results = memory.search_facts("programming", limit=10, mode="token")
+    assert [result["fact"] for result in results] == ["John likes programming.", "Python is a programming language"]
+    assert memory.search_facts("program", mode="token") == []
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_index_persistence():
+    # Create a test directory
+    test_dir = "test_memory_index_persistence"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Initialize memory
+    memory = Memory(test_dir)
+    memory.add_procedure("greeting", ["Say hello"], "Say hello to the user")
+    memory.add_procedure("greeting", ["Say hi"], "Say hi to the user")
+    memory.flush()
+    assert os.path.exists(os.path.join(test_dir, "procedures.index.json"))
+
+    # The persisted index is reused while it matches the store
+    reloaded = Memory(test_dir)
+    assert reloaded.indexes["procedures"].postings == memory.indexes["procedures"].postings
+    assert reloaded.search_procedures("hello") == []
+    assert reloaded.search_procedures("hi")[0]["name"] == "greeting"
+
+    # A store changed behind the index's back gets a rebuilt index
+    memory.add_procedure("farewell", ["Say goodbye"], "Say goodbye to the user")
+    reloaded = Memory(test_dir)
+    assert reloaded.search_procedures("goodbye")[0]["name"] == "farewell"
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_bm25_search():
+    # Create a test directory
+    test_dir = "test_memory_bm25"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Initialize memory
+    memory = Memory(test_dir)
+    memory.add_fact("The sky is blue", "fact")
+    memory.add_fact("The grass is green", "fact")
+    memory.add_fact("The user is called John", "fact")
+    memory.add_fact("Python is a programming language", "fact")
+
+    # Common words barely count, the rare word decides the ranking
+    results = memory.search_facts("what is the language", limit=2, mode="bm25", with_scores=True)
+    assert results[0][0]["fact"] == "Python is a programming language"
+    assert results[0][1] > results[1][1] > 0
+
+    # The mode can be selected per store
+    memory.search_modes["facts"] = "bm25"
+    assert memory.search_facts("is the sky", limit=1)[0]["fact"] == "The sky is blue"
+    assert memory.search_facts("sky is", limit=3, mode="keyword")[0]["fact"] == "The sky is blue"
+
+    # Document lengths and frequencies follow updates
+    memory.add_procedure("greeting", ["Say hello"], "Say hello to the user")
+    memory.add_procedure("greeting", ["Say hi"], "Say hi to the user")
+    index = memory.indexes["procedures"]
+    assert index.total_length == sum(index.doc_lengths.values()) == 6
+    assert memory.search_procedures("hello", mode="bm25") == []
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_short_term_memory_capacity():
+    # Create a test directory
+    test_dir = "test_memory_short_term_capacity"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Initialize memory with a small working memory
+    memory = Memory(test_dir, short_term_memory_size=3)
+
+    for importance in [0.5, 0.9, 0.1, 0.7, 0.3]:
+        memory.add_to_short_term_memory(f"Memory {importance}", importance=importance)
+
+    # The least important entries were evicted, insertion order is kept
+    assert len(memory.short_term_memory) == 3
+    assert [entry["content"] for entry in memory.short_term_memory] == ["Memory 0.5", "Memory 0.9", "Memory 0.7"]
+    assert [entry["importance"] for entry in memory.sort_short_term_memory(limit=2)] == [0.9, 0.7]
+
+    # Short-term memory is only written on flush
+    path = os.path.join(test_dir, "short_term_memory.json")
+    assert not os.path.exists(path)
+    memory.flush()
+    with open(path) as f:
+        assert [entry["content"] for entry in json.load(f)] == ["Memory 0.5", "Memory 0.9", "Memory 0.7"]
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_short_term_memory_decay():
+    # Entries lose half of their importance every hour
+    short_term_memory = ShortTermMemory(capacity=2, half_life=3600)
+    now = datetime.datetime.now()
+    old = {"content": "Old but important", "importance": 1.0, "timestamp": (now - datetime.timedelta(hours=2)).isoformat()}
+    new = {"content": "New", "importance": 0.5, "timestamp": now.isoformat()}
+    short_term_memory.add(old)
+    short_term_memory.add(new)
+
+    assert short_term_memory.decayed_importance(old, now) == 0.25
+    assert [entry["content"] for entry in short_term_memory.top()] == ["New", "Old but important"]
+
+    # The decayed entry is the one evicted
+    evicted = short_term_memory.add({"content": "Newest", "importance": 0.4, "timestamp": now.isoformat()})
+    assert evicted is old
+
+def test_fact_deduplication():
+    # Create a test directory
+    test_dir = "test_memory_dedup"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Initialize memory
+    memory = Memory(test_dir)
+
+    # Adding a known fact is a no-op returning the existing id
+    first_id = memory.add_fact("The sky is blue", "fact")
+    assert memory.add_fact("the sky  is BLUE", "fact") == first_id
+    assert len(memory.facts) == 1
+
+    # Batches are deduplicated too, against the store and within the batch
+    assert memory.add_facts(["Grass is green", "The sky is blue", "Grass is green"], "fact") == [1, 0, 1]
+    assert [fact["fact"] for fact in Memory(test_dir).facts] == ["The sky is blue", "Grass is green"]
+
+    # Stores written before deduplication can be compacted
+    with open(os.path.join(test_dir, "facts.json"), "w") as f:
+        json.dump([{"fact": "The sky is blue", "type": "semantic", "timestamp": "2025-06-18T17:53:05.784571"}] * 3, f)
+    memory = Memory(test_dir)
+    assert memory.compact_facts() == 2
+    assert len(memory.facts) == 1
+    assert len(Memory(test_dir).facts) == 1
+    assert memory.search_facts("sky") == memory.facts
+    assert memory.compact_facts() == 0
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_get_context_cache():
+    # Create a test directory
+    test_dir = "test_memory_context_cache"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Initialize memory
+    memory = Memory(test_dir)
+    memory.add_fact("User likes programming", "fact")
+    memory.add_procedure("greeting", ["Say hello"], "Greet the user")
+    memory.add_interaction("Hello", "Hi there!")
+
+    # A repeated, differently spaced or cased question is served from the cache
+    context = memory.get_context("programming")
+    assert memory.context_cache.stats()["misses"] == 4
+    assert memory.get_context("  Programming ") == context
+    assert memory.context_cache.stats()["hits"] == 4
+
+    # Only the section of the changed store is rebuilt
+    memory.add_fact("User likes programming in Python", "fact")
+    context = memory.get_context("programming")
+    assert "User likes programming in Python" in context
+    assert memory.context_cache.stats()["misses"] == 5
+    assert memory.context_cache.stats()["hits"] == 7
+
+    # A disabled cache still builds the same context
+    uncached = Memory(test_dir, context_cache_size=0)
+    assert uncached.get_context("programming") == context
+    assert len(uncached.context_cache) == 0
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_get_context_token_budget():
+    # Create a test directory
+    test_dir = "test_memory_context_budget"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Initialize memory
+    memory = Memory(test_dir, short_term_memory_size=20)
+    memory.add_fact("User likes programming", "fact")
+    memory.add_fact("User is programming in Python since 2010", "fact")
+    memory.add_procedure("programming setup", ["Install Python", "Create a virtual environment"], "Set up a programming environment")
+    memory.add_interaction("Hello", "Hi there! " + "I can talk for a long time. " * 100)
+    for i in range(20):
+        memory.add_to_short_term_memory(f"Short term note number {i}", importance=i / 20)
+
+    # Without a budget nothing is cut
+    context, report = memory.build_context("programming")
+    assert context == memory.get_context("programming")
+    assert report["dropped"] == [] and report["truncated"] == []
+    assert estimate_tokens(context) > 500
+
+    # With a budget the context fits and the cuts are reported
+    context, report = memory.build_context("programming", token_budget=200)
+    assert report["estimated_tokens"] <= 200
+    assert estimate_tokens(context) == report["estimated_tokens"]
+    assert "Fact: User likes programming" in context
+    assert "Procedure 1. programming setup" in context
+    assert [item["section"] for item in report["truncated"]] == ["interactions"]
+    assert report["dropped"] and all(item["section"] == "short_term_memory" for item in report["dropped"])
+
+    # The most important short-term memories are the ones kept
+    assert "Short term note number 19" in context
+    assert "Short term note number 0\n" not in context
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_vector_search():
+    # Create a test directory
+    test_dir = "test_memory_vector"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Initialize memory
+    memory = Memory(test_dir)
+    memory.add_fact("The user's favourite colour is blue", "fact")
+    memory.add_fact("Python is a programming language", "fact")
+
+    # Keyword search misses the different spelling, vector search finds it
+    assert memory.search_facts("favorite color") == []
+    results = memory.search_facts("favorite color", mode="vector", with_scores=True)
+    assert [fact["fact"] for fact, _ in results] == ["The user's favourite colour is blue"]
+
+    # New items are appended to the existing matrix
+    matrix = memory.vector_indexes["facts"].matrix
+    memory.add_fact("The user's favorite food is pizza", "fact")
+    assert memory.vector_indexes["facts"].matrix is matrix
+    assert len(memory.vector_indexes["facts"]) == 3
+    assert memory.search_facts("favorite food", limit=1, mode="vector")[0]["fact"] == "The user's favorite food is pizza"
+
+    # Updated procedures replace their vector
+    memory.search_modes["procedures"] = "vector"
+    memory.add_procedure("greeting", ["Say hello"], "Say hello to the user")
+    assert memory.search_procedures("hello") != []
+    memory.add_procedure("greeting", ["Wave"], "Wave at the user")
+    assert len(memory.vector_indexes["procedures"]) == 1
+    assert memory.search_procedures("waving")[0]["description"] == "Wave at the user"
+
+    # The matrix is saved next to the JSON files and reused
+    memory.flush()
+    reloaded = Memory(test_dir)
+    index = reloaded.get_vector_index("facts")
+    assert (index.matrix[:len(index)] == memory.vector_indexes["facts"].matrix[:3]).all()
+    assert reloaded.search_facts("favorite color", limit=1, mode="vector") == [results[0][0]]
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def add_shared_interactions(test_dir, worker, count):
+    memory = Memory(test_dir, storage="shared")
+    for i in range(count):
+        memory.add_interaction(f"Message {i} from worker {worker}", "Noted")
+
+def test_shared_storage_concurrent_processes():
+    # Create a test directory
+    test_dir = "test_memory_shared"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Several processes append to the same location at once
+    workers = [multiprocessing.Process(target=add_shared_interactions, args=(test_dir, worker, 25)) for worker in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    # No append is lost and every journal line is whole
+    memory = Memory(test_dir, storage="shared")
+    assert len(memory.interactions) == 100
+    assert {interaction["user_message"] for interaction in memory.interactions} == {f"Message {i} from worker {worker}" for i in range(25) for worker in range(4)}
+    with open(os.path.join(test_dir, "interactions.journal.jsonl")) as f:
+        assert all(json.loads(line)["writer"] for line in f)
+
+    # Compaction keeps the records of every writer
+    memory.compact()
+    assert os.path.getsize(os.path.join(test_dir, "interactions.journal.jsonl")) == 0
+    with open(os.path.join(test_dir, "interactions.json")) as f:
+        assert len(json.load(f)) == 100
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_shared_storage_refresh():
+    # Create a test directory
+    test_dir = "test_memory_shared_refresh"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Two writers on the same location, as two worker processes would be
+    first = Memory(test_dir, storage="shared")
+    second = Memory(test_dir, storage="shared")
+    first.add_fact("The user's name is John", "fact")
+    first.add_procedure("greeting", ["Say hello"], "Say hello to the user")
+    second.add_interaction("Hello", "Hi there!")
+
+    # Each one picks up the other's records without a reload
+    second.refresh()
+    assert [fact["fact"] for fact in second.search_facts("john")] == ["The user's name is John"]
+    assert second.procedures["greeting"]["steps"] == ["Say hello"]
+    first.refresh()
+    assert [interaction["user_message"] for interaction in first.interactions] == ["Hello"]
+
+    # Facts the other writer already added are not duplicated
+    second.add_fact("the user's name is john", "fact")
+    assert len(second.facts) == 1
+
+    # After a compaction by one writer the other reloads the files
+    first.add_interaction("Bye", "See you!")
+    first.compact()
+    second.refresh()
+    assert [interaction["user_message"] for interaction in second.interactions] == ["Hello", "Bye"]
+    second.add_fact("Python is a programming language", "fact")
+    first.refresh()
+    assert len(first.facts) == 2
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_memory_pool_eviction():
+    # Create a test directory
+    test_dir = "test_memory_pool"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+
+    # At most two tenants stay resident
+    pool = MemoryPool(test_dir, max_resident=2)
+    pool.get("alice").add_fact("Alice likes tea", "fact")
+    pool.get("bob").add_fact("Bob likes coffee", "fact")
+    pool.get("alice").add_to_short_term_memory("Alice is online")
+    pool.get("carol").add_fact("Carol likes juice", "fact")
+
+    # Bob was the least recently used tenant
+    assert "bob" not in pool
+    assert "alice" in pool and "carol" in pool
+    assert pool.stats()["evictions"] == 1
+    assert pool.stats()["hits"] == 1 and pool.stats()["misses"] == 3
+
+    # Evicted tenants are flushed and reloaded on their next access
+    assert [fact["fact"] for fact in pool.get("bob").search_facts("coffee")] == ["Bob likes coffee"]
+    assert "alice" not in pool
+    assert pool.get("alice").facts[0]["fact"] == "Alice likes tea"
+    with open(os.path.join(test_dir, "alice", "short_term_memory.json")) as f:
+        assert json.load(f)[0]["content"] == "Alice is online"
+
+    # Tenants are kept apart, ids can't leave the pool directory
+    assert pool.get("alice").search_facts("coffee") == []
+    assert pool.get_location("../bob") == os.path.join(test_dir, "..%2Fbob")
+    try:
+        pool.get("..")
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+    pool.close()
+
+    # The item limit evicts tenants holding large histories
+    pool = MemoryPool(test_dir, max_items=1)
+    pool.get("alice")
+    pool.get("bob")
+    assert len(pool) == 1 and "bob" in pool
+    pool.close()
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_memory_pool_loads_and_flushes_outside_the_lock():
+    # Create a test directory
+    test_dir = "test_memory_pool_lock"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+
+    pool = MemoryPool(test_dir, max_resident=1)
+    pool.get("bob").add_fact("Bob likes coffee", "fact")
+
+    # Bob's flush is held up while Alice is loaded
+    bob = pool.get("bob")
+    flushing, resume = threading.Event(), threading.Event()
+    close = bob.close
+    def slow_close():
+        flushing.set()
+        resume.wait(5)
+        close()
+    bob.close = slow_close
+    loader = threading.Thread(target=pool.get, args=("alice",))
+    loader.start()
+    assert flushing.wait(5)
+
+    # Other tenants are served meanwhile, Bob is reloaded once his files are written
+    assert pool.get("alice").search_facts("coffee") == []
+    results = []
+    reloader = threading.Thread(target=lambda: results.append(pool.get("bob")))
+    reloader.start()
+    time.sleep(0.05)
+    assert not results
+    resume.set()
+    loader.join(5)
+    reloader.join(5)
+    assert results[0] is not bob and results[0].facts[0]["fact"] == "Bob likes coffee"
+
+    # Concurrent requests for a tenant share a single load
+    barrier = threading.Barrier(4)
+    memories = []
+    def get_carol():
+        barrier.wait()
+        memories.append(pool.get("carol"))
+    threads = [threading.Thread(target=get_carol) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(memories) == 4 and all(memory is memories[0] for memory in memories)
+    pool.close()
+    assert len(pool) == 0 and not pool.closing
+
+    # Item counts are kept as the tenants are served, a tenant in a long
+    # change doesn't hold up the others
+    pool = MemoryPool(test_dir, max_items=10)
+    alice = pool.get("alice")
+    alice.add_facts([f"Alice fact {i}" for i in range(3)], "fact")
+    pool.get("alice")
+    assert pool.stats()["resident_items"] == 3
+    changing, release = threading.Event(), threading.Event()
+    def long_change():
+        with alice.changing():
+            changing.set()
+            release.wait(5)
+    change = threading.Thread(target=long_change)
+    change.start()
+    assert changing.wait(5)
+    start = time.monotonic()
+    assert pool.get("bob").facts[0]["fact"] == "Bob likes coffee"
+    assert time.monotonic() - start < 1
+    assert pool.stats()["resident_items"] == 4
+    release.set()
+    change.join()
+    pool.close()
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_interaction_store_behaves_like_a_list():
+    records = [
+        {"agent_message": "Hi there!", "user_message": "Hello", "metadata": {"mood": "sunny"}, "timestamp": "2024-01-01T10:00:00"},
+        {"agent_message": "Sure", "user_message": "Help me", "metadata": None, "timestamp": "2024-01-01T10:00:01.000250"},
+        # Kept as is: a timestamp with a time zone and an extra key
+        {"agent_message": "Bye", "user_message": "Bye", "metadata": {"mood": "sunny"}, "timestamp": "2024-01-01T10:00:02+02:00", "rating": 5},
+    ]
+    store = InteractionStore(copy.deepcopy(records))
+    assert store == records
+    assert len(store) == 3
+    assert store[-1] == records[-1]
+    assert store[-2:] == records[-2:]
+    assert [interaction["user_message"] for interaction in store] == ["Hello", "Help me", "Bye"]
+    assert list(store.get_timestamps()) == [record["timestamp"] for record in records]
+    assert json.loads(json.dumps(records)) == json.loads(json.dumps(store.to_list()))
+
+    # Copies don't see later appends
+    snapshot = copy.copy(store)
+    store.append({"agent_message": "Hey", "user_message": "Hey", "metadata": {"mood": "rainy"}, "timestamp": "2024-01-01T10:00:03"})
+    assert len(snapshot) == 3 and len(store) == 4
+
+    # Equal metadata dicts are stored once, reading one doesn't share it
+    assert len(store.metadata_values) == 2
+    store[0]["metadata"]["mood"] = "cloudy"
+    assert store[0]["metadata"] == {"mood": "sunny"}
+
+def test_interaction_store_memory_reduction():
+    records = [{"agent_message": f"Answer number {i}", "user_message": f"Question number {i}", "metadata": {"session": f"session {i % 20}"}, "timestamp": f"2024-01-01T10:{i // 60 % 60:02d}:{i % 60:02d}.{i:06d}"} for i in range(20000)]
+    text = json.dumps(records)
+
+    tracemalloc.start()
+    as_dicts = json.loads(text)
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    del as_dicts
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    store = InteractionStore(json.loads(text))
+    store_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    assert store == records
+    assert dict_bytes / store_bytes > 2.5
+
+def test_memory_interactions_round_trip():
+    # Create a test directory
+    test_dir = "test_memory_interaction_store"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Interactions are written as plain JSON records in every storage mode
+    for storage in ["json", "journal", "shared"]:
+        memory = Memory(test_dir, storage=storage)
+        memory.add_interaction(f"Hello {storage}", "Hi there!", {"storage": storage})
+        memory.compact()
+        with open(os.path.join(test_dir, "interactions.json")) as f:
+            assert json.load(f) == memory.interactions
+        assert Memory(test_dir, storage=storage).interactions == memory.interactions
+    assert isinstance(memory.interactions, InteractionStore)
+    assert memory.search_interactions("hello journal")[0]["metadata"] == {"storage": "journal"}
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_interaction_tiering():
+    # Create a test directory
+    test_dir = "test_memory_tiering"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # About 5 interactions stay hot, older ones are sealed 10 at a time
+    memory = Memory(test_dir, hot_interactions=5, segment_size=10)
+    for i in range(32):
+        memory.add_interaction(f"Question {i} about topic{i}", f"Answer {i}")
+    assert len(memory.archive) == 20 and len(memory.interactions) == 12
+    with open(os.path.join(test_dir, "interactions.json")) as f:
+        assert len(json.load(f)) == 12
+    assert os.path.exists(os.path.join(test_dir, "interactions.segments", "segment-000002.jsonl.gz"))
+
+    # Searches cover every tier and skip segments that can't match
+    assert [interaction["user_message"] for interaction in memory.search_interactions("topic3", mode="token")] == ["Question 3 about topic3"]
+    assert memory.archive.scanned == 1 and memory.archive.skipped == 1
+    assert [interaction["user_message"] for interaction in memory.search_interactions("topic1", limit=20)][:2] == ["Question 1 about topic1", "Question 10 about topic10"]
+    assert len(memory.search_interactions("question", limit=40)) == 32
+    assert [interaction["user_message"] for interaction in memory.search_recent_interactions(14)] == [f"Question {i} about topic{i}" for i in range(18, 32)]
+
+    # Startup only loads the hot tier
+    reloaded = Memory(test_dir, hot_interactions=5, segment_size=10)
+    assert reloaded.interactions == memory.interactions
+    assert reloaded.search_interactions("topic7", mode="token")[0]["user_message"] == "Question 7 about topic7"
+
+    # A crash between sealing a segment and rewriting the hot file leaves
+    # archived interactions in it, they are dropped on load
+    with open(os.path.join(test_dir, "interactions.json"), "w") as f:
+        json.dump(reloaded.archive.recent(10) + reloaded.interactions[:], f)
+    recovered = Memory(test_dir, hot_interactions=5, segment_size=10)
+    assert recovered.interactions == memory.interactions
+
+    # Searches don't wait while a segment is written, its records are read from RAM
+    writing, release = threading.Event(), threading.Event()
+    write = recovered.archive.write
+    def slow_write(segment):
+        writing.set()
+        release.wait(5)
+        write(segment)
+    recovered.archive.write = slow_write
+    sealing = threading.Thread(target=recovered.archive_oldest_interactions, args=(10,))
+    sealing.start()
+    assert writing.wait(5)
+    assert len(recovered.interactions) == 2 and len(recovered.archive) == 30
+    assert recovered.search_interactions("topic25", mode="token")[0]["user_message"] == "Question 25 about topic25"
+    release.set()
+    sealing.join()
+    assert not recovered.archive.pending
+    assert len(Memory(test_dir, hot_interactions=5, segment_size=10).archive) == 30
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_snapshot():
+    # Create a test directory
+    test_dir = "test_memory_snapshot"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    memory = Memory(test_dir)
+    memory.add_facts(["Python is a programming language", "The sky is blue"], "test")
+    memory.add_procedure("Deploy", ["Run the deploy script"], "Deploy the app")
+    memory.add_interaction("What is Python?", "A programming language", metadata={"session": "a"})
+    memory.add_interaction("What color is the sky?", "Blue")
+    memory.flush()
+    snapshot_path = os.path.join(test_dir, "memory.snapshot")
+    assert os.path.exists(snapshot_path)
+
+    # A fresh snapshot replaces loading the JSON files and indexes
+    loaded = Memory(test_dir)
+    assert loaded.load_snapshot()
+    assert loaded.facts == memory.facts and loaded.procedures == memory.procedures
+    assert loaded.interactions == memory.interactions
+    assert loaded.search_facts("python") == memory.search_facts("python")
+    assert loaded.search_interactions("sky")[0]["agent_message"] == "Blue"
+    loaded.add_fact("Water is wet", "test")
+    assert loaded.search_facts("water")[0]["fact"] == "Water is wet"
+
+    # Changing a JSON file outside the memory makes the snapshot stale
+    with open(os.path.join(test_dir, "facts.json")) as f:
+        facts = json.load(f)
+    facts.append({"fact": "Edited by hand", "source": "test", "timestamp": datetime.datetime.now().isoformat()})
+    with open(os.path.join(test_dir, "facts.json"), "w") as f:
+        json.dump(facts, f)
+    edited = Memory(test_dir)
+    assert not edited.load_snapshot()
+    assert edited.search_facts("hand")[0]["fact"] == "Edited by hand"
+    edited.flush()
+    assert Memory(test_dir).facts == edited.facts
+
+    # A corrupt snapshot is ignored
+    with open(snapshot_path, "r+b") as f:
+        f.seek(-100, os.SEEK_END)
+        f.write(b"garbage")
+    corrupt = Memory(test_dir)
+    assert not corrupt.load_snapshot()
+    assert corrupt.facts == edited.facts
+
+    # Export writes plain JSON, import builds the snapshot from it
+    export_dir = os.path.join(test_dir, "export")
+    edited.export_json(export_dir)
+    with open(os.path.join(export_dir, "interactions.json")) as f:
+        assert json.load(f) == edited.interactions
+    imported = Memory(export_dir, snapshot=False)
+    imported.save_snapshot()
+    assert Memory(export_dir).interactions == edited.interactions
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_time_window_queries():
+    # Create a test directory
+    test_dir = "test_memory_time_window"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Two days of interactions, one session each, written out of order
+    start = datetime.datetime(2024, 5, 1, 9, 0)
+    moments = [start + datetime.timedelta(days=day, minutes=10 * i) for day in range(2) for i in range(5)]
+    records = [{"user_message": f"Question {i}", "agent_message": f"Answer {i}", "metadata": None, "timestamp": moment.isoformat()}
+               for i, moment in enumerate(moments)]
+    with open(os.path.join(test_dir, "interactions.json"), "w") as f:
+        json.dump(records[5:] + records[:5], f)
+
+    memory = Memory(test_dir)
+    day_two = memory.get_interactions_between(datetime.datetime(2024, 5, 2), "2024-05-03T00:00:00")
+    assert [interaction["user_message"] for interaction in day_two] == [f"Question {i}" for i in range(5, 10)]
+    assert [interaction["user_message"] for interaction in memory.get_interactions_between(end=datetime.datetime(2024, 5, 2), limit=2)] == ["Question 3", "Question 4"]
+    assert memory.get_interactions_between("2024-06-01") == []
+    assert [len(session) for session in memory.get_sessions()] == [5, 5]
+    assert [interaction["user_message"] for interaction in memory.search_recent_interactions(2)] == ["Question 8", "Question 9"]
+
+    # New interactions extend the index, a pause starts a new session
+    memory.add_interaction("Much later", "Yes")
+    assert [interaction["user_message"] for interaction in memory.get_last_session()] == ["Much later"]
+    assert memory.get_last_session(gap=10 * 365 * 24 * 3600)[0]["user_message"] == "Question 0"
+    try:
+        memory.get_interactions_between("yesterday")
+        assert False, "unreadable bounds must be rejected"
+    except ValueError:
+        pass
+
+    # The index is kept in the snapshot and spans archived interactions
+    memory.flush()
+    loaded = Memory(test_dir)
+    assert loaded.load_snapshot() and list(loaded.time_index.keys) == list(memory.time_index.keys)
+    loaded.archive_oldest_interactions(7)
+    assert [interaction["user_message"] for interaction in loaded.get_interactions_between("2024-05-02T09:15")] == ["Question 7", "Question 8", "Question 9", "Much later"]
+    assert [interaction["user_message"] for interaction in loaded.get_interactions_between("2024-05-02", limit=3)] == ["Question 8", "Question 9", "Much later"]
+    assert [len(session) for session in loaded.get_sessions("2024-05-01", "2024-05-03")] == [5, 5]
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_metadata_filters():
+    # Create a test directory
+    test_dir = "test_memory_metadata_filters"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    memory = Memory(test_dir, metadata_indexes=["channel", "priority"], hot_interactions=6, segment_size=4)
+    for i in range(12):
+        metadata = {"channel": "email" if i % 2 else "chat", "priority": i % 4, "user_id": f"user{i % 3}"}
+        memory.add_interaction(f"Order {i} is late", f"Sorry about order {i}", metadata)
+    assert len(memory.archive) == 4
+
+    def orders(interactions):
+        return [interaction["user_message"] for interaction in interactions]
+
+    # Equality and range filters on indexed keys prune the candidates
+    assert memory.filter_interactions({"channel": "email", "priority": {"gte": 2}}) == {i - 4 for i in (5, 7, 9, 11) if i % 4 >= 2}
+    assert orders(memory.search_interactions("late", limit=10, filters={"channel": "email", "priority": {"gte": 2}})) == ["Order 3 is late", "Order 7 is late", "Order 11 is late"]
+    assert orders(memory.search_interactions("late", limit=10, mode="bm25", filters={"priority": {"in": [0]}})) == ["Order 0 is late", "Order 4 is late", "Order 8 is late"]
+    assert memory.search_interactions("late", filters={"channel": "fax"}) == []
+
+    # Keys without an index are checked on the remaining candidates
+    assert orders(memory.search_interactions("late", limit=10, filters={"user_id": "user1", "channel": "chat"})) == ["Order 4 is late", "Order 10 is late"]
+
+    # Recent interactions, reaching into the archive when needed
+    assert orders(memory.search_recent_interactions(2, filters={"channel": "chat"})) == ["Order 8 is late", "Order 10 is late"]
+    assert orders(memory.search_recent_interactions(5, filters={"priority": {"lt": 2}, "channel": "email"})) == ["Order 1 is late", "Order 5 is late", "Order 9 is late"]
+
+    # The index follows new interactions and reloads
+    memory.add_interaction("Order 12 is late", "Sorry", {"channel": "phone", "priority": 3})
+    assert orders(memory.search_recent_interactions(3, filters={"channel": "phone"})) == ["Order 12 is late"]
+    reloaded = Memory(test_dir, metadata_indexes=["channel", "priority"], hot_interactions=6, segment_size=4)
+    assert reloaded.filter_interactions({"channel": "phone"}) == memory.filter_interactions({"channel": "phone"})
+
+    # Archived segments whose summary rules the filters out aren't read
+    archive = reloaded.archive
+    read = archive.read
+    reads = []
+    archive.read = lambda segment: reads.append(segment["name"]) or read(segment)
+    assert reloaded.search_interactions("late", limit=10, filters={"channel": "fax"}) == []
+    assert reloaded.search_interactions("late", limit=10, filters={"priority": {"gt": 3}}) == []
+    assert orders(reloaded.search_recent_interactions(10, filters={"channel": "email", "priority": {"in": [4, "1"]}})) == []
+    assert reads == [] and archive.skipped == 3
+    assert orders(reloaded.search_recent_interactions(10, filters={"channel": "email", "priority": 1})) == ["Order 1 is late", "Order 5 is late", "Order 9 is late"]
+    assert reads == ["segment-000001"]
+
+    try:
+        memory.search_interactions("late", filters={"priority": {"between": [1, 2]}})
+        assert False, "unknown operators must be rejected"
+    except ValueError:
+        pass
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_fuzzy_search():
+    # Create a test directory
+    test_dir = "test_memory_fuzzy"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    memory = Memory(test_dir)
+    memory.add_facts(["Python is a programming language", "We receive mail every day", "Bananas are yellow"], "test")
+
+    # Misspelled and partial words only match in fuzzy mode
+    assert memory.search_facts("pyhton") == []
+    assert memory.search_facts("pyhton", mode="fuzzy")[0]["fact"] == "Python is a programming language"
+    assert memory.search_facts("recieve", mode="fuzzy")[0]["fact"] == "We receive mail every day"
+    fact, score = memory.search_facts("prog", mode="fuzzy", with_scores=True)[0]
+    assert fact["fact"] == "Python is a programming language" and 0 < score < 1
+    assert memory.search_facts("python", mode="fuzzy", with_scores=True)[0][1] == 1
+
+    # The threshold trades recall for precision
+    memory.fuzzy_threshold = 0.8
+    assert memory.search_facts("pyhton", mode="fuzzy") == []
+    memory.fuzzy_threshold = 0.4
+
+    # Words added later are matched too, in every store
+    memory.add_fact("Strawberries are red", "test")
+    assert memory.search_facts("strawbery", mode="fuzzy")[0]["fact"] == "Strawberries are red"
+    memory.add_interaction("How do I recieve a refund?", "Fill in the form")
+    memory.search_modes["interactions"] = "fuzzy"
+    assert memory.search_interactions("refnud")[0]["agent_message"] == "Fill in the form"
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_top_k_query_engine():
+    # Create a test directory
+    test_dir = "test_memory_top_k"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Pruned top-k searches return what scoring every item returns
+    rng = random.Random(0)
+    words = [f"word{i}" for i in range(30)] + ["the"] * 10
+    memory = Memory(test_dir)
+    memory.add_facts([" ".join(rng.choice(words) for _ in range(rng.randint(3, 12))) for _ in range(300)], "test")
+    index = memory.indexes["facts"]
+    for _ in range(50):
+        query = " ".join(rng.choice(words) for _ in range(rng.randint(1, 5)))
+        for mode in ["keyword", "token", "bm25", "fuzzy"]:
+            terms = index.get_query_terms(query, mode)
+            scores = {}
+            for term in terms:
+                best = {}
+                for postings, weight in term.postings:
+                    for doc_id, value in postings.items():
+                        best[doc_id] = max(best.get(doc_id, 0), weight * term.score(doc_id, value))
+                for doc_id, score in best.items():
+                    scores[doc_id] = scores.get(doc_id, 0) + score
+            expected = sorted(scores.items(), key=lambda x: (-x[1], x[0]))[:5]
+            results = index.search(query, limit=5, mode=mode)
+            assert [doc_id for doc_id, _ in results] == [doc_id for doc_id, _ in expected]
+            assert all(abs(score - expected_score) < 1e-9 for (_, score), (_, expected_score) in zip(results, expected))
+
+    # Keyword terms find their tokens through the trigrams, as a scan would
+    for term in ["word1", "ord2", "the", "wor", "d1"]:
+        assert sorted(index.match_tokens(term)) == sorted(token for token in index.postings if term in token)
+
+    # Postings of common terms are only looked up for the items in the running
+    class CountingPostings(Mapping):
+        def __init__(self, postings):
+            self.postings = postings
+            self.touched = 0
+        def __getitem__(self, doc_id):
+            self.touched += 1
+            return self.postings[doc_id]
+        def __contains__(self, doc_id):
+            self.touched += 1
+            return doc_id in self.postings
+        def __iter__(self):
+            for doc_id in self.postings:
+                self.touched += 1
+                yield doc_id
+        def __len__(self):
+            return len(self.postings)
+    rare = CountingPostings({doc_id: 1 for doc_id in range(0, 10000, 1000)})
+    common = CountingPostings({doc_id: 1 for doc_id in range(10000)})
+    terms = [QueryTerm([(rare, 5.0)], 5.0, count_match), QueryTerm([(common, 0.5)], 0.5, count_match)]
+    assert top_k(terms, 3) == [(0, 5.5), (1000, 5.5), (2000, 5.5)]
+    assert rare.touched == 10 and common.touched <= 20
+
+    # One query over every store, archived interactions included
+    shutil.rmtree(test_dir)
+    memory = Memory(test_dir, hot_interactions=2, segment_size=2)
+    memory.add_fact("Coffee is brewed with hot water", "test")
+    memory.add_procedure("coffee", ["Boil water", "Pour"], "Brew coffee with water")
+    memory.add_interaction("How strong is coffee?", "Quite strong")
+    for i in range(4):
+        memory.add_interaction(f"Question {i}", f"Answer {i}")
+    assert len(memory.archive) == 2
+    results = memory.search_all("coffee water", limit=3, with_scores=True)
+    assert [(store, score) for store, _, score in results] == [("facts", 2), ("procedures", 2), ("interactions", 1)]
+    assert results[2][1]["user_message"] == "How strong is coffee?"
+    assert [store for store, _ in memory.search_all("coffee", limit=2, mode="bm25", stores=["interactions", "facts"])] == ["interactions", "facts"]
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_concurrent_readers_and_writers():
+    # Create a test directory
+    test_dir = "test_memory_concurrency"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    memory = Memory(test_dir, snapshot=False)
+
+    # Searches run while a change is written to disk, the next change waits
+    dumping, release = threading.Event(), threading.Event()
+    write_file = memory.storage.write_file
+    def slow_write(file_name, data):
+        if file_name == "facts.json":
+            dumping.set()
+            release.wait(5)
+        write_file(file_name, data)
+    memory.storage.write_file = slow_write
+    first = threading.Thread(target=memory.add_fact, args=("Green tea is brewed at 80 degrees", "fact"))
+    first.start()
+    assert dumping.wait(5)
+    assert [fact["fact"] for fact in memory.search_facts("tea")] == ["Green tea is brewed at 80 degrees"]
+    # Nothing outside the process changes the files, refresh doesn't wait either
+    refresh = threading.Thread(target=memory.refresh)
+    refresh.start()
+    refresh.join(1)
+    assert not refresh.is_alive()
+    second = threading.Thread(target=memory.add_fact, args=("Black tea is brewed at 95 degrees", "fact"))
+    second.start()
+    second.join(0.1)
+    assert second.is_alive()
+    assert len(memory.facts) == 1
+    release.set()
+    first.join()
+    second.join()
+    memory.storage.write_file = write_file
+    assert len(memory.facts) == 2
+
+    # Changing the memory while holding it shared would wait forever
+    with memory.lock.shared():
+        try:
+            memory.add_fact("Oolong tea is brewed at 90 degrees", "fact")
+            assert False, "add_fact should refuse to run under the shared lock"
+        except RuntimeError:
+            pass
+
+    # Readers and writers running at once
+    errors = []
+    def write(writer_id):
+        try:
+            for i in range(25):
+                memory.add_interaction(f"Question {writer_id}-{i} about tea", f"Answer {writer_id}-{i}")
+                memory.add_to_short_term_memory(f"Writer {writer_id} step {i}")
+        except Exception as e:
+            errors.append(e)
+    def read():
+        try:
+            for _ in range(25):
+                memory.search_interactions("tea", mode="bm25")
+                memory.get_context("tea")
+                memory.search_all("tea")
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(4)] + [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(memory.interactions) == 100
+    memory.flush()
+
+    # Every change made it to disk
+    reloaded = Memory(test_dir, snapshot=False)
+    assert len(reloaded.facts) == 2
+    assert len(reloaded.interactions) == 100
+    assert len(reloaded.search_interactions("Question 3-24", limit=1)) == 1
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_journal_appends_of_threads_are_batched():
+    # Create a test directory
+    test_dir = "test_memory_batched_appends"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    # Appends of several threads reach the group commit together
+    memory = Memory(test_dir, storage="shared")
+    memory.storage.compact_every = 30
+    def add_facts(writer_id):
+        for i in range(25):
+            memory.add_fact(f"Writer {writer_id} fact {i}", "fact")
+    threads = [threading.Thread(target=add_facts, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert memory.storage.commits["facts.json"].commits < 200
+    assert len(memory.facts) == 200
+
+    # Journals are compacted along the way without losing or repeating records
+    memory.wait_for_writes()
+    assert memory.storage.journal_sizes["facts.json"] < 30
+    facts = [fact["fact"] for fact in Memory(test_dir, storage="shared").facts]
+    assert len(facts) == 200 and set(facts) == {fact["fact"] for fact in memory.facts}
+
+    # A change failing part way still writes what it changed
+    try:
+        with memory.changing():
+            memory.add_fact("Tea is brewed with hot water", "fact")
+            raise ValueError("failed change")
+    except ValueError:
+        pass
+    assert Memory(test_dir, storage="shared").facts[-1]["fact"] == "Tea is brewed with hot water"
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
+def test_async_and_sync_interaction_writes():
+    # Create a test directory
+    test_dir = "test_memory_async_and_sync_writes"
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    memory = Memory(test_dir, snapshot=False)
+
+    # A slow background write must not land after the newer file
+    write_file = memory.storage.write_file
+    def slow_write(file_name, data):
+        if threading.current_thread().name.startswith("memory-writer"):
+            time.sleep(0.2)
+        write_file(file_name, data)
+    memory.storage.write_file = slow_write
+
+    async def add_interactions():
+        write = memory.add_interaction_async("First question", "First answer")
+        memory.add_interaction("Second question", "Second answer")
+        await write
+        write = memory.add_interaction_async("Third question", "Third answer")
+        memory.add_fact("Tea is brewed with hot water", "fact")
+        memory.add_interaction("Fourth question", "Fourth answer")
+        await write
+
+    asyncio.run(add_interactions())
+    memory.storage.write_file = write_file
+    assert len(memory.interactions) == 4
+
+    reloaded = Memory(test_dir, snapshot=False)
+    assert [interaction["user_message"] for interaction in reloaded.interactions] == ["First question", "Second question", "Third question", "Fourth question"]
+    assert len(reloaded.facts) == 1
+
+    # Journal storages get only the record, the store isn't copied
+    journal_memory = Memory(test_dir, storage="journal", snapshot=False)
+    journal_memory.storage.compact_every = 2
+    appended = []
+    append = journal_memory.storage.append
+    def record_append(file_name, data, record):
+        appended.append(data)
+        append(file_name, data, record)
+    journal_memory.storage.append = record_append
+    for i in range(3):
+        journal_memory.add_interaction_in_background(f"Background question {i}", f"Background answer {i}").result()
+    assert appended == [None, None, None]
+    journal_memory.flush()
+    assert len(Memory(test_dir, snapshot=False).interactions) == 7
+
+    # Clean up
+    shutil.rmtree(test_dir)
+
 if __name__ == "__main__":
     test_agent_memory()
     test_search_facts()
@@ -354,4 +1519,32 @@ if __name__ == "__main__":
     test_recent_interactions()
     test_short_term_memory_persistence()
     test_case_insensitive_search()
-    test_get_context() 
\ No newline at end of file
+    test_get_context()
+    test_journal_storage_reload()
+    test_journal_storage_migrates_existing_json()
+    test_journal_compaction_survives_a_crash()
+    test_indexed_search_matches_keyword_scan()
+    test_index_persistence()
+    test_bm25_search()
+    test_short_term_memory_capacity()
+    test_short_term_memory_decay()
+    test_fact_deduplication()
+    test_get_context_cache()
+    test_get_context_token_budget()
+    test_vector_search()
+    test_shared_storage_concurrent_processes()
+    test_shared_storage_refresh()
+    test_memory_pool_eviction()
+    test_memory_pool_loads_and_flushes_outside_the_lock()
+    test_interaction_store_behaves_like_a_list()
+    test_interaction_store_memory_reduction()
+    test_memory_interactions_round_trip()
+    test_interaction_tiering()
+    test_snapshot()
+    test_time_window_queries()
+    test_metadata_filters()
+    test_fuzzy_search()
+    test_top_k_query_engine()
+    test_concurrent_readers_and_writers()
+    test_journal_appends_of_threads_are_batched()
+    test_async_and_sync_interaction_writes()
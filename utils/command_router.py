@@ -0,0 +1,66 @@
+import re
+from typing import Any, Callable, Dict, Iterable, NamedTuple, Optional
+
+WORD_PATTERN = re.compile(r"\w+")
+# Stripped between a command and its payload, as in "remember this fact: ..."
+PAYLOAD_SEPARATORS = ":, \t\n"
+# Trie key marking the end of a key command
+END = ""
+
+class CommandMatch(NamedTuple):
+    name: str
+    key_command: str
+    # The message after the key command
+    payload: str
+
+
+class CommandRouter:
+    """
+    Finds the key command in a message and calls the handler of its command.
+
+    Key commands are compiled into a trie of lowercase words, so a message
+    is scanned once and each of its words is looked up in a dict, whatever
+    the number of commands. The leftmost key command wins and, at the same
+    position, the longest one: "remember this fact" over "remember this".
+    Commands match whole words, in any case.
+    """
+
+    def __init__(self):
+        self.trie: Dict[str, Any] = {}
+        self.handlers: Dict[str, Callable[[CommandMatch], str]] = {}
+
+    def add(self, name: str, key_commands: Iterable[str], handler: Callable[[CommandMatch], str]) -> None:
+        """Register a command, a key command already registered is taken over."""
+        self.handlers[name] = handler
+        for key_command in key_commands:
+            words = WORD_PATTERN.findall(key_command.lower())
+            if not words:
+                raise ValueError(f"Key command without words: {key_command!r}")
+            node = self.trie
+            for word in words:
+                node = node.setdefault(word, {})
+            node[END] = (name, key_command)
+
+    def match(self, message: str) -> Optional[CommandMatch]:
+        # Words are lowered one by one so their spans stay those of the message
+        words = [(word.group().lower(), word.end()) for word in WORD_PATTERN.finditer(message)]
+        for i in range(len(words)):
+            node = self.trie
+            found = None
+            for word, end in words[i:]:
+                node = node.get(word)
+                if node is None:
+                    break
+                if END in node:
+                    found = (node[END], end)
+            if found is not None:
+                (name, key_command), end = found
+                return CommandMatch(name, key_command, message[end:].lstrip(PAYLOAD_SEPARATORS).strip())
+        return None
+
+    def route(self, message: str) -> Optional[str]:
+        """Call the handler of the command in the message, None if there is none."""
+        match = self.match(message)
+        if match is None:
+            return None
+        return self.handlers[match.name](match)
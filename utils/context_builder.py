@@ -0,0 +1,109 @@
+import math
+import re
+from typing import List, Dict, Any, Tuple, Optional
+
+# Share of the token budget each context section gets before the leftover is
+# handed out, sections with a bigger share also get the leftover first
+DEFAULT_SECTION_WEIGHTS = {
+    "facts": 0.3,
+    "interactions": 0.3,
+    "procedures": 0.25,
+    "short_term_memory": 0.15,
+}
+
+# Items cut shorter than this are dropped instead of truncated
+MIN_TRUNCATED_TOKENS = 16
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough local token count: one token per punctuation mark and one per four
+    characters of every word, which is close to what BPE tokenizers produce
+    for English text.
+    """
+    return sum(math.ceil(len(piece) / 4) for piece in TOKEN_PATTERN.findall(text))
+
+TRUNCATION_MARK = "..."
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    """Cut text to at most `tokens` estimated tokens, truncation mark included."""
+    tokens -= estimate_tokens(TRUNCATION_MARK)
+    used = 0
+    end = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        used += math.ceil(len(match.group()) / 4)
+        if used > tokens:
+            break
+        end = match.end()
+    return text[:end] + TRUNCATION_MARK
+
+
+class ContextSection:
+    """A titled part of the context, items are (text, relevance score) in display order."""
+
+    def __init__(self, name: str, title: str, items: List[Tuple[str, float]], weight: Optional[float] = None):
+        self.name = name
+        self.title = title
+        self.items = items
+        self.weight = DEFAULT_SECTION_WEIGHTS.get(name, 0.1) if weight is None else weight
+
+    def render(self) -> str:
+        return f"{self.title}: " + "\n".join(text for text, _ in self.items)
+
+def render_context(sections: List[ContextSection]) -> str:
+    return "\n".join(section.render() for section in sections).strip()
+
+def fit_context(sections: List[ContextSection], token_budget: int) -> Tuple[List[ContextSection], Dict[str, Any]]:
+    """
+    Cut sections down to a token budget.
+
+    Every section first gets its weighted share of the budget and keeps its
+    most relevant items that fit in it. The tokens left over then go to the
+    remaining items by section weight and relevance; an item that does not fit
+    is truncated, or dropped when less than MIN_TRUNCATED_TOKENS are left.
+
+    Returns:
+        The fitted sections, items kept in their original order, and a report
+        of the estimated size and of every dropped or truncated item
+    """
+    report = {"token_budget": token_budget, "estimated_tokens": 0, "dropped": [], "truncated": []}
+    available = token_budget - sum(estimate_tokens(f"{section.title}: ") for section in sections)
+    total_weight = sum(section.weight for section in sections) or 1
+    shares = [max(available, 0) * section.weight / total_weight for section in sections]
+
+    kept: List[Dict[int, str]] = [{} for _ in sections]
+    pending = []
+    for section_index, section in enumerate(sections):
+        share = shares[section_index]
+        ranked = sorted(enumerate(section.items), key=lambda x: -x[1][1])
+        for item_index, (text, score) in ranked:
+            # +1 for the newline between items
+            cost = estimate_tokens(text) + 1
+            if cost <= share:
+                kept[section_index][item_index] = text
+                share -= cost
+                available -= cost
+            else:
+                pending.append((section.weight, score, section_index, item_index, text, cost))
+
+    pending.sort(key=lambda x: (-x[0], -x[1]))
+    for _, _, section_index, item_index, text, cost in pending:
+        section_name = sections[section_index].name
+        if cost <= available:
+            kept[section_index][item_index] = text
+            available -= cost
+        elif available - 1 >= MIN_TRUNCATED_TOKENS:
+            kept[section_index][item_index] = truncate_to_tokens(text, available - 1)
+            available = 0
+            report["truncated"].append({"section": section_name, "text": text})
+        else:
+            report["dropped"].append({"section": section_name, "text": text})
+
+    fitted = []
+    for section_index, section in enumerate(sections):
+        items = [(kept[section_index][item_index], score) for item_index, (_, score) in enumerate(section.items) if item_index in kept[section_index]]
+        fitted.append(ContextSection(section.name, section.title, items, section.weight))
+
+    report["estimated_tokens"] = estimate_tokens(render_context(fitted))
+    return fitted, report
@@ -0,0 +1,49 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class FileLock:
+    """
+    Advisory reader/writer lock on a file, shared between processes.
+
+    Every acquisition opens its own file descriptor, so threads of one
+    process exclude each other the same way separate processes do. Where
+    flock is not available (Windows) the lock only covers the threads of the
+    current process.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.thread_lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, exclusive: bool) -> Iterator[None]:
+        if fcntl is None:
+            with self.thread_lock:
+                yield
+            return
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def shared(self):
+        """Lock for reading, any number of readers can hold it at once."""
+        return self.acquire(exclusive=False)
+
+    def exclusive(self):
+        """Lock for writing, excludes readers and other writers."""
+        return self.acquire(exclusive=True)
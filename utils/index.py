@@ -0,0 +1,250 @@
+import math
+import string
+from typing import List, Dict, Any, Tuple, Callable, Iterable, Optional, Set
+from .query_engine import QueryTerm, count_match, top_k
+from .trigram_index import TrigramIndex, DEFAULT_FUZZY_THRESHOLD
+
+# Search modes supported by the index:
+# - "keyword": same semantics as utils.search.search_keywords, an item scores
+#   one point for every query term that occurs as a substring of its content
+# - "token": an item scores one point for every query term that is a whole
+#   word of its content (case and surrounding punctuation are ignored)
+# - "bm25": whole-word matching ranked with Okapi BM25, so terms that occur in
+#   most items (like "the" or "is") contribute almost nothing to the score
+# - "fuzzy": every query term matches the words similar to it, see
+#   utils.trigram_index, so "pyhton" finds "python" and "prog" finds
+#   "programming"; an item scores the best similarity of every term
+SEARCH_MODES = ["keyword", "token", "bm25", "fuzzy"]
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+PUNCTUATION = set(string.punctuation)
+
+def tokenize(text: str) -> List[str]:
+    return text.lower().split()
+
+def normalize_token(token: str) -> str:
+    return token.strip(string.punctuation)
+
+
+class InvertedIndex:
+    """
+    Inverted index over the content of a memory store.
+
+    Postings map every lowercased whitespace-separated token to the ids of the
+    items containing it together with its term frequency. A query term without
+    whitespace can only occur inside a single token, so substring matching
+    over the vocabulary gives exactly the results of a full scan.
+    """
+
+    def __init__(self, fn: Callable[[Dict[str, Any]], str]):
+        self.fn = fn
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.words: Dict[str, Set[str]] = {}
+        self.doc_lengths: Dict[int, int] = {}
+        self.total_length = 0
+        # Trigrams of the words, built on the first fuzzy search
+        self.trigrams: Optional[TrigramIndex] = None
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def add(self, doc_id: int, item: Dict[str, Any]) -> None:
+        tokens = tokenize(self.fn(item))
+        self.doc_lengths[doc_id] = len(tokens)
+        self.total_length += len(tokens)
+
+        for token in tokens:
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = {}
+                word = normalize_token(token)
+                self.words.setdefault(word, set()).add(token)
+                if self.trigrams is not None:
+                    self.trigrams.add(word)
+            postings[doc_id] = postings.get(doc_id, 0) + 1
+
+    def remove(self, doc_id: int, item: Dict[str, Any]) -> None:
+        """Remove an item, `item` must be the content that was indexed."""
+        length = self.doc_lengths.pop(doc_id, None)
+        if length is None:
+            return
+        self.total_length -= length
+
+        for token in set(tokenize(self.fn(item))):
+            postings = self.postings.get(token)
+            if postings is None:
+                continue
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[token]
+                word = normalize_token(token)
+                self.words[word].discard(token)
+                if not self.words[word]:
+                    del self.words[word]
+                    if self.trigrams is not None:
+                        self.trigrams.remove(word)
+
+    def build(self, items: Iterable[Tuple[int, Dict[str, Any]]]) -> None:
+        for doc_id, item in items:
+            self.add(doc_id, item)
+
+    def match_tokens(self, term: str, mode: str = "keyword") -> List[str]:
+        """Vocabulary tokens matched by a single query term."""
+        if mode == "token":
+            return list(self.words.get(normalize_token(term), ()))
+        if len(term) >= 3 and not PUNCTUATION.intersection(term):
+            # Such a term can only occur inside the word of a token, so the
+            # words sharing its trigrams are the only ones to check
+            return [token for word in self.get_trigrams().containing(term) for token in self.words[word] if term in token]
+        return [token for token in self.postings if term in token]
+
+    def get_postings(self, token: str, candidates: Optional[Set[int]] = None) -> Dict[int, int]:
+        """Postings of a token, only those of `candidates` if given."""
+        postings = self.postings[token]
+        if candidates is None:
+            return postings
+        if len(candidates) < len(postings):
+            return {doc_id: postings[doc_id] for doc_id in candidates if doc_id in postings}
+        return {doc_id: tf for doc_id, tf in postings.items() if doc_id in candidates}
+
+    def match_documents(self, term: str, mode: str = "keyword", candidates: Optional[Set[int]] = None) -> Set[int]:
+        documents = set()
+        for token in self.match_tokens(term, mode):
+            documents.update(self.get_postings(token, candidates))
+        return documents
+
+    def match_frequencies(self, term: str, mode: str = "token", candidates: Optional[Set[int]] = None) -> Dict[int, int]:
+        """Term frequency of a query term in every item that contains it."""
+        tokens = self.match_tokens(term, mode)
+        if len(tokens) == 1:
+            return self.get_postings(tokens[0], candidates)
+
+        frequencies: Dict[int, int] = {}
+        for token in tokens:
+            for doc_id, tf in self.get_postings(token, candidates).items():
+                frequencies[doc_id] = frequencies.get(doc_id, 0) + tf
+        return frequencies
+
+    def get_trigrams(self) -> TrigramIndex:
+        if self.trigrams is None:
+            # Built aside, concurrent readers never see it half done
+            trigrams = TrigramIndex()
+            for word in self.words:
+                trigrams.add(word)
+            self.trigrams = trigrams
+        return self.trigrams
+
+    def get_fuzzy_terms(self, query_terms: List[str], threshold: float, candidates: Optional[Set[int]] = None) -> List[QueryTerm]:
+        terms = []
+        for term in query_terms:
+            # An item scores the best similarity of the term to one of its words
+            matches = sorted(self.get_trigrams().match(normalize_token(term), threshold), key=lambda match: -match[1])
+            postings = [(self.get_postings(token, candidates), similarity) for word, similarity in matches for token in self.words[word]]
+            postings = [(token_postings, similarity) for token_postings, similarity in postings if token_postings]
+            if postings:
+                terms.append(QueryTerm(postings, postings[0][1], count_match))
+        return terms
+
+    def get_document_frequency(self, term: str) -> int:
+        tokens = self.match_tokens(term, "token")
+        if len(tokens) == 1:
+            return len(self.postings[tokens[0]])
+        return len(self.match_documents(term, "token"))
+
+    def get_bm25_terms(self, query_terms: List[str], candidates: Optional[Set[int]] = None) -> List[QueryTerm]:
+        total_documents = len(self.doc_lengths)
+        if not total_documents:
+            return []
+        average_length = self.total_length / total_documents or 1
+
+        def get_scorer(idf: float) -> Callable[[int, int], float]:
+            def score(doc_id: int, tf: int) -> float:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[doc_id] / average_length)
+                return idf * tf * (BM25_K1 + 1) / (tf + norm)
+            return score
+
+        terms = []
+        for term in query_terms:
+            frequencies = self.match_frequencies(term, candidates=candidates)
+            if not frequencies:
+                continue
+            # Collection statistics stay those of the whole index, so filtering
+            # doesn't change the score of an item
+            df = len(frequencies) if candidates is None else self.get_document_frequency(term)
+            idf = math.log(1 + (total_documents - df + 0.5) / (df + 0.5))
+            # tf / (tf + norm) stays below 1
+            terms.append(QueryTerm([(frequencies, 1.0)], idf * (BM25_K1 + 1), get_scorer(idf)))
+        return terms
+
+    def get_match_terms(self, query_terms: List[str], mode: str, candidates: Optional[Set[int]] = None) -> List[QueryTerm]:
+        terms = []
+        for term in query_terms:
+            # The postings of every token are walked as they are, an item
+            # matching several tokens of a term is counted once
+            postings = [self.get_postings(token, candidates) for token in self.match_tokens(term, mode)]
+            postings = [(token_postings, 1.0) for token_postings in postings if token_postings]
+            if postings:
+                terms.append(QueryTerm(postings, 1.0, count_match))
+        return terms
+
+    def get_query_terms(self, query: str, mode: str, candidates: Optional[Set[int]] = None,
+                        threshold: float = DEFAULT_FUZZY_THRESHOLD) -> List[QueryTerm]:
+        """The terms of a query with the items they match and how they score them."""
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode}. Available modes: {', '.join(SEARCH_MODES)}")
+        query_terms = tokenize(query)
+        if mode == "bm25":
+            return self.get_bm25_terms(query_terms, candidates)
+        if mode == "fuzzy":
+            return self.get_fuzzy_terms(query_terms, threshold, candidates)
+        return self.get_match_terms(query_terms, mode, candidates)
+
+    def search(self, query: str, limit: int = 3, mode: str = "keyword", candidates: Optional[Set[int]] = None,
+               threshold: float = DEFAULT_FUZZY_THRESHOLD, minimum: Optional[float] = None) -> List[Tuple[int, float]]:
+        """
+        Search the index for the top `limit` items, see utils.query_engine.top_k.
+
+        Args:
+            query: Search query string
+            limit: Maximum number of results to return
+            mode: One of SEARCH_MODES
+            candidates: Only score these items, e.g. the ones passing a filter
+            threshold: Minimum similarity of a word to a query term in "fuzzy" mode
+            minimum: Items scoring below this may be left out
+
+        Returns:
+            List of (doc_id, score) sorted by score, ties in insertion order
+        """
+        return top_k(self.get_query_terms(query, mode, candidates, threshold), limit, minimum)
+
+    def to_dict(self, signature: Optional[List[Any]] = None) -> Dict[str, Any]:
+        return {
+            "signature": signature,
+            "doc_lengths": [[doc_id, length] for doc_id, length in self.doc_lengths.items()],
+            "postings": {token: [[doc_id, tf] for doc_id, tf in postings.items()] for token, postings in self.postings.items()},
+        }
+
+    def to_state(self) -> Dict[str, Any]:
+        """The index structures as they are, for binary snapshots (see utils.snapshot)."""
+        return {"postings": self.postings, "words": self.words, "doc_lengths": self.doc_lengths, "total_length": self.total_length}
+
+    @classmethod
+    def from_state(cls, fn: Callable[[Dict[str, Any]], str], state: Dict[str, Any]) -> "InvertedIndex":
+        index = cls(fn)
+        index.postings = state["postings"]
+        index.words = state["words"]
+        index.doc_lengths = state["doc_lengths"]
+        index.total_length = state["total_length"]
+        return index
+
+    @classmethod
+    def from_dict(cls, fn: Callable[[Dict[str, Any]], str], data: Dict[str, Any]) -> "InvertedIndex":
+        index = cls(fn)
+        index.doc_lengths = {doc_id: length for doc_id, length in data["doc_lengths"]}
+        index.total_length = sum(index.doc_lengths.values())
+        for token, postings in data["postings"].items():
+            index.postings[token] = {doc_id: tf for doc_id, tf in postings}
+            index.words.setdefault(normalize_token(token), set()).add(token)
+        return index
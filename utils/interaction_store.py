@@ -0,0 +1,183 @@
+import datetime
+import json
+from array import array
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+INTERACTION_KEYS = frozenset(["agent_message", "user_message", "metadata", "timestamp"])
+NO_METADATA = -1
+
+def timestamp_to_int(timestamp: str) -> Optional[int]:
+    """Microseconds since the epoch, None unless the timestamp converts back to the same string."""
+    try:
+        moment = datetime.datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is not None:
+        return None
+    value = (moment - EPOCH) // ONE_MICROSECOND
+    return value if int_to_timestamp(value) == timestamp else None
+
+def int_to_timestamp(value: int) -> str:
+    return (EPOCH + value * ONE_MICROSECOND).isoformat()
+
+
+class InteractionStore:
+    """
+    Interactions stored column by column instead of as one dict each.
+
+    Messages are kept in two lists, timestamps as integer microseconds and
+    metadata as an index into a table holding every distinct metadata dict
+    once. Reading an interaction builds a new dict, so the store can be used
+    like the list of dicts it replaces: indexing, slicing, iteration, len,
+    append and comparison with a list. Records that don't fit the columns
+    (other keys, timestamps that wouldn't convert back to the same string)
+    are kept as they are.
+    """
+
+    def __init__(self, records: Iterable[Dict[str, Any]] = ()):
+        self.user_messages: List[str] = []
+        self.agent_messages: List[str] = []
+        self.timestamps = array("q")
+        self.metadata_ids = array("i")
+        # Distinct metadata dicts, shared by the interactions that have them
+        self.metadata_values: List[Dict[str, Any]] = []
+        self.metadata_index: Dict[str, int] = {}
+        self.overflow: Dict[int, Dict[str, Any]] = {}
+        self.extend(records)
+
+    def __len__(self) -> int:
+        return len(self.user_messages)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for i in range(len(self)):
+            yield self.get_record(i)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        if isinstance(index, slice):
+            return [self.get_record(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("interaction index out of range")
+        return self.get_record(index)
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, (InteractionStore, list)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self) -> str:
+        return f"InteractionStore({len(self)} interactions)"
+
+    def __copy__(self) -> "InteractionStore":
+        # Copies the columns, not the strings, like copying a list would
+        store = InteractionStore()
+        store.user_messages = self.user_messages.copy()
+        store.agent_messages = self.agent_messages.copy()
+        store.timestamps = array("q", self.timestamps)
+        store.metadata_ids = array("i", self.metadata_ids)
+        # Append-only, the copy never refers to values added later
+        store.metadata_values = self.metadata_values
+        store.metadata_index = self.metadata_index
+        store.overflow = self.overflow.copy()
+        return store
+
+    def get_metadata_id(self, metadata: Any) -> Optional[int]:
+        if metadata is None:
+            return NO_METADATA
+        if not isinstance(metadata, dict):
+            return None
+        try:
+            key = json.dumps(metadata, sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+        metadata_id = self.metadata_index.get(key)
+        if metadata_id is None:
+            metadata_id = self.metadata_index[key] = len(self.metadata_values)
+            self.metadata_values.append(json.loads(json.dumps(metadata)))
+        return metadata_id
+
+    def append(self, record: Dict[str, Any]) -> None:
+        timestamp = metadata_id = None
+        if record.keys() == INTERACTION_KEYS:
+            if isinstance(record["user_message"], str) and isinstance(record["agent_message"], str):
+                timestamp = timestamp_to_int(record["timestamp"])
+                metadata_id = self.get_metadata_id(record["metadata"])
+
+        if timestamp is None or metadata_id is None:
+            self.overflow[len(self)] = dict(record)
+            self.user_messages.append("")
+            self.agent_messages.append("")
+            self.timestamps.append(0)
+            self.metadata_ids.append(NO_METADATA)
+            return
+
+        self.user_messages.append(record["user_message"])
+        self.agent_messages.append(record["agent_message"])
+        self.timestamps.append(timestamp)
+        self.metadata_ids.append(metadata_id)
+
+    def extend(self, records: Iterable[Dict[str, Any]]) -> None:
+        for record in records:
+            self.append(record)
+
+    def get_record(self, i: int) -> Dict[str, Any]:
+        if i in self.overflow:
+            return dict(self.overflow[i])
+        metadata_id = self.metadata_ids[i]
+        return {
+            "agent_message": self.agent_messages[i],
+            "user_message": self.user_messages[i],
+            "metadata": None if metadata_id == NO_METADATA else dict(self.metadata_values[metadata_id]),
+            "timestamp": int_to_timestamp(self.timestamps[i]),
+        }
+
+    def get_metadata(self, i: int) -> Any:
+        """Metadata of an interaction without copying it, it must not be changed."""
+        if i in self.overflow:
+            return self.overflow[i].get("metadata")
+        metadata_id = self.metadata_ids[i]
+        return None if metadata_id == NO_METADATA else self.metadata_values[metadata_id]
+
+    def get_metadata_groups(self) -> Iterator[Tuple[Any, List[int]]]:
+        """Every distinct metadata with the positions of the interactions that have it."""
+        groups: Dict[int, List[int]] = {}
+        for i, metadata_id in enumerate(self.metadata_ids):
+            if metadata_id != NO_METADATA and i not in self.overflow:
+                groups.setdefault(metadata_id, []).append(i)
+        for metadata_id, positions in groups.items():
+            yield self.metadata_values[metadata_id], positions
+        for i, record in self.overflow.items():
+            yield record.get("metadata"), [i]
+
+    def get_timestamps(self) -> Iterator[str]:
+        for i, value in enumerate(self.timestamps):
+            yield self.overflow[i]["timestamp"] if i in self.overflow else int_to_timestamp(value)
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return list(self)
+
+    def to_columns(self) -> Dict[str, Any]:
+        """The columns as plain values, for binary snapshots (see utils.snapshot)."""
+        return {
+            "user_messages": self.user_messages,
+            "agent_messages": self.agent_messages,
+            "timestamps": self.timestamps.tobytes(),
+            "metadata_ids": self.metadata_ids.tobytes(),
+            "metadata_values": self.metadata_values,
+            "overflow": self.overflow,
+        }
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, Any]) -> "InteractionStore":
+        store = cls()
+        store.user_messages = columns["user_messages"]
+        store.agent_messages = columns["agent_messages"]
+        store.timestamps.frombytes(columns["timestamps"])
+        store.metadata_ids.frombytes(columns["metadata_ids"])
+        store.metadata_values = columns["metadata_values"]
+        store.metadata_index = {json.dumps(metadata, sort_keys=True): i for i, metadata in enumerate(store.metadata_values)}
+        store.overflow = columns["overflow"]
+        return store
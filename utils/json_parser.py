@@ -1,6 +1,12 @@
 import json
+import logging
 import os
-from typing import Optional, Dict, Any
+import tempfile
+import zlib
+from contextlib import contextmanager
+from typing import IO, Any, Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
 
 def load_json(path: str):
     if not os.path.exists(path):
@@ -10,14 +16,50 @@ def load_json(path: str):
         with open(path, "r") as f:
             return json.load(f)
     except Exception as e:
-        print(f"Error loading JSON file {path}: {e}")
+        logger.error("Error loading JSON file %s: %s", path, e)
         return None
-    
+
+def encode_json_default(value: Any) -> Any:
+    # List-like containers such as InteractionStore are written as lists
+    if hasattr(value, "to_list"):
+        return value.to_list()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+@contextmanager
+def atomic_file(path: str, mode: str = "w") -> Iterator[IO]:
+    # Readers see either the old or the new file, never a partially written one
+    folder = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_json_atomic(path: str, data: Dict[str, Any]) -> None:
+    with atomic_file(path) as f:
+        json.dump(data, f, indent=2, default=encode_json_default)
+
+def write_text_atomic(path: str, text: str) -> None:
+    # Written as is, so the file has exactly the bytes of `text`
+    with atomic_file(path, "wb") as f:
+        f.write(text.encode("utf-8"))
+
+def get_file_checksum(path: str) -> Optional[str]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return f"{zlib.crc32(f.read()):08x}"
+
 def save_json(path: str, data: Dict[str, Any]):
     try:
-        with open(path, "w") as f:
-            json.dump(data, f,  indent=2)
+        write_json_atomic(path, data)
     except Exception as e:
-        print(f"Error saving JSON file {path}: {e}")
+        logger.error("Error saving JSON file %s: %s", path, e)
         return None
     
@@ -0,0 +1,47 @@
+import threading
+from typing import Dict, Tuple
+import httpx
+from openai import DefaultHttpxClient, DefaultAsyncHttpxClient
+
+# Connection pool shared by every OpenAI client of the process
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 10
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+
+# Per request settings, retries use the exponential backoff of the openai client
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_MAX_RETRIES = 2
+
+_http_clients: Dict[Tuple[int, int, float], httpx.Client] = {}
+_http_clients_lock = threading.Lock()
+
+def get_shared_http_client(max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                           max_keepalive_connections: int = DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+                           keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY) -> httpx.Client:
+    """
+    Return the process-wide HTTP client for the given pool settings.
+
+    Clients built on it reuse open connections instead of repeating the TCP
+    and TLS handshakes on every request.
+    """
+    key = (max_connections, max_keepalive_connections, keepalive_expiry)
+    with _http_clients_lock:
+        client = _http_clients.get(key)
+        if client is None or client.is_closed:
+            limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections, keepalive_expiry=keepalive_expiry)
+            client = _http_clients[key] = DefaultHttpxClient(limits=limits)
+        return client
+
+def close_shared_http_clients() -> None:
+    with _http_clients_lock:
+        for client in _http_clients.values():
+            client.close()
+        _http_clients.clear()
+
+def create_async_http_client(max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                             max_keepalive_connections: int = DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+                             keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY) -> httpx.AsyncClient:
+    # Async connections belong to the event loop that opened them, so unlike
+    # the sync pool this one can't be shared process-wide
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections, keepalive_expiry=keepalive_expiry)
+    return DefaultAsyncHttpxClient(limits=limits)
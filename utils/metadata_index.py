@@ -0,0 +1,152 @@
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+# Conditions of a filter on a metadata key: a plain value means "eq"
+FILTER_OPERATORS = ["eq", "in", "gt", "gte", "lt", "lte"]
+
+def get_value_key(value: Any) -> Optional[Tuple[int, Any]]:
+    """
+    Sortable key of a metadata value, None for values that can't be indexed
+    (lists, dicts). Values only compare with values of the same kind, so
+    True, 1 and "1" are all different.
+    """
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return None
+
+def get_conditions(condition: Any) -> Dict[str, Any]:
+    if isinstance(condition, dict):
+        unknown = set(condition) - set(FILTER_OPERATORS)
+        if unknown or not condition:
+            raise ValueError(f"Unknown filter operators: {', '.join(sorted(unknown)) or 'none given'}. Available operators: {', '.join(FILTER_OPERATORS)}")
+        return condition
+    return {"eq": condition}
+
+def matches_condition(value: Any, operator: str, operand: Any) -> bool:
+    if operator == "eq":
+        key = get_value_key(operand)
+        return value == operand if key is None else get_value_key(value) == key
+    if operator == "in":
+        return any(matches_condition(value, "eq", item) for item in operand)
+    key, bound = get_value_key(value), get_value_key(operand)
+    if key is None or bound is None or key[0] != bound[0]:
+        return False
+    if operator == "gt":
+        return key > bound
+    if operator == "gte":
+        return key >= bound
+    if operator == "lt":
+        return key < bound
+    return key <= bound
+
+def matches_filters(metadata: Optional[Dict[str, Any]], filters: Dict[str, Any]) -> bool:
+    """Whether metadata passes every filter, see MetadataIndex.select."""
+    metadata = metadata or {}
+    for name, condition in filters.items():
+        if name not in metadata:
+            return False
+        if not all(matches_condition(metadata[name], operator, operand) for operator, operand in get_conditions(condition).items()):
+            return False
+    return True
+
+
+class MetadataIndex:
+    """
+    Secondary indexes on declared metadata keys.
+
+    For every key, the positions of the records are grouped by value, so an
+    equality filter is a dict lookup. The distinct values are also kept
+    sorted, so a range filter is two binary searches over them. Records
+    without the key, or whose value is a list or dict, aren't indexed for it.
+    """
+
+    def __init__(self, keys: Iterable[str] = ()):
+        self.keys = list(keys)
+        self.postings: Dict[str, Dict[Tuple[int, Any], Set[int]]] = {key: {} for key in self.keys}
+        # Sorted distinct values of every key, rebuilt after a new value shows up
+        self.sorted_values: Dict[str, Optional[List[Tuple[int, Any]]]] = {key: [] for key in self.keys}
+
+    def add(self, position: int, metadata: Optional[Dict[str, Any]]) -> None:
+        self.add_positions([position], metadata)
+
+    def add_positions(self, positions: Iterable[int], metadata: Optional[Dict[str, Any]]) -> None:
+        if not isinstance(metadata, dict):
+            return
+        positions = list(positions)
+        for key in self.keys:
+            if key not in metadata:
+                continue
+            value_key = get_value_key(metadata[key])
+            if value_key is None:
+                continue
+            postings = self.postings[key].get(value_key)
+            if postings is None:
+                postings = self.postings[key][value_key] = set()
+                self.sorted_values[key] = None
+            postings.update(positions)
+
+    def build(self, groups: Iterable[Tuple[Optional[Dict[str, Any]], Iterable[int]]]) -> None:
+        """Index (metadata, positions) groups, see InteractionStore.get_metadata_groups."""
+        for metadata, positions in groups:
+            self.add_positions(positions, metadata)
+
+    def get_sorted_values(self, key: str) -> List[Tuple[int, Any]]:
+        if self.sorted_values[key] is None:
+            self.sorted_values[key] = sorted(self.postings[key])
+        return self.sorted_values[key]
+
+    def lookup(self, key: str, operator: str, operand: Any) -> Optional[Set[int]]:
+        """Positions matching one condition, None if the index can't answer it."""
+        postings = self.postings[key]
+        if operator == "in":
+            if any(get_value_key(item) is None for item in operand):
+                return None
+            return set().union(*(postings.get(get_value_key(item), ()) for item in operand))
+        bound = get_value_key(operand)
+        if bound is None:
+            return None
+        if operator == "eq":
+            return set(postings.get(bound, ()))
+
+        values = self.get_sorted_values(key)
+        # Only values of the same kind as the bound are in range
+        low, high = bisect_left(values, (bound[0],)), bisect_left(values, (bound[0] + 1,))
+        if operator in ("gt", "gte"):
+            low = (bisect_right if operator == "gt" else bisect_left)(values, bound, low, high)
+        else:
+            high = (bisect_right if operator == "lte" else bisect_left)(values, bound, low, high)
+        return set().union(*(postings[value] for value in values[low:high]))
+
+    def select(self, filters: Dict[str, Any]) -> Tuple[Optional[Set[int]], Dict[str, Any]]:
+        """
+        Positions passing the filters on indexed keys.
+
+        Filters map a metadata key to a value, or to conditions such as
+        {"gte": 2, "lt": 5} or {"in": ["email", "chat"]}, see
+        FILTER_OPERATORS. A record passes when it has every key and its
+        value meets every condition.
+
+        Returns:
+            The positions, None if no filter could use an index, and the
+            filters left to check on the records themselves
+        """
+        positions: Optional[Set[int]] = None
+        remaining: Dict[str, Any] = {}
+        for key, condition in filters.items():
+            conditions = get_conditions(condition)
+            if key not in self.postings:
+                remaining[key] = condition
+                continue
+            for operator, operand in conditions.items():
+                matched = self.lookup(key, operator, operand)
+                if matched is None:
+                    remaining.setdefault(key, {})[operator] = operand
+                    continue
+                positions = matched if positions is None else positions & matched
+        return positions, remaining
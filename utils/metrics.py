@@ -0,0 +1,102 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# Called with (kind, name, value) for every recorded value, kind is
+# "counter" or "timer" (value in seconds) or "value"
+Hook = Callable[[str, str, float], None]
+
+
+class MetricsRegistry:
+    """
+    In-process counters, timers and observed values.
+
+    Timers and observed values keep count, total, min and max. `snapshot()`
+    returns everything as a dict and `to_prometheus()` in the Prometheus text
+    format; hooks see every value as it is recorded. A disabled registry
+    records nothing.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters: Dict[str, float] = {}
+        self.summaries: Dict[str, Dict[str, float]] = {}
+        self.hooks: List[Hook] = []
+
+    def add_hook(self, hook: Hook) -> None:
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook: Hook) -> None:
+        self.hooks.remove(hook)
+
+    def increment(self, name: str, value: float = 1) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.call_hooks("counter", name, value)
+
+    def observe(self, name: str, value: float, kind: str = "value") -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            summary = self.summaries.get(name)
+            if summary is None:
+                self.summaries[name] = {"count": 1, "total": value, "min": value, "max": value}
+            else:
+                summary["count"] += 1
+                summary["total"] += value
+                summary["min"] = min(summary["min"], value)
+                summary["max"] = max(summary["max"], value)
+        self.call_hooks(kind, name, value)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """Record the seconds spent in the block under `name`, also when it raises."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, kind="timer")
+
+    def call_hooks(self, kind: str, name: str, value: float) -> None:
+        for hook in self.hooks:
+            hook(kind, name, value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "summaries": {name: {**summary, "mean": summary["total"] / summary["count"]} for name, summary in self.summaries.items()},
+            }
+
+    def to_prometheus(self) -> str:
+        lines = []
+        snapshot = self.snapshot()
+        for name, value in sorted(snapshot["counters"].items()):
+            metric = get_prometheus_name(name)
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        for name, summary in sorted(snapshot["summaries"].items()):
+            metric = get_prometheus_name(name)
+            lines += [f"# TYPE {metric} summary", f"{metric}_count {summary['count']}", f"{metric}_sum {summary['total']}"]
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.summaries.clear()
+
+def get_prometheus_name(name: str) -> str:
+    # agent.llm_call -> memagent_agent_llm_call
+    return "memagent_" + "".join(c if c.isalnum() else "_" for c in name)
+
+# Registry used when an Agent or Memory isn't given one
+default_registry = MetricsRegistry()
+
+def get_registry(registry: Optional[MetricsRegistry] = None) -> MetricsRegistry:
+    return default_registry if registry is None else registry
@@ -0,0 +1,165 @@
+import heapq
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+class QueryTerm(NamedTuple):
+    # Postings of every token the term matches with the weight of the token,
+    # by decreasing weight: item id -> what `score` needs, e.g. the term
+    # frequency. An item scores weight * score of the first list it is in
+    postings: Sequence[Tuple[Mapping[int, Any], float]]
+    # Highest score the term can add to an item
+    bound: float
+    score: Callable[[int, Any], float]
+
+def count_match(doc_id: int, value: Any) -> float:
+    return 1.0
+
+def count_postings(term: QueryTerm) -> int:
+    return sum(len(postings) for postings, _ in term.postings)
+
+
+class TopScores:
+    """
+    The `limit` best scores of items scored term by term, on a min-heap.
+
+    Scores only go up, so an item already kept is pushed again with its new
+    score; the entry it leaves behind is dropped once it reaches the top of
+    the heap, and the heap is rebuilt when too many pile up.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.heap: List[Tuple[float, int]] = []
+        # Item id -> score of the items kept
+        self.kept: Dict[int, float] = {}
+
+    def drop_stale(self) -> None:
+        heap, kept = self.heap, self.kept
+        while heap and kept.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def get_kth_score(self) -> Optional[float]:
+        if len(self.kept) < self.limit:
+            return None
+        self.drop_stale()
+        return self.heap[0][0]
+
+    def get_floor(self) -> float:
+        """Score an item must beat to be kept."""
+        kth = self.get_kth_score()
+        return float("-inf") if kth is None else kth
+
+    def add(self, doc_id: int, score: float) -> None:
+        if doc_id in self.kept:
+            self.kept[doc_id] = score
+            heapq.heappush(self.heap, (score, doc_id))
+            if len(self.heap) > 2 * self.limit + 16:
+                self.heap = [(score, doc_id) for doc_id, score in self.kept.items()]
+                heapq.heapify(self.heap)
+            return
+        if len(self.kept) >= self.limit:
+            if score <= self.get_floor():
+                return
+            _, dropped = heapq.heappop(self.heap)
+            del self.kept[dropped]
+        self.kept[doc_id] = score
+        heapq.heappush(self.heap, (score, doc_id))
+
+def top_k(terms: Sequence[QueryTerm], limit: int, minimum: Optional[float] = None) -> List[Tuple[int, float]]:
+    """
+    The `limit` best items of a query, scored as the sum of its terms.
+
+    Terms are processed by decreasing bound (rarest first for BM25), the
+    postings of each of their tokens by decreasing weight, while a size-k
+    heap keeps the k-th best score so far. Once the bounds of the terms
+    left add up to less than it, items not seen yet can't make it into the
+    results: the remaining postings are only looked up for the items still
+    in the running instead of being walked (MaxScore). Items that can't
+    reach the k-th score anymore are dropped along the way.
+
+    Args:
+        minimum: Score an item must reach to be of use, e.g. the k-th score
+            of another store searched before, items below it may be left out
+
+    Returns:
+        (doc_id, score) sorted by score, ties by doc_id, exactly as if every
+        item had been scored
+    """
+    if limit <= 0:
+        return []
+    terms = sorted(terms, key=lambda term: (-term.bound, count_postings(term)))
+    # Bounds of the terms from each one on, summed up without rounding
+    # drift so nothing is left once every term was processed
+    rest = [0.0] * (len(terms) + 1)
+    for i in range(len(terms) - 1, -1, -1):
+        rest[i] = rest[i + 1] + terms[i].bound
+
+    top = TopScores(limit)
+    scores: Dict[int, float] = {}
+
+    def get_threshold() -> Optional[float]:
+        kth = top.get_kth_score()
+        if minimum is None or (kth is not None and kth > minimum):
+            return kth
+        return minimum
+
+    for i, term in enumerate(terms):
+        threshold = get_threshold()
+        admit = threshold is None or rest[i] >= threshold
+        score = term.score
+        lists = term.postings
+        if admit and score is count_match and len(lists) > 1 and all(weight == lists[0][1] for _, weight in lists):
+            # Every posting is walked anyway, merge them at C speed
+            lists = [(set().union(*(postings for postings, _ in lists)), lists[0][1])]
+        # Items this term already scored through a token of higher weight
+        seen = set() if len(lists) > 1 else None
+        floor = top.get_floor()
+        for postings, weight in lists:
+            if admit:
+                matches = postings if score is count_match else postings.items()
+            elif len(scores) < len(postings):
+                # Only the items already scored can still make it
+                matches = [doc_id for doc_id in scores if doc_id in postings]
+            else:
+                matches = [doc_id for doc_id in postings if doc_id in scores]
+            if score is not count_match and not admit:
+                matches = [(doc_id, postings[doc_id]) for doc_id in matches]
+            for match in matches:
+                if score is count_match:
+                    doc_id, value = match, weight
+                else:
+                    doc_id, value = match
+                    value = weight * score(doc_id, value)
+                if seen is not None:
+                    if doc_id in seen:
+                        continue
+                    seen.add(doc_id)
+                total = scores.get(doc_id, 0) + value
+                scores[doc_id] = total
+                if total > floor or doc_id in top.kept:
+                    top.add(doc_id, total)
+                    floor = top.get_floor()
+
+        remaining = rest[i + 1]
+        threshold = get_threshold()
+        if threshold is not None and remaining < threshold:
+            scores = {doc_id: value for doc_id, value in scores.items() if value + remaining >= threshold}
+
+    return heapq.nsmallest(limit, scores.items(), key=lambda x: (-x[1], x[0]))
+
+def search_stores(stores: Sequence[str], search: Callable[[str, Optional[float]], List[Tuple[int, float]]],
+                  limit: int) -> List[Tuple[str, int, float]]:
+    """
+    The `limit` best items over several stores, as (store, doc_id, score)
+    sorted by score, then store order, then doc_id.
+
+    `search(store, minimum)` returns the best items of one store; the k-th
+    score over the stores searched so far is passed on as `minimum`, so
+    later stores skip the items that can't make it.
+    """
+    order = {store: i for i, store in enumerate(stores)}
+    results: List[Tuple[str, int, float]] = []
+    for store in stores:
+        minimum = results[-1][2] if len(results) >= limit else None
+        results += [(store, doc_id, score) for doc_id, score in search(store, minimum)]
+        results = heapq.nsmallest(limit, results, key=lambda x: (-x[2], order[x[0]], x[1]))
+    return results
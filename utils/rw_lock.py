@@ -0,0 +1,82 @@
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+class ReadWriteLock:
+    """
+    Reader/writer lock between the threads of one process, see FileLock for
+    one between processes.
+
+    Any number of threads can hold it shared, or a single thread exclusive.
+    Once a writer waits, new readers wait behind it, so a steady stream of
+    readers can't starve writers. A thread can take the lock again while it
+    holds it, and shared while it holds it exclusive, but not exclusive
+    while it holds it shared: it would wait for itself.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.waiting_writers = 0
+        # Thread holding the lock exclusive
+        self.writer: Optional[int] = None
+        # How many times the current thread holds the lock shared
+        self.local = threading.local()
+
+    def get_depth(self) -> int:
+        return getattr(self.local, "depth", 0)
+
+    @contextmanager
+    def held_again(self) -> Iterator[None]:
+        depth = self.get_depth()
+        self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+
+    @contextmanager
+    def shared(self) -> Iterator[None]:
+        """Lock for reading, any number of readers can hold it at once."""
+        if self.get_depth() or self.writer == threading.get_ident():
+            with self.held_again():
+                yield
+            return
+
+        with self.condition:
+            while self.writer is not None or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            with self.held_again():
+                yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        """Lock for writing, excludes readers and other writers."""
+        if self.writer == threading.get_ident():
+            yield
+            return
+        if self.get_depth():
+            raise RuntimeError("A read-write lock held shared can't be taken exclusive by the same thread")
+
+        with self.condition:
+            self.waiting_writers += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = threading.get_ident()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = None
+                self.condition.notify_all()
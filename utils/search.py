@@ -1,3 +1,4 @@
+import heapq
 from typing import List, Dict, Any, Tuple, Callable
 
 def search_keywords(query: str, items: List[Dict[str, Any]], fn: Callable[[Dict[str, Any]], str], limit: int = 3) -> List[Dict[str, Any]]:
@@ -28,6 +29,6 @@ def search_keywords(query: str, items: List[Dict[str, Any]], fn: Callable[[Dict[
         if score > 0:
             results.append((item, score))
 
-    # Sort by score (descending) and return top matches
-    results.sort(key=lambda x: x[1], reverse=True)
-    return [item[0] for item in results[:limit]]
\ No newline at end of file
+    # Top matches by score (descending), ties in item order, without sorting every match
+    top = heapq.nsmallest(limit, enumerate(results), key=lambda x: (-x[1][1], x[0]))
+    return [item for _, (item, _) in top]
\ No newline at end of file
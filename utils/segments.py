@@ -0,0 +1,259 @@
+import gzip
+import json
+import os
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from .cache import LRUCache
+from .index import InvertedIndex, tokenize, normalize_token
+from .json_file_utils import create_folder, get_file_path
+from .json_parser import load_json, write_json_atomic
+from .metadata_index import get_conditions, get_value_key, matches_condition, matches_filters
+from .time_index import to_timestamp_key
+from .trigram_index import DEFAULT_FUZZY_THRESHOLD
+
+DEFAULT_SEGMENT_SIZE = 1000
+# Decompressed segments (and their search indexes) kept in RAM
+DEFAULT_SEGMENT_CACHE_SIZE = 8
+MANIFEST_NAME = "manifest.json"
+
+def can_match(terms: Set[str], query: str, mode: str) -> bool:
+    """Whether any query term can match a segment with these tokens, see utils.index.SEARCH_MODES."""
+    if mode == "fuzzy":
+        # Similar words can't be told apart from the term summary
+        return True
+    query_terms = tokenize(query)
+    if mode == "keyword":
+        return any(term in token for term in query_terms for token in terms)
+    words = {normalize_token(token) for token in terms}
+    return any(normalize_token(term) in words for term in query_terms)
+
+def summarize_metadata(records: List[Dict[str, Any]], keys: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Distinct values of every metadata key among records, and whether some
+    value can't be indexed (lists, dicts), see utils.metadata_index.
+    """
+    summary = {key: {"values": {}, "other": False} for key in keys}
+    for record in records:
+        metadata = record.get("metadata")
+        if not isinstance(metadata, dict):
+            continue
+        for key, values in summary.items():
+            if key not in metadata:
+                continue
+            value_key = get_value_key(metadata[key])
+            if value_key is None:
+                values["other"] = True
+            else:
+                values["values"].setdefault(value_key, metadata[key])
+    return {key: {"values": list(values["values"].values()), "other": values["other"]} for key, values in summary.items()}
+
+def can_match_filters(summary: Optional[Dict[str, Dict[str, Any]]], filters: Dict[str, Any]) -> bool:
+    """Whether records with this metadata summary can pass the filters, see utils.metadata_index.matches_filters."""
+    if summary is None:
+        return True
+    for key, condition in filters.items():
+        # Keys that weren't summarized can't rule anything out
+        if key not in summary or summary[key]["other"]:
+            continue
+        conditions = get_conditions(condition).items()
+        if not any(all(matches_condition(value, operator, operand) for operator, operand in conditions) for value in summary[key]["values"]):
+            return False
+    return True
+
+
+class SegmentArchive:
+    """
+    Old records sealed into immutable gzip-compressed JSON lines segments.
+
+    `manifest.json` lists the segments in order with their position in the
+    full history and time range; every segment has a `.terms.json` file with
+    the tokens of its records, so searches skip the segments that can't
+    match without decompressing them. Likewise a `.metadata.json` file holds
+    the distinct values of the `metadata_keys` of its records, so filtered
+    searches skip the segments no record of which can pass the filters.
+    Only the manifest is read on startup.
+
+    Sealing is split in two: `add` makes the records part of the archive in
+    RAM, `write` puts the segment on disk later, so the caller can hold off
+    readers only while it swaps its tiers.
+    """
+
+    def __init__(self, folder: str, fn: Callable[[Dict[str, Any]], str], cache_size: int = DEFAULT_SEGMENT_CACHE_SIZE,
+                 metadata_keys: Iterable[str] = ()):
+        self.folder = folder
+        create_folder(folder)
+        self.fn = fn
+        self.metadata_keys = list(metadata_keys)
+        # Segment name -> metadata summary, None for segments sealed without one
+        self.metadata: Dict[str, Optional[Dict[str, Dict[str, Any]]]] = {}
+        self.manifest = load_json(get_file_path(folder, MANIFEST_NAME)) or {"segments": []}
+        self.terms: Dict[str, Set[str]] = {}
+        # Records of the segments added but not written yet
+        self.pending: Dict[str, List[Dict[str, Any]]] = {}
+        self.cache = LRUCache(cache_size)
+        # Segments searched and skipped thanks to their term summary
+        self.scanned = 0
+        self.skipped = 0
+
+    @property
+    def segments(self) -> List[Dict[str, Any]]:
+        return self.manifest["segments"]
+
+    def __len__(self) -> int:
+        if not self.segments:
+            return 0
+        last = self.segments[-1]
+        return last["start"] + last["count"]
+
+    def seal(self, records: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Write records as a new segment, they are part of the archive once this returns."""
+        segment = self.add(records)
+        self.write(segment)
+        return segment
+
+    def add(self, records: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Add records as a new segment in RAM, searchable right away, see write."""
+        name = f"segment-{len(self.segments) + 1:06d}"
+        terms = set()
+        for record in records:
+            terms.update(tokenize(self.fn(record)))
+        self.terms[name] = terms
+        self.metadata[name] = summarize_metadata(records, self.metadata_keys)
+
+        segment = {
+            "name": name,
+            "start": len(self),
+            "count": len(records),
+            "first_timestamp": records[0]["timestamp"],
+            "last_timestamp": records[-1]["timestamp"],
+        }
+        # Time range for time-window queries, records aren't always in time order
+        keys = [key for key in (to_timestamp_key(record["timestamp"]) for record in records) if key is not None]
+        if keys:
+            segment["min_time"], segment["max_time"] = min(keys), max(keys)
+        self.pending[name] = records
+        self.segments.append(segment)
+        return segment
+
+    def write(self, segment: Dict[str, Any]) -> None:
+        """Write a segment added with `add`, segments must be written in order."""
+        name = segment["name"]
+        records = self.pending[name]
+        path = get_file_path(self.folder, f"{name}.jsonl.gz")
+        with gzip.open(f"{path}.tmp", "wt", encoding="utf-8", compresslevel=6) as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        os.replace(f"{path}.tmp", path)
+        write_json_atomic(get_file_path(self.folder, f"{name}.terms.json"), sorted(self.terms[name]))
+        write_json_atomic(get_file_path(self.folder, f"{name}.metadata.json"), self.metadata[name])
+
+        # The manifest is written last, a crash before leaves an unused file
+        written = self.segments[:self.segments.index(segment) + 1]
+        write_json_atomic(get_file_path(self.folder, MANIFEST_NAME), {"segments": written})
+        del self.pending[name]
+
+    def read(self, segment: Dict[str, Any]) -> List[Dict[str, Any]]:
+        if segment["name"] in self.pending:
+            return self.pending[segment["name"]]
+
+        def load() -> List[Dict[str, Any]]:
+            with gzip.open(get_file_path(self.folder, f"{segment['name']}.jsonl.gz"), "rt", encoding="utf-8") as f:
+                return [json.loads(line) for line in f]
+        return self.cache.get_or_compute((segment["name"], "records"), load)
+
+    def get_terms(self, segment: Dict[str, Any]) -> Set[str]:
+        terms = self.terms.get(segment["name"])
+        if terms is None:
+            terms = self.terms[segment["name"]] = set(load_json(get_file_path(self.folder, f"{segment['name']}.terms.json")) or [])
+        return terms
+
+    def get_metadata(self, segment: Dict[str, Any]) -> Optional[Dict[str, Dict[str, Any]]]:
+        name = segment["name"]
+        if name not in self.metadata:
+            self.metadata[name] = load_json(get_file_path(self.folder, f"{name}.metadata.json"))
+        return self.metadata[name]
+
+    def can_match_filters(self, segment: Dict[str, Any], filters: Optional[Dict[str, Any]]) -> bool:
+        return not filters or can_match_filters(self.get_metadata(segment), filters)
+
+    def get_index(self, segment: Dict[str, Any], kind: str, build: Callable[[List[Dict[str, Any]]], Any]) -> Any:
+        return self.cache.get_or_compute((segment["name"], kind), lambda: build(self.read(segment)))
+
+    def build_index(self, records: List[Dict[str, Any]]) -> InvertedIndex:
+        index = InvertedIndex(self.fn)
+        index.build(enumerate(records))
+        return index
+
+    def search(self, query: str, limit: int = 3, mode: str = "keyword", embedder=None,
+               filters: Optional[Dict[str, Any]] = None,
+               threshold: float = DEFAULT_FUZZY_THRESHOLD) -> List[Tuple[int, Dict[str, Any], float]]:
+        """
+        Search every segment that can match, only the records whose
+        metadata passes `filters` if given, see utils.metadata_index.
+
+        Returns:
+            Up to `limit` results of every segment as (position in the full
+            history, record, score)
+        """
+        results = []
+        for segment in self.segments:
+            if mode != "vector" and not can_match(self.get_terms(segment), query, mode) or not self.can_match_filters(segment, filters):
+                self.skipped += 1
+                continue
+
+            candidates = None
+            if filters:
+                candidates = {i for i, record in enumerate(self.read(segment)) if matches_filters(record.get("metadata"), filters)}
+                if not candidates:
+                    self.skipped += 1
+                    continue
+
+            if mode == "vector":
+                from .vector_index import VectorIndex
+
+                def build(records: List[Dict[str, Any]]) -> VectorIndex:
+                    index = VectorIndex(self.fn, embedder)
+                    index.build(enumerate(records))
+                    return index
+
+                matches = self.get_index(segment, "vector", build).search(query, limit=limit, candidates=candidates)
+            else:
+                matches = self.get_index(segment, "text", self.build_index).search(query, limit=limit, mode=mode, candidates=candidates, threshold=threshold)
+
+            self.scanned += 1
+            records = self.read(segment)
+            results.extend((segment["start"] + doc_id, records[doc_id], score) for doc_id, score in matches)
+        return results
+
+    def recent(self, limit: int, filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """The `limit` newest archived records whose metadata passes `filters` if given, oldest first."""
+        records: List[Dict[str, Any]] = []
+        for segment in reversed(self.segments):
+            if len(records) >= limit:
+                break
+            if not self.can_match_filters(segment, filters):
+                self.skipped += 1
+                continue
+            segment_records = self.read(segment)
+            if filters:
+                segment_records = [record for record in segment_records if matches_filters(record.get("metadata"), filters)]
+            records = segment_records + records
+        return records[-limit:] if limit > 0 else []
+
+    def between(self, start: Optional[int] = None, end: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Archived records with start <= timestamp < end (microseconds since
+        the epoch, see utils.time_index), only segments whose time range
+        overlaps the window are read.
+        """
+        records = []
+        for segment in self.segments:
+            # Segments sealed before time ranges were recorded are always read
+            if "min_time" in segment:
+                if (end is not None and segment["min_time"] >= end) or (start is not None and segment["max_time"] < start):
+                    continue
+            for record in self.read(segment):
+                key = to_timestamp_key(record["timestamp"])
+                if key is not None and (start is None or key >= start) and (end is None or key < end):
+                    records.append(record)
+        records.sort(key=lambda record: to_timestamp_key(record["timestamp"]))
+        return records
@@ -0,0 +1,79 @@
+import datetime
+import heapq
+import math
+from itertools import islice
+from typing import List, Dict, Any, Optional, Tuple, Iterator
+
+
+class ShortTermMemory:
+    """
+    Capacity-bounded working memory.
+
+    Entries are kept in insertion order and, next to them, in a min-heap keyed
+    by (importance, timestamp), so adding an entry evicts the least important
+    one in O(log n) and the top entries can be read without sorting
+    everything.
+
+    With a `half_life` (in seconds) importance decays exponentially with age.
+    Since every entry decays at the same rate, importance * 0.5 ** (age /
+    half_life) ranks entries exactly like log2(importance) + created /
+    half_life, which never changes, so decay needs no re-heapify.
+    """
+
+    def __init__(self, capacity: int = 10, half_life: Optional[float] = None):
+        self.capacity = capacity
+        self.half_life = half_life
+        self.entries: Dict[int, Dict[str, Any]] = {}
+        self.heap: List[Tuple[float, str, int]] = []
+        self.next_id = 0
+        self.dirty = False
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self.entries.values())
+
+    def __getitem__(self, position: int) -> Dict[str, Any]:
+        if position < 0:
+            position += len(self.entries)
+        if not 0 <= position < len(self.entries):
+            raise IndexError("short term memory index out of range")
+        return next(islice(self.entries.values(), position, None))
+
+    def priority(self, entry: Dict[str, Any]) -> float:
+        if not self.half_life:
+            return entry["importance"]
+        if entry["importance"] <= 0:
+            return -math.inf
+        created = datetime.datetime.fromisoformat(entry["timestamp"]).timestamp()
+        return math.log2(entry["importance"]) + created / self.half_life
+
+    def decayed_importance(self, entry: Dict[str, Any], now: Optional[datetime.datetime] = None) -> float:
+        if not self.half_life:
+            return entry["importance"]
+        now = now or datetime.datetime.now()
+        age = (now - datetime.datetime.fromisoformat(entry["timestamp"])).total_seconds()
+        return entry["importance"] * 0.5 ** (max(age, 0) / self.half_life)
+
+    def add(self, entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Add an entry and return the entry evicted to stay within capacity, if any."""
+        entry_id = self.next_id
+        self.next_id += 1
+        self.entries[entry_id] = entry
+        # -entry_id: on equal keys the earlier entry ranks higher, like a stable sort
+        heapq.heappush(self.heap, (self.priority(entry), entry["timestamp"], -entry_id))
+        self.dirty = True
+
+        if len(self.entries) > self.capacity:
+            _, _, evicted_id = heapq.heappop(self.heap)
+            return self.entries.pop(-evicted_id)
+        return None
+
+    def top(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Entries sorted by (decayed) importance and timestamp, most important first."""
+        limit = len(self.heap) if limit is None else limit
+        return [self.entries[-entry_id] for _, _, entry_id in heapq.nlargest(limit, self.heap)]
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return list(self.entries.values())
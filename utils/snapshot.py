@@ -0,0 +1,76 @@
+import marshal
+import os
+import struct
+import sys
+import zlib
+from typing import Any, Dict, List, Optional
+from .json_file_utils import get_file_path
+from .storage import get_journal_name
+
+SNAPSHOT_NAME = "memory.snapshot"
+SOURCE_FILES = ["facts.json", "procedures.json", "interactions.json"]
+
+# Magic, format version, Python major and minor (marshal data is only
+# guaranteed to load on the version that wrote it), signature length and
+# CRC32 of the payload
+MAGIC = b"MEMSNAP\x00"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<8sIBBQI")
+# Bytes at the end of each source file covered by its signature
+TAIL_SIZE = 4096
+
+def get_file_signature(path: str) -> Optional[List[int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    # The tail catches rewrites that keep size, mtime and even the inode
+    with open(path, "rb") as f:
+        f.seek(max(stat.st_size - TAIL_SIZE, 0))
+        tail = f.read()
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino, zlib.crc32(tail)]
+
+def get_source_signature(location: str) -> Dict[str, Optional[List[int]]]:
+    """Signature of the JSON files and journals a snapshot is built from."""
+    signature = {}
+    for name in SOURCE_FILES:
+        for file_name in (name, get_journal_name(name)):
+            signature[file_name] = get_file_signature(get_file_path(location, file_name))
+    return signature
+
+def write_snapshot(path: str, signature: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    header = marshal.dumps(signature)
+    data = marshal.dumps(payload)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, sys.version_info[0], sys.version_info[1], len(header), zlib.crc32(data)))
+        f.write(header)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_snapshot(path: str, signature: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Load a snapshot written by write_snapshot.
+
+    Returns:
+        The payload, or None if there is no snapshot, it is damaged, was
+        written by another format or Python version, or the source files
+        changed since
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            magic, version, major, minor, header_length, checksum = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != FORMAT_VERSION or (major, minor) != sys.version_info[:2]:
+                return None
+            if marshal.loads(f.read(header_length)) != signature:
+                return None
+            data = f.read()
+        if zlib.crc32(data) != checksum:
+            return None
+        return marshal.loads(data)
+    except (OSError, EOFError, ValueError, TypeError, struct.error):
+        return None
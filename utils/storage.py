@@ -0,0 +1,424 @@
+import json
+import logging
+import os
+import threading
+import uuid
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from .file_lock import FileLock
+from .json_file_utils import get_file_path, load_json_file, save_to_json_file
+from .json_parser import encode_json_default, get_file_checksum, load_json, write_text_atomic
+from .metrics import MetricsRegistry, get_registry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COMPACT_EVERY = 1000
+
+def get_journal_name(file_name: str) -> str:
+    # facts.json -> facts.journal.jsonl
+    base, _ = os.path.splitext(file_name)
+    return f"{base}.journal.jsonl"
+
+def get_compacting_name(file_name: str, checksum: str, number: int) -> str:
+    # facts.json -> facts.compacting-<checksum of the new snapshot>-000001.jsonl
+    base, _ = os.path.splitext(file_name)
+    return f"{base}.compacting-{checksum}-{number:06d}.jsonl"
+
+def replay_journal(data: Union[List[Any], Dict[str, Any]], records: List[Dict[str, Any]]):
+    for record in records:
+        if record["op"] == "append":
+            data.append(record["value"])
+        elif record["op"] == "set":
+            data[record["key"]] = record["value"]
+    return data
+
+def read_journal(path: str) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+
+    records = []
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                # A torn last line is what an interrupted append leaves behind.
+                logger.warning("Skipping unreadable journal record %s:%d: %s", path, line_number, e)
+    return records
+
+def parse_journal_lines(path: str, text: str) -> List[Dict[str, Any]]:
+    records = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            logger.warning("Skipping unreadable journal record in %s: %s", path, e)
+    return records
+
+
+class JsonStorage:
+    """Original storage mode: every change rewrites the whole JSON file."""
+
+    def __init__(self, location: str, metrics: Optional[MetricsRegistry] = None):
+        self.location = location
+        # storage.write times every write, storage.bytes_written counts its bytes
+        self.metrics = get_registry(metrics)
+
+    def write_file(self, file_name: str, data: Union[List[Any], Dict[str, Any]]) -> None:
+        with self.metrics.timer("storage.write"):
+            save_to_json_file(self.location, file_name, data)
+        path = get_file_path(self.location, file_name)
+        if self.metrics.enabled and os.path.exists(path):
+            self.metrics.increment("storage.bytes_written", os.path.getsize(path))
+
+    def load(self, file_name: str, default: Union[List[Any], Dict[str, Any]]):
+        data = load_json_file(self.location, file_name)
+        return default if data is None else data
+
+    def append(self, file_name: str, data: List[Any], record: Any) -> None:
+        self.write_file(file_name, data)
+
+    def extend(self, file_name: str, data: List[Any], records: List[Any]) -> None:
+        self.write_file(file_name, data)
+
+    def set(self, file_name: str, data: Dict[str, Any], key: str, value: Any) -> None:
+        self.write_file(file_name, data)
+
+    def save(self, file_name: str, data: Union[List[Any], Dict[str, Any]]) -> None:
+        self.write_file(file_name, data)
+
+    def compact(self, file_name: str, data: Union[List[Any], Dict[str, Any]]) -> None:
+        self.write_file(file_name, data)
+
+    def is_append(self, write: Callable[..., None]) -> bool:
+        """
+        Whether `write` only adds the records it is given to the file, so it
+        can be called with `data` None and in any order with other appends.
+        This mode rewrites the whole file every time.
+        """
+        return False
+
+    def compaction_due(self, file_name: str) -> bool:
+        """Whether appends called with `data` None left a file to compact."""
+        return False
+
+    def read_updates(self, file_name: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Journal records other processes wrote since the file was loaded, or
+        None when it has to be loaded again. Only one process writes with
+        this mode, so there are none.
+        """
+        return []
+
+
+class JournalStorage(JsonStorage):
+    """
+    Append-only storage mode.
+
+    The existing `<name>.json` file is kept as a snapshot and every change is
+    appended as one JSON record per line to `<name>.journal.jsonl`. Loading
+    replays the journal on top of the snapshot; once a journal holds
+    `compact_every` records it is folded back into the snapshot. Because the
+    snapshot is the regular JSON file, an existing memory directory can be
+    opened in this mode as is, and `compact` turns it back into plain JSON.
+
+    Compaction renames the journal to `<name>.compacting-<checksum>-<n>.jsonl`
+    before it replaces the snapshot, with the checksum of the new snapshot,
+    and removes it afterwards. A crash in between leaves the file behind,
+    and loads replay it only if the snapshot on disk doesn't hold it yet.
+    """
+
+    def __init__(self, location: str, compact_every: int = DEFAULT_COMPACT_EVERY, metrics: Optional[MetricsRegistry] = None):
+        super().__init__(location, metrics)
+        self.compact_every = compact_every
+        self.journal_sizes: Dict[str, int] = {}
+        # Appends of several threads, each written in one piece
+        self.append_lock = threading.Lock()
+
+    def get_journal_path(self, file_name: str) -> str:
+        return get_file_path(self.location, get_journal_name(file_name))
+
+    def load(self, file_name: str, default: Union[List[Any], Dict[str, Any]]):
+        data = super().load(file_name, default)
+        records = self.read_compacting_records(file_name) + read_journal(self.get_journal_path(file_name))
+        self.journal_sizes[file_name] = len(records)
+        return replay_journal(data, records)
+
+    def get_compacting_journals(self, file_name: str) -> List[Tuple[int, str, str]]:
+        """Journals left by an interrupted compaction, as (number, checksum, path) in order."""
+        base, _ = os.path.splitext(file_name)
+        prefix = f"{base}.compacting-"
+        journals = []
+        for name in os.listdir(self.location):
+            if name.startswith(prefix) and name.endswith(".jsonl"):
+                checksum, number = name[len(prefix):-len(".jsonl")].split("-")
+                journals.append((int(number), checksum, get_file_path(self.location, name)))
+        return sorted(journals)
+
+    def read_compacting_records(self, file_name: str) -> List[Dict[str, Any]]:
+        """Records of an interrupted compaction the snapshot doesn't hold, to replay before the journal."""
+        journals = self.get_compacting_journals(file_name)
+        if not journals:
+            return []
+        checksum = get_file_checksum(get_file_path(self.location, file_name))
+        records = []
+        for _, journal_checksum, path in journals:
+            if journal_checksum != checksum:
+                records.extend(read_journal(path))
+        return records
+
+    # data: the whole store, to compact the journal once it holds
+    # compact_every records; None leaves that to the caller, see compaction_due
+    def write_records(self, file_name: str, data: Optional[Union[List[Any], Dict[str, Any]]], records: List[Dict[str, Any]]) -> None:
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with self.metrics.timer("storage.write"):
+            with self.append_lock:
+                with open(self.get_journal_path(file_name), "a") as f:
+                    f.write(lines)
+                self.journal_sizes[file_name] = self.journal_sizes.get(file_name, 0) + len(records)
+        self.metrics.increment("storage.bytes_written", len(lines.encode("utf-8")))
+
+        if data is not None and self.compaction_due(file_name):
+            self.compact(file_name, data)
+
+    def is_append(self, write: Callable[..., None]) -> bool:
+        # Sets of one key must stay in order, they aren't appends
+        return write == self.append or write == self.extend
+
+    def compaction_due(self, file_name: str) -> bool:
+        return self.journal_sizes.get(file_name, 0) >= self.compact_every
+
+    def append(self, file_name: str, data: List[Any], record: Any) -> None:
+        self.write_records(file_name, data, [{"op": "append", "value": record}])
+
+    def extend(self, file_name: str, data: List[Any], records: List[Any]) -> None:
+        self.write_records(file_name, data, [{"op": "append", "value": record} for record in records])
+
+    def set(self, file_name: str, data: Dict[str, Any], key: str, value: Any) -> None:
+        self.write_records(file_name, data, [{"op": "set", "key": key, "value": value}])
+
+    def save(self, file_name: str, data: Union[List[Any], Dict[str, Any]]) -> None:
+        # A full rewrite supersedes whatever the journal holds.
+        self.compact(file_name, data)
+
+    def compact(self, file_name: str, data: Union[List[Any], Dict[str, Any]]) -> None:
+        self.replace_snapshot(file_name, data)
+
+    def replace_snapshot(self, file_name: str, data: Union[List[Any], Dict[str, Any]]) -> None:
+        path = get_file_path(self.location, file_name)
+        with self.metrics.timer("storage.compact"):
+            text = json.dumps(data, indent=2, default=encode_json_default)
+            checksum = f"{zlib.crc32(text.encode('utf-8')):08x}"
+
+            # Journals of an interrupted compaction go into the new snapshot
+            # too, unless the current one already holds them
+            journals = self.get_compacting_journals(file_name)
+            if journals:
+                current = get_file_checksum(path)
+                for _, journal_checksum, journal_path in journals:
+                    if journal_checksum == current:
+                        os.remove(journal_path)
+                journals = [journal for journal in journals if journal[1] != current]
+            renamed = []
+            for number, _, journal_path in journals:
+                renamed.append(get_file_path(self.location, get_compacting_name(file_name, checksum, number)))
+                os.replace(journal_path, renamed[-1])
+            journal_path = self.get_journal_path(file_name)
+            if os.path.exists(journal_path):
+                number = journals[-1][0] + 1 if journals else 1
+                renamed.append(get_file_path(self.location, get_compacting_name(file_name, checksum, number)))
+                os.replace(journal_path, renamed[-1])
+                open(journal_path, "w").close()
+
+            # Replaced atomically, a failed dump never leaves a truncated
+            # snapshot; the renamed journals are only removed once it is written
+            write_text_atomic(path, text)
+            for renamed_path in renamed:
+                os.remove(renamed_path)
+        self.metrics.increment("storage.bytes_written", os.path.getsize(path))
+        self.journal_sizes[file_name] = 0
+
+
+class CommitBatch:
+    def __init__(self):
+        self.lines: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+
+
+class GroupCommit:
+    """
+    Appends lines to a file durably, batching concurrent appends.
+
+    The first thread to arrive writes every line queued so far under the
+    exclusive file lock and with a single fsync, threads arriving meanwhile
+    queue their lines for the next batch. Each append returns once its own
+    batch is on disk and raises if writing that batch failed.
+    """
+
+    def __init__(self, path: str, lock: FileLock):
+        self.path = path
+        self.lock = lock
+        self.condition = threading.Condition()
+        self.batch = CommitBatch()
+        self.writing = False
+        self.commits = 0
+
+    def append(self, lines: str) -> None:
+        with self.condition:
+            batch = self.batch
+            batch.lines.append(lines)
+            while not batch.done and self.writing:
+                self.condition.wait()
+            if batch.done:
+                if batch.error is not None:
+                    raise batch.error
+                return
+            # Nobody is writing: this thread writes the batch, later arrivals
+            # start the next one
+            self.writing = True
+            self.batch = CommitBatch()
+
+        try:
+            with self.lock.exclusive():
+                with open(self.path, "a") as f:
+                    f.write("".join(batch.lines))
+                    f.flush()
+                    os.fsync(f.fileno())
+        except BaseException as e:
+            batch.error = e
+
+        with self.condition:
+            batch.done = True
+            self.writing = False
+            self.commits += 1
+            self.condition.notify_all()
+        if batch.error is not None:
+            raise batch.error
+
+
+class SharedJournalStorage(JournalStorage):
+    """
+    Journal storage mode for several processes sharing one location.
+
+    Appends go through a group commit under an exclusive flock on
+    `.memory.lock`, so concurrent writers only ever append to the journal and
+    never rewrite the snapshot. Loads hold the shared lock and remember how
+    far the journal was read, `read_updates` then returns the records other
+    processes appended since. Compaction rebuilds the snapshot from the files
+    on disk under the exclusive lock and replaces it atomically.
+    """
+
+    def __init__(self, location: str, compact_every: int = DEFAULT_COMPACT_EVERY, metrics: Optional[MetricsRegistry] = None):
+        super().__init__(location, compact_every, metrics)
+        # Tells this instance's records apart from other writers'
+        self.writer_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lock = FileLock(get_file_path(location, ".memory.lock"))
+        self.commits: Dict[str, GroupCommit] = {}
+        self.commits_lock = threading.Lock()
+        # file name -> journal bytes read so far, None once it must be reloaded
+        self.offsets: Dict[str, Optional[int]] = {}
+        self.snapshots: Dict[str, Optional[Tuple[int, int, int]]] = {}
+
+    def get_snapshot_identity(self, file_name: str) -> Optional[Tuple[int, int, int]]:
+        # Atomic replaces change the inode, so this changes on every compaction
+        try:
+            stat = os.stat(get_file_path(self.location, file_name))
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def read_journal_from(self, file_name: str, offset: int) -> Tuple[List[Dict[str, Any]], int]:
+        path = self.get_journal_path(file_name)
+        if not os.path.exists(path):
+            return [], 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            chunk = f.read()
+        # Only whole lines, a line still being written is read next time
+        end = chunk.rfind(b"\n") + 1
+        return parse_journal_lines(path, chunk[:end].decode("utf-8")), offset + end
+
+    def load(self, file_name: str, default: Union[List[Any], Dict[str, Any]]):
+        with self.lock.shared():
+            data = load_json(get_file_path(self.location, file_name))
+            data = default if data is None else data
+            compacting = self.read_compacting_records(file_name)
+            records, offset = self.read_journal_from(file_name, 0)
+            records = compacting + records
+            self.snapshots[file_name] = self.get_snapshot_identity(file_name)
+        self.offsets[file_name] = offset
+        self.journal_sizes[file_name] = len(records)
+        return replay_journal(data, records)
+
+    def read_updates(self, file_name: str) -> Optional[List[Dict[str, Any]]]:
+        offset = self.offsets.get(file_name)
+        if offset is None:
+            return None
+
+        with self.lock.shared():
+            journal_path = self.get_journal_path(file_name)
+            journal_size = os.path.getsize(journal_path) if os.path.exists(journal_path) else 0
+            # Another process compacted the file
+            if self.get_snapshot_identity(file_name) != self.snapshots.get(file_name) or journal_size < offset:
+                self.offsets[file_name] = None
+                return None
+            records, self.offsets[file_name] = self.read_journal_from(file_name, offset)
+
+        self.journal_sizes[file_name] = self.journal_sizes.get(file_name, 0) + len(records)
+        return [record for record in records if record.get("writer") != self.writer_id]
+
+    def get_group_commit(self, file_name: str) -> GroupCommit:
+        with self.commits_lock:
+            if file_name not in self.commits:
+                self.commits[file_name] = GroupCommit(self.get_journal_path(file_name), self.lock)
+            return self.commits[file_name]
+
+    def write_records(self, file_name: str, data: Optional[Union[List[Any], Dict[str, Any]]], records: List[Dict[str, Any]]) -> None:
+        lines = "".join(json.dumps({**record, "writer": self.writer_id}) + "\n" for record in records)
+        with self.metrics.timer("storage.write"):
+            self.get_group_commit(file_name).append(lines)
+        self.metrics.increment("storage.bytes_written", len(lines.encode("utf-8")))
+
+        with self.append_lock:
+            self.journal_sizes[file_name] = self.journal_sizes.get(file_name, 0) + len(records)
+        if data is not None and self.compaction_due(file_name):
+            self.compact(file_name, data)
+
+    def save(self, file_name: str, data: Union[List[Any], Dict[str, Any]]) -> None:
+        # Replaces whatever other processes wrote, refresh before saving
+        with self.lock.exclusive():
+            self.replace_snapshot(file_name, data)
+
+    def compact(self, file_name: str, data: Union[List[Any], Dict[str, Any]]) -> None:
+        # `data` may miss records of other processes, the files on disk don't
+        with self.lock.exclusive():
+            snapshot = load_json(get_file_path(self.location, file_name))
+            snapshot = type(data)() if snapshot is None else snapshot
+            records, _ = self.read_journal_from(file_name, 0)
+            self.replace_snapshot(file_name, replay_journal(snapshot, self.read_compacting_records(file_name) + records))
+
+    def replace_snapshot(self, file_name: str, data: Union[List[Any], Dict[str, Any]]) -> None:
+        super().replace_snapshot(file_name, data)
+        # The snapshot now holds records this process hasn't seen
+        self.offsets[file_name] = None
+
+
+STORAGE_MODES = {
+    "json": JsonStorage,
+    "journal": JournalStorage,
+    "shared": SharedJournalStorage,
+}
+
+def create_storage(mode: Union[str, JsonStorage], location: str, metrics: Optional[MetricsRegistry] = None) -> JsonStorage:
+    if isinstance(mode, JsonStorage):
+        return mode
+    if mode not in STORAGE_MODES:
+        raise ValueError(f"Unknown storage mode: {mode}. Available modes: {', '.join(STORAGE_MODES)}")
+    return STORAGE_MODES[mode](location, metrics=metrics)
@@ -0,0 +1,135 @@
+import datetime
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+from .interaction_store import EPOCH, ONE_MICROSECOND, InteractionStore
+
+# Interactions further apart than this belong to different sessions
+DEFAULT_SESSION_GAP = 30 * 60
+
+TimeBound = Union[str, datetime.datetime, None]
+
+def to_timestamp_key(value: TimeBound) -> Optional[int]:
+    """
+    Microseconds since the epoch of an ISO timestamp or datetime, None if it
+    can't be read. Aware times are converted to local time, like the naive
+    timestamps the memory writes.
+    """
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if not isinstance(value, datetime.datetime):
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return (value - EPOCH) // ONE_MICROSECOND
+
+def to_bound_key(value: TimeBound) -> Optional[int]:
+    """Key of a time window bound, None for an open bound."""
+    if value is None:
+        return None
+    key = to_timestamp_key(value)
+    if key is None:
+        raise ValueError(f"Not an ISO timestamp or datetime: {value!r}")
+    return key
+
+
+class TimeIndex:
+    """
+    Record positions sorted by timestamp, for time-window queries.
+
+    Keys are integer microseconds since the epoch in an array, so a window
+    is found with two binary searches and the records in it are read
+    directly. Records are usually added in time order, which only appends
+    to the arrays; an older record is inserted at its place.
+    """
+
+    def __init__(self):
+        self.keys = array("q")
+        self.positions = array("q")
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, key: Optional[int], position: int) -> None:
+        if key is None:
+            return
+        if not self.keys or key >= self.keys[-1]:
+            self.keys.append(key)
+            self.positions.append(position)
+            return
+        # Equal keys keep the order they were added in
+        i = bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.positions.insert(i, position)
+
+    def build(self, items: Iterable[Tuple[int, Optional[int]]]) -> None:
+        """Index (position, key) pairs, records without a key are left out."""
+        pairs = sorted((key, position) for position, key in items if key is not None)
+        self.keys = array("q", (key for key, _ in pairs))
+        self.positions = array("q", (position for _, position in pairs))
+
+    @classmethod
+    def from_interactions(cls, interactions: InteractionStore) -> "TimeIndex":
+        index = cls()
+        if not interactions.overflow and all(a <= b for a, b in zip(interactions.timestamps, interactions.timestamps[1:])):
+            # Already in time order, the timestamp column is the index
+            index.keys = array("q", interactions.timestamps)
+            index.positions = array("q", range(len(interactions)))
+            return index
+        index.build((i, to_timestamp_key(interactions.overflow[i]["timestamp"]) if i in interactions.overflow else key)
+                    for i, key in enumerate(interactions.timestamps))
+        return index
+
+    def get_bounds(self, start: Optional[int] = None, end: Optional[int] = None) -> Tuple[int, int]:
+        """Range of sorted entries with start <= key < end, in O(log n)."""
+        low = 0 if start is None else bisect_left(self.keys, start)
+        high = len(self.keys) if end is None else bisect_left(self.keys, end)
+        return low, max(low, high)
+
+    def between(self, start: Optional[int] = None, end: Optional[int] = None, limit: Optional[int] = None) -> List[int]:
+        """Positions of the records with start <= key < end in time order, the `limit` newest if given."""
+        low, high = self.get_bounds(start, end)
+        if limit is not None:
+            low = max(low, high - limit)
+        return self.positions[low:high].tolist()
+
+    def latest(self, limit: int) -> List[int]:
+        """Positions of the `limit` newest records, oldest first."""
+        return self.between(limit=limit) if limit > 0 else []
+
+    def get_session_start(self, gap: float = DEFAULT_SESSION_GAP) -> int:
+        """
+        Sorted entry where the last session starts: the entry after the
+        last gap longer than `gap` seconds, 0 if there is none.
+        """
+        gap_key = int(gap * 1_000_000)
+        i = len(self.keys) - 1
+        while i > 0 and self.keys[i] - self.keys[i - 1] <= gap_key:
+            i -= 1
+        return max(i, 0)
+
+    def to_state(self) -> Dict[str, Any]:
+        return {"keys": self.keys.tobytes(), "positions": self.positions.tobytes()}
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> "TimeIndex":
+        index = cls()
+        index.keys.frombytes(state["keys"])
+        index.positions.frombytes(state["positions"])
+        return index
+
+def split_sessions(records: List[Dict[str, Any]], gap: float = DEFAULT_SESSION_GAP) -> List[List[Dict[str, Any]]]:
+    """Split time-ordered records wherever they are more than `gap` seconds apart."""
+    sessions: List[List[Dict[str, Any]]] = []
+    gap_key = int(gap * 1_000_000)
+    previous = None
+    for record in records:
+        key = to_timestamp_key(record["timestamp"])
+        if not sessions or (key is not None and previous is not None and key - previous > gap_key):
+            sessions.append([])
+        sessions[-1].append(record)
+        previous = key if key is not None else previous
+    return sessions
@@ -0,0 +1,73 @@
+from typing import Dict, List, Set, Tuple
+
+# Minimum similarity of a word to a query term in the "fuzzy" search mode
+DEFAULT_FUZZY_THRESHOLD = 0.4
+# A query term that starts a word ("prog" in "programming") matches it with
+# this similarity, below a whole-word match
+PREFIX_WEIGHT = 0.9
+
+def get_trigrams(word: str) -> Set[str]:
+    # Padded like pg_trgm, so the start and end of a word weigh more
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """
+    Trigrams of the words of a vocabulary, for typo-tolerant matching.
+
+    A query term is compared to the words sharing at least one trigram with
+    it, found through the postings of its own trigrams, so the cost depends
+    on how common its trigrams are, not on the size of the vocabulary.
+    Similarity is the Dice coefficient of the trigram sets ("pyhton" and
+    "python" score 0.43), or PREFIX_WEIGHT when the term starts the word.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, Set[str]] = {}
+        self.sizes: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def add(self, word: str) -> None:
+        if not word or word in self.sizes:
+            return
+        trigrams = get_trigrams(word)
+        self.sizes[word] = len(trigrams)
+        for trigram in trigrams:
+            self.postings.setdefault(trigram, set()).add(word)
+
+    def remove(self, word: str) -> None:
+        if self.sizes.pop(word, None) is None:
+            return
+        for trigram in get_trigrams(word):
+            words = self.postings.get(trigram)
+            if words is not None:
+                words.discard(word)
+                if not words:
+                    del self.postings[trigram]
+
+    def containing(self, term: str) -> List[str]:
+        """Words containing a term of at least 3 characters."""
+        words = min((self.postings.get(term[i:i + 3], ()) for i in range(len(term) - 2)), key=len)
+        return [word for word in words if term in word]
+
+    def match(self, term: str, threshold: float = DEFAULT_FUZZY_THRESHOLD) -> List[Tuple[str, float]]:
+        """Words at least `threshold` similar to a normalized query term, with their similarity."""
+        if not term:
+            return []
+        trigrams = get_trigrams(term)
+        shared: Dict[str, int] = {}
+        for trigram in trigrams:
+            for word in self.postings.get(trigram, ()):
+                shared[word] = shared.get(word, 0) + 1
+
+        matches = []
+        for word, count in shared.items():
+            similarity = 2 * count / (len(trigrams) + self.sizes[word])
+            if word.startswith(term):
+                similarity = max(similarity, PREFIX_WEIGHT)
+            if similarity >= threshold:
+                matches.append((word, similarity))
+        return matches
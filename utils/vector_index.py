@@ -0,0 +1,136 @@
+import re
+import zlib
+from typing import List, Dict, Any, Tuple, Callable, Iterable, Optional, Set
+import numpy as np
+
+DEFAULT_DIMENSIONS = 512
+DEFAULT_NGRAM_SIZE = 3
+# Hashed embeddings of unrelated texts still overlap a little
+DEFAULT_MIN_SIMILARITY = 0.1
+INITIAL_CAPACITY = 64
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class HashingEmbedder:
+    """
+    Local embedder hashing words and character n-grams into a fixed number of
+    dimensions. Shared n-grams make "colour" close to "color", no model is
+    needed.
+
+    Any object with a `dimensions` attribute and an `embed(texts)` method
+    returning a (len(texts), dimensions) float32 array of unit vectors can be
+    used in its place, for example a wrapper around a sentence embedding model.
+    """
+
+    def __init__(self, dimensions: int = DEFAULT_DIMENSIONS, ngram_size: int = DEFAULT_NGRAM_SIZE):
+        self.dimensions = dimensions
+        self.ngram_size = ngram_size
+
+    def features(self, text: str) -> List[str]:
+        features = []
+        for word in WORD_PATTERN.findall(text.lower()):
+            features.append(word)
+            padded = f"#{word}#"
+            features.extend(padded[i:i + self.ngram_size] for i in range(max(len(padded) - self.ngram_size + 1, 1)))
+        return features
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self.features(text):
+                hashed = zlib.crc32(feature.encode("utf-8"))
+                # The sign bit keeps collisions from only ever adding up
+                vectors[row, hashed % self.dimensions] += 1.0 if hashed & 0x80000000 else -1.0
+
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+class VectorIndex:
+    """
+    Embeddings of a memory store in one contiguous float32 matrix.
+
+    Rows are appended in place and the matrix doubles its capacity when full,
+    so adding items never rebuilds it. A query is a single matrix-vector
+    product followed by argpartition for the top-k.
+    """
+
+    def __init__(self, fn: Callable[[Dict[str, Any]], str], embedder: Optional[HashingEmbedder] = None):
+        self.fn = fn
+        self.embedder = embedder or HashingEmbedder()
+        self.matrix = np.zeros((INITIAL_CAPACITY, self.embedder.dimensions), dtype=np.float32)
+        self.doc_ids = np.zeros(INITIAL_CAPACITY, dtype=np.int64)
+        self.rows: Dict[int, int] = {}
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def reserve(self, size: int) -> None:
+        capacity = len(self.matrix)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        matrix = np.zeros((capacity, self.embedder.dimensions), dtype=np.float32)
+        matrix[:self.size] = self.matrix[:self.size]
+        doc_ids = np.zeros(capacity, dtype=np.int64)
+        doc_ids[:self.size] = self.doc_ids[:self.size]
+        self.matrix, self.doc_ids = matrix, doc_ids
+
+    def add_vectors(self, doc_ids: List[int], vectors: np.ndarray) -> None:
+        self.reserve(self.size + len(doc_ids))
+        rows = []
+        for doc_id in doc_ids:
+            row = self.rows.get(doc_id)
+            if row is None:
+                row = self.rows[doc_id] = self.size
+                self.size += 1
+            rows.append(row)
+        self.matrix[rows] = vectors
+        self.doc_ids[rows] = doc_ids
+
+    def add(self, doc_id: int, item: Dict[str, Any]) -> None:
+        """Add an item, or replace the vector of an item already indexed."""
+        self.add_vectors([doc_id], self.embedder.embed([self.fn(item)]))
+
+    def build(self, items: Iterable[Tuple[int, Dict[str, Any]]]) -> None:
+        items = list(items)
+        if items:
+            self.add_vectors([doc_id for doc_id, _ in items], self.embedder.embed([self.fn(item) for _, item in items]))
+
+    def search(self, query: str, limit: int = 3, min_similarity: float = DEFAULT_MIN_SIMILARITY,
+               candidates: Optional[Set[int]] = None) -> List[Tuple[int, float]]:
+        """
+        Return up to `limit` (doc_id, cosine similarity) pairs, most similar
+        first, only among `candidates` if given.
+        """
+        if not query.strip() or not self.size or limit <= 0:
+            return []
+
+        query_vector = self.embedder.embed([query])[0]
+        if candidates is None:
+            rows = np.arange(self.size)
+            scores = self.matrix[:self.size] @ query_vector
+        else:
+            rows = np.array(sorted(self.rows[doc_id] for doc_id in candidates if doc_id in self.rows), dtype=np.int64)
+            if not len(rows):
+                return []
+            scores = self.matrix[rows] @ query_vector
+        limit = min(limit, len(rows))
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(self.doc_ids[rows[i]]), float(scores[i])) for i in top if scores[i] >= min_similarity]
+
+    def save(self, path: str, signature: Optional[List[Any]] = None) -> Dict[str, Any]:
+        """Write the matrix to `path` (.npy) and return the metadata to store next to it."""
+        np.save(path, self.matrix[:self.size])
+        return {"signature": signature, "dimensions": self.embedder.dimensions, "doc_ids": self.doc_ids[:self.size].tolist()}
+
+    @classmethod
+    def load(cls, fn: Callable[[Dict[str, Any]], str], embedder: Optional[HashingEmbedder], path: str, metadata: Dict[str, Any]) -> "VectorIndex":
+        index = cls(fn, embedder)
+        index.add_vectors(metadata["doc_ids"], np.load(path))
+        return index